@@ -0,0 +1,316 @@
+"""Benchmarks the scoring hot paths on a synthetic database.
+
+    python3 benchmark.py [--scale 1k|100k|1m] [--database-uri sqlite:////tmp/bench.db] [--iterations 200] [--output results.json] [--baseline old.json]
+
+Customers, transactions and instalments are generated with the models.py schema, in a temporary
+SQLite file unless --database-uri points at an empty database (or one an earlier run filled, which
+is reused as it is). Each benchmark is timed call by call and reported as p50/p95/mean in
+milliseconds, with the peak memory Python allocated during one traced call. Results are JSON, and
+with --baseline each p50 is compared with an earlier run: the exit status is 1 when any got more
+than --threshold slower.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import func, insert
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPORT_PATH = os.path.join(BASE_DIR, "Consumer-Credit-Report.pdf")
+CCI_PATH = os.path.join(BASE_DIR, "CONSUMER-CREDIT-INDEX-Q2-2024.pdf")
+
+# Number of instalments generated at each scale
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+INSERT_CHUNK_SIZE = 10_000
+DEFAULT_ITERATIONS = 200
+WARMUP_ITERATIONS = 5
+DEFAULT_THRESHOLD = 0.2
+
+# A transaction is paid in this many monthly instalments, a customer has 1 to 4 transactions
+INSTALMENTS_PER_TRANSACTION = 3
+STATUS_CODES = [-2, -1, -1, -1, -1, 0, 2, 3, 4, 5, 6]
+
+
+def generate_customers(n_instalments, rng, now):
+    # Yields (customer, transactions, instalments) rows until n_instalments instalments are made
+    from models import CustomerStatus, TransactionStatus, InstalmentPaymentStatus
+    made = 0
+    i = 0
+    while made < n_instalments:
+        customer_id = f"customer-{i:07d}"
+        customer = {
+            "customer_id": customer_id,
+            "name": customer_id,
+            "email": f"{customer_id}@example.com",
+            "password": "password",
+            "contact_number": "91234567",
+            "address": "address",
+            "date_of_birth": datetime(1990, 1, 1),
+            "status": CustomerStatus.ACTIVE,
+            "wallet_balance": 0,
+            "credit_score": rng.randrange(300, 900),
+            "credit_score_history": ",".join(str(rng.choice(STATUS_CODES)) for _ in range(6)),
+            "credit_utilisation_ratio": round(rng.random(), 4),
+        }
+        transactions, instalments = [], []
+        for t in range(rng.randint(1, 4)):
+            transaction_id = f"{customer_id}-{t}"
+            date_of_transaction = now - timedelta(days=rng.randrange(0, 365))
+            transactions.append({
+                "transaction_id": transaction_id,
+                "amount": 300.0,
+                "date_of_transaction": date_of_transaction,
+                "status": TransactionStatus.IN_PROGRESS,
+                "reference_no": "",
+                "cashback_percentage": 0,
+                "customer_id": customer_id,
+            })
+            for n in range(INSTALMENTS_PER_TRANSACTION):
+                due_date = date_of_transaction + timedelta(days=30 * (n + 1))
+                paid_date = None
+                # Most instalments due by now are paid, some of them late
+                if due_date <= now and rng.random() < 0.85:
+                    paid_date = due_date + timedelta(days=rng.choice([0, 0, 0, 5, 40, 70, 100]))
+                instalments.append({
+                    "instalment_payment_id": f"{transaction_id}-{n}",
+                    "amount_due": 100.0,
+                    "late_payment_amount_due": 0.0,
+                    "status": InstalmentPaymentStatus.PAID if paid_date else InstalmentPaymentStatus.UNPAID,
+                    "due_date": due_date,
+                    "paid_date": paid_date,
+                    "instalment_number": n + 1,
+                    "transaction_id": transaction_id,
+                })
+        made += len(instalments)
+        i += 1
+        yield customer, transactions, instalments
+
+
+def build_database(db, n_instalments, seed=0, now=None):
+    from models import Customer, CreditTier, Transaction, InstalmentPayment
+    now = now or datetime.now()
+    rng = random.Random(seed)
+    db.create_all()
+    db.session.execute(insert(CreditTier), [
+        {"credit_tier_id": f"tier-{i}", "name": name, "min_credit_score": low, "max_credit_score": high, "credit_limit": limit}
+        for i, (name, low, high, limit) in enumerate([("Bronze", 0, 499, 500), ("Silver", 500, 699, 1000), ("Gold", 700, 1000, 3000)])
+    ])
+
+    from service import refresh_payment_statuses
+    customers, transactions, instalments = [], [], []
+
+    def flush():
+        customer_ids = [customer["customer_id"] for customer in customers]
+        for model, rows in ((Customer, customers), (Transaction, transactions), (InstalmentPayment, instalments)):
+            if rows:
+                db.session.execute(insert(model), rows)
+            rows.clear()
+        db.session.commit()
+        # Scoring reads the materialised payment statuses, so they are built as in production.
+        # Chunk by chunk rather than with payment_status.rebuild, whose open read cursor blocks
+        # SQLite's writes.
+        if customer_ids:
+            refresh_payment_statuses(db, customer_ids, now)
+
+    for customer, customer_transactions, customer_instalments in generate_customers(n_instalments, rng, now):
+        customers.append(customer)
+        transactions += customer_transactions
+        instalments += customer_instalments
+        if len(instalments) >= INSERT_CHUNK_SIZE:
+            flush()
+    flush()
+
+
+def measure(fn, cases, iterations=DEFAULT_ITERATIONS, setup=None):
+    # Calls fn(*case) for the cases in turn; setup runs before each call and is not timed
+    for i in range(min(WARMUP_ITERATIONS, iterations)):
+        if setup:
+            setup()
+        fn(*cases[i % len(cases)])
+
+    timings = []
+    for i in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn(*cases[i % len(cases)])
+        timings.append(time.perf_counter() - start)
+
+    # Peak memory of one call, traced separately since tracing slows every allocation down
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        fn(*cases[0])
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    timings = np.array(timings) * 1000
+    return {
+        "iterations": iterations,
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p95_ms": float(np.percentile(timings, 95)),
+        "mean_ms": float(timings.mean()),
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def sample_customer_ids(db, n, seed=0):
+    from models import Customer
+    customer_ids = [customer_id for (customer_id,) in db.session.query(Customer.customer_id).order_by(Customer.customer_id)]
+    rng = random.Random(seed)
+    return rng.sample(customer_ids, min(n, len(customer_ids)))
+
+
+def run_benchmarks(db, iterations=DEFAULT_ITERATIONS, seed=0):
+    import service
+    from repository import get_most_recent_6_months_instalment_payments
+    from service import (
+        get_payment_history_and_credit_utilisation_ratio, preprocess, predict,
+        extract_payment_history_and_credit_utilisation_ratio_from_report,
+        extract_payment_history_and_credit_utilisation_ratio_from_cci,
+    )
+    from feature_cache import feature_cache
+
+    customer_ids = [(customer_id,) for customer_id in sample_customer_ids(db, iterations, seed)]
+    histories = [get_payment_history_and_credit_utilisation_ratio(db, customer_id) for (customer_id,) in customer_ids]
+    features = [(preprocess(credit_utilisation_ratio, payment_history),) for payment_history, credit_utilisation_ratio in histories]
+    preprocess_cases = [(credit_utilisation_ratio, payment_history) for payment_history, credit_utilisation_ratio in histories]
+
+    results = {}
+    results["get_most_recent_6_months_instalment_payments"] = measure(
+        lambda customer_id: get_most_recent_6_months_instalment_payments(db, customer_id), customer_ids, iterations)
+    # With the statuses read from the table, then computed from the instalments
+    materialised = service.USE_MATERIALISED_PAYMENT_STATUS
+    try:
+        service.USE_MATERIALISED_PAYMENT_STATUS = True
+        results["get_payment_history_and_credit_utilisation_ratio"] = measure(
+            lambda customer_id: get_payment_history_and_credit_utilisation_ratio(db, customer_id), customer_ids, iterations)
+        service.USE_MATERIALISED_PAYMENT_STATUS = False
+        results["get_payment_history_and_credit_utilisation_ratio_computed"] = measure(
+            lambda customer_id: get_payment_history_and_credit_utilisation_ratio(db, customer_id), customer_ids, iterations)
+    finally:
+        service.USE_MATERIALISED_PAYMENT_STATUS = materialised
+    # Features computed from scratch, then served from the feature cache
+    results["preprocess"] = measure(preprocess, preprocess_cases, iterations, setup=feature_cache.clear)
+    results["preprocess_cached"] = measure(preprocess, preprocess_cases, iterations)
+    results["predict"] = measure(predict, features, iterations)
+    results["extract_payment_history_and_credit_utilisation_ratio_from_report"] = measure(
+        extract_payment_history_and_credit_utilisation_ratio_from_report, [(REPORT_PATH,)], iterations)
+    results["extract_payment_history_and_credit_utilisation_ratio_from_cci"] = measure(
+        extract_payment_history_and_credit_utilisation_ratio_from_cci, [(CCI_PATH,)], iterations)
+    return results
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    # Benchmarks whose p50 grew by more than threshold (0.2 is 20%) since the baseline run
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None or before["p50_ms"] == 0:
+            continue
+        change = result["p50_ms"] / before["p50_ms"] - 1
+        if change > threshold:
+            regressions.append({"benchmark": name, "baseline_p50_ms": before["p50_ms"], "p50_ms": result["p50_ms"], "change": change})
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def benchmark(db, scale="1k", iterations=DEFAULT_ITERATIONS, seed=0):
+    from models import Customer, InstalmentPayment
+    n_instalments = SCALES[scale]
+    db.create_all()
+    build_seconds = None
+    if db.session.query(func.count(InstalmentPayment.instalment_payment_id)).scalar() == 0:
+        start = time.perf_counter()
+        build_database(db, n_instalments, seed)
+        build_seconds = time.perf_counter() - start
+        logger.info("Built a database of %d instalments in %.1fs", n_instalments, build_seconds)
+    else:
+        logger.info("Reusing the existing database")
+
+    return {
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "database": db.engine.dialect.name,
+        "scale": scale,
+        "customers": db.session.query(func.count(Customer.customer_id)).scalar(),
+        "instalments": db.session.query(func.count(InstalmentPayment.instalment_payment_id)).scalar(),
+        "build_seconds": build_seconds,
+        "results": run_benchmarks(db, iterations, seed),
+        # Process-wide high-water mark, including memory outside Python's allocator (fitz, LightGBM)
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the scoring hot paths on a synthetic database")
+    parser.add_argument("--scale", choices=list(SCALES), default="1k", help="number of instalments to generate")
+    parser.add_argument("--database-uri", help="database to fill (or reuse), a temporary SQLite file by default")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="p50 slowdown counted as a regression")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    temporary_path = None
+    database_uri = args.database_uri
+    if database_uri is None:
+        fd, temporary_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        database_uri = f"sqlite:///{temporary_path}"
+    os.environ["SQLALCHEMY_DATABASE_URI"] = database_uri
+
+    from main import create_app
+    from models import db
+    app = create_app()
+    try:
+        with app.app_context():
+            result = benchmark(db, args.scale, args.iterations, args.seed)
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        if temporary_path:
+            os.remove(temporary_path)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), result, args.threshold)
+        for regression in regressions:
+            logger.warning("%s: p50 %.3fms -> %.3fms (%+.0f%%)", regression["benchmark"], regression["baseline_p50_ms"], regression["p50_ms"], regression["change"] * 100)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from metrics import stage, PDF_PARSING
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CCI_CACHE_DIR = os.getenv("CCI_CACHE_DIR", os.path.join(BASE_DIR, "cci_cache"))
+CCI_FILENAME_MARKER = "CONSUMER-CREDIT-INDEX"
+LATEST_FILENAME = "latest.json"
+
+# Bump when the artifact layout changes so artifacts written by older code are parsed again
+ARTIFACT_FORMAT = 1
+
+
+@stage(PDF_PARSING)
+def parse_cci_delinquency(file):
+    # Reads the "Unsecured Credit Card by Age Groups" delinquency table: the last 6 months, each
+    # a month label followed by the delinquency rate (%) of 7 age groups
+    COLS = 8
+    ROWS = 6
+    start_section = ["Unsecured Credit Card by Age Groups", "Delinquency"]
+    months = []
+    delinquency_rates = []
+
+    import fitz
+    if isinstance(file, (bytes, bytearray)):
+        pdf_document = fitz.open(stream=file, filetype="pdf")
+    else:
+        pdf_document = fitz.open(file, filetype="pdf")
+    try:
+        for page_num in range(pdf_document.page_count):
+            text = pdf_document[page_num].get_text()
+            if all(substring in text for substring in start_section):
+                lines = text.strip().split('\n')
+                recent_6_months = lines[-COLS*(ROWS+1):-COLS]
+
+                months = []
+                delinquency_rates = []
+                for i in range(0, len(recent_6_months), COLS):  # 8 elements per month (1 month + 7 delinquency rates)
+                    months.append(recent_6_months[i].strip())
+                    delinquency_rates.append([float(x.strip().strip('%')) for x in recent_6_months[i+1:i+COLS]])
+    finally:
+        pdf_document.close()
+
+    if len(months) == 0:
+        raise Exception("No delinquency table found in Consumer Credit Index")
+    return {
+        "months": months,
+        "delinquency_rates": delinquency_rates,
+        # Average delinquency (%) across age groups for each month
+        "average_delinquency": [sum(rates) / len(rates) for rates in delinquency_rates],
+    }
+
+
+class CCIStore:
+    """Parsed Consumer Credit Index artifacts, one JSON file per uploaded PDF keyed by its
+    SHA-256, plus latest.json naming the one scoring uses (the most recent upload).
+
+    The latest artifact is kept in memory and only re-read when latest.json changes, so the
+    scoring routes never open a PDF."""
+
+    def __init__(self, directory=CCI_CACHE_DIR, pdf_dir=BASE_DIR):
+        self.directory = directory
+        self.pdf_dir = pdf_dir
+        self._lock = threading.Lock()
+        self._latest = None
+        self._latest_mtime = None
+        self._bootstrapped = False
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _write_json(self, filename, data):
+        # Written to a temporary file first so readers never see a half-written artifact
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._path(f".{filename}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self._path(filename))
+
+    def add(self, content, filename):
+        sha256 = hashlib.sha256(content).hexdigest()
+        artifact_filename = f"{sha256}.json"
+        artifact = self._read(artifact_filename)
+        if artifact is None or artifact.get("format") != ARTIFACT_FORMAT:
+            artifact = {
+                "format": ARTIFACT_FORMAT,
+                "version": sha256[:12],
+                "sha256": sha256,
+                "filename": filename,
+                "parsed_at": datetime.now().isoformat(),
+                **parse_cci_delinquency(content),
+            }
+            self._write_json(artifact_filename, artifact)
+
+        with self._lock:
+            self._write_json(LATEST_FILENAME, {
+                "sha256": sha256,
+                "filename": filename,
+                "uploaded_at": datetime.now().isoformat(),
+            })
+            self._latest = artifact
+            self._latest_mtime = os.stat(self._path(LATEST_FILENAME)).st_mtime_ns
+        logger.info("Consumer Credit Index %s (%s) is now the latest", filename, artifact["version"])
+        return artifact
+
+    def _read(self, filename):
+        try:
+            with open(self._path(filename)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def latest(self):
+        try:
+            mtime = os.stat(self._path(LATEST_FILENAME)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._latest is not None and mtime == self._latest_mtime:
+            return self._latest
+
+        if mtime is None:
+            return self._bootstrap()
+
+        with self._lock:
+            # Another worker process may have uploaded a newer index
+            pointer = self._read(LATEST_FILENAME)
+            artifact = self._read(f"{pointer['sha256']}.json")
+            if artifact is None:
+                raise Exception(f"Consumer Credit Index artifact {pointer['sha256']} is missing")
+            self._latest = artifact
+            self._latest_mtime = mtime
+            return artifact
+
+    def _bootstrap(self):
+        # Nothing has been uploaded since the cache was created: parse a CCI PDF already sitting
+        # next to the service (as before /upload-cci parsed them) once, instead of per request. A
+        # PDF that fails to parse or save is tried again by the next request.
+        if self._bootstrapped:
+            return None
+        for filename in sorted(os.listdir(self.pdf_dir), reverse=True):
+            if CCI_FILENAME_MARKER in filename:
+                with open(os.path.join(self.pdf_dir, filename), "rb") as f:
+                    artifact = self.add(f.read(), filename)
+                self._bootstrapped = True
+                return artifact
+        self._bootstrapped = True
+        return None
+
+    def invalidate(self):
+        with self._lock:
+            self._latest = None
+            self._latest_mtime = None
+            self._bootstrapped = False
+
+
+cci_store = CCIStore()
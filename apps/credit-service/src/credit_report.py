@@ -0,0 +1,101 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from metrics import stage, PDF_PARSING
+
+# Credit bureau report sections: the unsecured credit card status history (with the balance) and
+# the unsecured credit limit. Each is found on the first page that has its start markers.
+HISTORY_SECTION = ["Unsecured Credit Card", "Account Status History"]
+HISTORY_SECTION_END = "HDB Loan"
+CREDIT_LIMIT_SECTION = "Unsecured Credit Limit"
+CREDIT_LIMIT_SECTION_END = "Applicant Type"
+
+# A run of exactly 12 account status codes (12 months, most recent first)
+STATUS_SEQUENCE_PATTERN = re.compile(r"(?<![ABCD*GHRSW])[ABCD*GHRSW]{12}(?![ABCD*GHRSW])")
+BALANCE_PATTERN = re.compile(r"\d+\.\d+")
+
+# Used when the report has no credit limit section, as before
+DEFAULT_CREDIT_LIMIT = 10
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+
+def spool_to_file(file, directory=None):
+    # Copies an upload to a temporary file in chunks so the PDF is never held in memory as a whole.
+    # The caller removes the file.
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(file, f, SPOOL_CHUNK_SIZE)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def upload_sha256(file):
+    # Content hash of an upload, read in chunks; the file is rewound for whoever reads it next
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(SPOOL_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def parse_history_section(text):
+    section_start = text.find(HISTORY_SECTION[0])
+    section_end = text.find(HISTORY_SECTION_END, section_start)
+    relevant_text = text[section_start:section_end].strip()
+
+    status_sequences = STATUS_SEQUENCE_PATTERN.findall(relevant_text)
+    # The last 12 month sequence in the section is the credit card's, its first 6 months are used
+    status_history = list(status_sequences[-1][:6]) if status_sequences else None
+
+    balance_match = BALANCE_PATTERN.search(relevant_text)
+    if not balance_match:
+        raise Exception("No balance found in PDF")
+    return status_history, int(float(balance_match.group()))
+
+
+def parse_credit_limit_section(text):
+    section_start = text.find(CREDIT_LIMIT_SECTION)
+    section_end = text.find(CREDIT_LIMIT_SECTION_END, section_start)
+    return int(text[section_start+len(CREDIT_LIMIT_SECTION):section_end].strip().replace(",", ""))
+
+
+@stage(PDF_PARSING)
+def parse_credit_report(path):
+    # Returns the 6 most recent account status codes, the balance and the credit limit. Pages are
+    # read one at a time and reading stops once both sections have been found.
+    import fitz
+    status_history, balance, credit_limit = None, 0, None
+    found_history = False
+    pdf_document = fitz.open(path, filetype="pdf")
+    try:
+        for page in pdf_document:
+            text = page.get_text()
+            if not found_history and all(marker in text for marker in HISTORY_SECTION):
+                status_history, balance = parse_history_section(text)
+                found_history = True
+            if credit_limit is None and CREDIT_LIMIT_SECTION in text:
+                credit_limit = parse_credit_limit_section(text)
+            if found_history and credit_limit is not None:
+                break
+    finally:
+        pdf_document.close()
+
+    if status_history is None:
+        raise Exception("No account status history found in credit report")
+    return status_history, balance, credit_limit if credit_limit is not None else DEFAULT_CREDIT_LIMIT
+
+
+def read_credit_report(file):
+    # file is a path or an upload (any binary file object), uploads are spooled to disk first
+    if isinstance(file, (str, os.PathLike)):
+        return parse_credit_report(file)
+    path = spool_to_file(file)
+    try:
+        return parse_credit_report(path)
+    finally:
+        os.remove(path)
@@ -0,0 +1,163 @@
+import logging
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from models import db, CreditTier
+
+logger = logging.getLogger(__name__)
+
+# How long (in seconds) the tiers are served from memory before being read from the database again
+DEFAULT_TTL = float(os.getenv("CREDIT_TIER_CACHE_TTL", "300"))
+
+# Plain copy of a CreditTier row, safe to share between requests and app contexts
+CreditTierRecord = namedtuple("CreditTierRecord", ["credit_tier_id", "name", "min_credit_score", "max_credit_score", "credit_limit"])
+
+
+class CreditTierIndex:
+    """Credit tiers sorted into disjoint score intervals, looked up by bisection.
+
+    Tiers are closed intervals [min_credit_score, max_credit_score]. Their end points cut the
+    score axis into segments (each end point, and the open ranges between them) and every
+    segment records which tiers cover it, so overlaps and gaps are found once when the index is
+    built and a lookup is a single bisect."""
+
+    def __init__(self, credit_tiers):
+        self.credit_tiers = list(credit_tiers)
+        self.points = sorted({tier.min_credit_score for tier in self.credit_tiers} | {tier.max_credit_score for tier in self.credit_tiers})
+
+        # at_point[i] covers the score points[i], between[i] the open range (points[i-1], points[i])
+        self.at_point = [self._covering(point, point) for point in self.points]
+        bounds = [float("-inf")] + self.points + [float("inf")]
+        self.between = [self._covering(low, high, open_range=True) for low, high in zip(bounds, bounds[1:])]
+
+        self.lowest = None
+        for credit_tier in self.credit_tiers:
+            if self.lowest is None or credit_tier.credit_limit < self.lowest.credit_limit:
+                self.lowest = credit_tier
+
+        self.overlaps = [segment for segment in self._segments() if len(segment[2]) > 1]
+        # Credit scores are integers, so an open range only counts as a gap if an integer falls in it
+        self.gaps = [segment for segment in self._segments()[1:-1] if len(segment[2]) == 0 and math.floor(segment[0]) + 1 < segment[1]]
+
+    def _covering(self, low, high, open_range=False):
+        if open_range:
+            return [tier for tier in self.credit_tiers if tier.min_credit_score <= low and tier.max_credit_score >= high]
+        return [tier for tier in self.credit_tiers if tier.min_credit_score <= low <= tier.max_credit_score]
+
+    def _segments(self):
+        # (low, high, tiers) in score order, open ranges and end points interleaved
+        bounds = [float("-inf")] + self.points + [float("inf")]
+        segments = []
+        for i, tiers in enumerate(self.between):
+            segments.append((bounds[i], bounds[i + 1], tiers))
+            if i < len(self.points):
+                segments.append((self.points[i], self.points[i], self.at_point[i]))
+        return segments
+
+    def find(self, credit_score):
+        # A NULL score matched no tier in the database query either
+        if credit_score is None:
+            raise Exception("Customer credit score does not belong to any credit tier in database")
+        i = bisect_left(self.points, credit_score)
+        if i < len(self.points) and self.points[i] == credit_score:
+            tiers = self.at_point[i]
+        else:
+            tiers = self.between[i]
+        if len(tiers) > 1:
+            raise Exception("More than 1 credit tier exists in database")
+        if len(tiers) == 0:
+            raise Exception("Customer credit score does not belong to any credit tier in database")
+        return tiers[0]
+
+    def credit_limit(self, credit_score):
+        return self.find(credit_score).credit_limit
+
+    def lowest_credit_tier(self):
+        if self.lowest is None:
+            raise Exception("No credit tier exists in database")
+        return self.lowest
+
+
+def load_credit_tiers():
+    return [
+        CreditTierRecord(*row) for row in db.session.query(
+            CreditTier.credit_tier_id,
+            CreditTier.name,
+            CreditTier.min_credit_score,
+            CreditTier.max_credit_score,
+            CreditTier.credit_limit,
+        ).all()
+    ]
+
+
+class CreditTierCache:
+    """Process-wide CreditTierIndex, rebuilt from the database once its TTL has passed or
+    after invalidate() is called."""
+
+    def __init__(self, ttl=DEFAULT_TTL, loader=load_credit_tiers):
+        self.ttl = ttl
+        self.loader = loader
+        # Called on invalidate(), e.g. to pass it on to the other server processes (see server.py)
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._index = None
+        self._loaded_at = 0
+
+    def get(self):
+        index = self._index
+        if index is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return index
+
+        with self._lock:
+            # Another thread may have refreshed the index while we were waiting for the lock
+            if self._index is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._index
+            index = CreditTierIndex(self.loader())
+            for low, high, tiers in index.overlaps:
+                logger.warning("Credit tiers %s overlap on scores %s to %s", [tier.name for tier in tiers], low, high)
+            for low, high, _ in index.gaps:
+                logger.warning("No credit tier covers scores between %s and %s", low, high)
+            self._index = index
+            self._loaded_at = time.monotonic()
+            return index
+
+    def invalidate(self, notify=True):
+        with self._lock:
+            self._index = None
+        if notify:
+            for listener in self.listeners:
+                listener()
+
+
+credit_tier_cache = CreditTierCache()
+
+# Session.info key set when a flush changed a credit tier
+TIERS_CHANGED = "credit_tiers_changed"
+
+
+@event.listens_for(CreditTier, "after_insert")
+@event.listens_for(CreditTier, "after_update")
+@event.listens_for(CreditTier, "after_delete")
+def invalidate_on_change(mapper, connection, target):
+    # Tier edits made through this service are picked up straight away, edits made elsewhere
+    # (e.g. the admin portal) are picked up on the TTL or through /invalidate-credit-tiers.
+    # The cache is cleared once the edit is committed: clearing it at flush time would let a
+    # concurrent request reload the old tiers before the commit, and a rolled back edit would
+    # clear it for nothing.
+    object_session(target).info[TIERS_CHANGED] = True
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_after_commit(session):
+    if session.info.pop(TIERS_CHANGED, False):
+        credit_tier_cache.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_rolled_back_changes(session):
+    session.info.pop(TIERS_CHANGED, None)
@@ -0,0 +1,104 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Number of distinct payment histories whose features are kept, 0 turns the cache off
+DEFAULT_MAXSIZE = int(os.getenv("FEATURE_CACHE_SIZE", "4096"))
+
+
+def history_key(payment_history):
+    return tuple(np.asarray(payment_history, dtype=float).tolist())
+
+
+class FeatureCache:
+    """LRU cache of the payment-history features (every model input except the credit
+    utilisation ratio), keyed by the status tuple.
+
+    Statuses come from a small alphabet and most customers share a handful of histories
+    (all -1 being by far the most common), so most scores skip feature extraction entirely."""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._features = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, payment_histories, compute):
+        # Features of every history as one matrix. compute(histories) is called once with all
+        # the distinct histories that are not cached and returns their features row by row.
+        keys = [history_key(payment_history) for payment_history in payment_histories]
+        rows = {}
+        with self._lock:
+            for key in keys:
+                if key in rows:
+                    continue
+                features = self._features.get(key)
+                if features is not None:
+                    self._features.move_to_end(key)
+                    self.hits += 1
+                    rows[key] = features
+            missing = [key for key in dict.fromkeys(keys) if key not in rows]
+            self.misses += len(missing)
+
+        if missing:
+            computed = compute([list(key) for key in missing])
+            with self._lock:
+                for key, features in zip(missing, computed):
+                    features = np.array(features)
+                    features.flags.writeable = False
+                    rows[key] = features
+                    self._store(key, features)
+
+        return np.stack([rows[key] for key in keys])
+
+    def _store(self, key, features):
+        if self.maxsize <= 0:
+            return
+        self._features[key] = features
+        self._features.move_to_end(key)
+        while len(self._features) > self.maxsize:
+            self._features.popitem(last=False)
+            self.evictions += 1
+
+    def prewarm(self, payment_histories, compute):
+        # Fills the cache without counting the lookups as misses
+        with self._lock:
+            keys = [key for key in dict.fromkeys(history_key(payment_history) for payment_history in payment_histories) if key not in self._features]
+        if not keys:
+            return 0
+        computed = compute([list(key) for key in keys])
+        with self._lock:
+            for key, features in zip(keys, computed):
+                # A request may have cached it meanwhile
+                if key in self._features:
+                    continue
+                features = np.array(features)
+                features.flags.writeable = False
+                self._store(key, features)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._features.clear()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._features),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+feature_cache = FeatureCache()
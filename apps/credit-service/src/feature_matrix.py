@@ -0,0 +1,964 @@
+import math
+from functools import cached_property, lru_cache
+import numpy as np
+from features import get_feature_spec, parse_feature_name
+
+# NumPy re-implementations of the tsfresh calculators in relevant_features.csv. Each one takes
+# every customer's repayment history at once (an N x T matrix) and returns one value per row,
+# so rescoring thousands of customers never goes through tsfresh's per-series DataFrames.
+# Values follow tsfresh/scipy/statsmodels/pandas to within floating point error.
+
+_CALCULATORS = {}
+
+
+def _calculator(func):
+    _CALCULATORS[func.__name__] = func
+    return func
+
+
+class _Batch:
+    """Statistics of the N x T status matrix shared by several calculators, computed on first use."""
+
+    def __init__(self, X):
+        self.X = X
+        self.n_rows, self.length = X.shape
+
+    @cached_property
+    def mean(self):
+        return np.mean(self.X, axis=1)
+
+    @cached_property
+    def var(self):
+        return np.var(self.X, axis=1)
+
+    @cached_property
+    def std(self):
+        return np.std(self.X, axis=1)
+
+    @cached_property
+    def max(self):
+        return np.max(self.X, axis=1)
+
+    @cached_property
+    def min(self):
+        return np.min(self.X, axis=1)
+
+    @cached_property
+    def median(self):
+        return np.median(self.X, axis=1)
+
+    @cached_property
+    def diff(self):
+        return np.diff(self.X, axis=1)
+
+    @cached_property
+    def equal(self):
+        # equal[r, i, j]: X[r, i] == X[r, j]
+        return self.X[:, :, None] == self.X[:, None, :]
+
+    @cached_property
+    def occurrences(self):
+        # How many times each element's value appears in its row
+        return self.equal.sum(axis=2)
+
+    @cached_property
+    def first_occurrence(self):
+        earlier = np.tril(np.ones((self.length, self.length), dtype=bool), k=-1)
+        return ~(self.equal & earlier).any(axis=2)
+
+    @cached_property
+    def fft(self):
+        return np.fft.rfft(self.X, axis=1)
+
+    @cached_property
+    def welch(self):
+        return _welch(self.X)
+
+    @cached_property
+    def linear_trend(self):
+        return _linregress(np.arange(self.length), self.X)
+
+    @cached_property
+    def adf(self):
+        return _adfuller(self.X)
+
+    def cwt(self, width):
+        key = ("cwt", width)
+        if key not in self.__dict__:
+            self.__dict__[key] = _cwt(self.X, width)
+        return self.__dict__[key]
+
+
+def _where_rows(condition, values, default):
+    return np.where(condition, values, default).astype(float)
+
+
+def _normal_cdf(x):
+    # Hart's double precision approximation (as given by West, 2005), since NumPy has no erf
+    a = np.abs(x)
+    exponential = np.exp(-a * a / 2)
+    numerator = 3.52624965998911e-02 * a + 0.700383064443688
+    for c in (6.37396220353165, 33.912866078383, 112.079291497871, 221.213596169931, 220.206867912376):
+        numerator = numerator * a + c
+    denominator = 8.83883476483184e-02 * a + 1.75566716318264
+    for c in (16.064177579207, 86.7807322029461, 296.564248779674, 637.333633378831, 793.826512519948, 440.413735824752):
+        denominator = denominator * a + c
+    fraction = a + 0.65
+    for k in (4, 3, 2, 1):
+        fraction = a + k / fraction
+    tail = np.where(a < 7.07106781186547, exponential * numerator / denominator, exponential / fraction / math.sqrt(2 * math.pi))
+    tail = np.where(a > 37, 0.0, tail)
+    return np.where(x > 0, 1 - tail, tail)
+
+
+def _t_two_sided_pvalue(t, df):
+    # Abramowitz & Stegun 26.7.3/26.7.4, exact for an integer number of degrees of freedom
+    theta = np.arctan(np.abs(t) / np.sqrt(df))
+    sin, cos2 = np.sin(theta), np.cos(theta) ** 2
+    if df % 2 == 0:
+        term = np.ones_like(theta)
+        total = np.ones_like(theta)
+        for k in range(1, df // 2):
+            term = term * cos2 * (2 * k - 1) / (2 * k)
+            total = total + term
+        inside = sin * total
+    else:
+        total = np.zeros_like(theta)
+        if df > 1:
+            term = np.ones_like(theta)
+            total = np.ones_like(theta)
+            for k in range(1, (df - 1) // 2):
+                term = term * cos2 * (2 * k) / (2 * k + 1)
+                total = total + term
+        inside = 2 / np.pi * (theta + sin * np.sqrt(cos2) * total)
+    return 1 - inside
+
+
+def _linregress(x, Y):
+    # scipy.stats.linregress(x, y) for every row y of Y against the same x
+    n = len(x)
+    xmean = np.mean(x)
+    ymean = np.mean(Y, axis=1)
+    xm = x - xmean
+    ym = Y - ymean[:, None]
+    ssxm = np.dot(xm, xm) / n
+    ssxym = ym @ xm / n
+    ssym = np.sum(ym * ym, axis=1) / n
+
+    if ssxm == 0:
+        r = np.zeros(len(Y))
+    else:
+        r = np.where(ssym == 0, 0.0, np.clip(ssxym / np.sqrt(ssxm * ssym), -1.0, 1.0))
+    slope = ssxym / ssxm
+    intercept = ymean - slope * xmean
+
+    if n == 2:
+        pvalue = np.where(Y[:, 0] == Y[:, 1], 1.0, 0.0)
+        stderr = np.zeros(len(Y))
+    else:
+        df = n - 2
+        TINY = 1.0e-20
+        t = r * np.sqrt(df / ((1.0 - r + TINY) * (1.0 + r + TINY)))
+        pvalue = _t_two_sided_pvalue(t, df)
+        stderr = np.sqrt((1 - r ** 2) * ssym / ssxm / df)
+    return {"slope": slope, "intercept": intercept, "rvalue": r, "pvalue": pvalue, "stderr": stderr}
+
+
+def _linspace(start, stop, num):
+    # np.linspace(start[i], stop[i], num) for every row
+    step = (stop - start) / (num - 1)
+    edges = np.arange(num) * step[:, None] + start[:, None]
+    edges[:, -1] = stop
+    return edges
+
+
+def _histogram(V, bins):
+    # np.histogram(v, bins)[0] for every row v of V
+    first, last = V.min(axis=1), V.max(axis=1)
+    same = first == last
+    first = np.where(same, first - 0.5, first)
+    last = np.where(same, last + 0.5, last)
+    edges = _linspace(first, last, bins + 1)
+
+    indices = ((V - first[:, None]) / (last - first)[:, None] * bins).astype(np.intp)
+    indices[indices == bins] -= 1
+    rows = np.arange(len(V))[:, None]
+    indices[V < edges[rows, indices]] -= 1
+    indices[(V >= edges[rows, indices + 1]) & (indices != bins - 1)] += 1
+    return (indices[:, :, None] == np.arange(bins)).sum(axis=1)
+
+
+def _binned_entropy(V, bins):
+    probs = _histogram(V, bins) / V.shape[1]
+    logs = np.log(np.where(probs == 0, 1.0, probs))
+    return -np.sum(probs * logs, axis=1)
+
+
+def _welch(X):
+    # scipy.signal.welch(x, nperseg=len(x)): a single Hann-windowed, mean-detrended segment
+    n = X.shape[1]
+    if n > 256:
+        raise Exception("Welch density is only implemented for series of at most 256 points")
+    fac = np.linspace(-np.pi, np.pi, n + 1)
+    window = (0.5 * np.cos(0 * fac) + 0.5 * np.cos(fac))[:-1]
+    scale = 1.0 / np.sum(window * window)
+    spectrum = np.fft.rfft(window * (X - np.mean(X, axis=1, keepdims=True)), n=n, axis=1)
+    pxx = (np.conjugate(spectrum) * spectrum * scale).real
+    if n % 2:
+        pxx[:, 1:] *= 2
+    else:
+        pxx[:, 1:-1] *= 2
+    return pxx
+
+
+def _ricker(points, a):
+    A = 2 / (np.sqrt(3 * a) * (np.pi ** 0.25))
+    wsq = a ** 2
+    vec = np.arange(0, points) - (points - 1.0) / 2
+    xsq = vec ** 2
+    mod = (1 - xsq / wsq)
+    gauss = np.exp(-xsq / (2 * wsq))
+    return A * mod * gauss
+
+
+def _cwt(X, width):
+    # One row of scipy.signal.cwt(x, ricker, widths): np.convolve(x, wavelet, mode="same")
+    n = X.shape[1]
+    kernel = _ricker(min(10 * width, n), width)[::-1]
+    k = len(kernel)
+    full = np.zeros((len(X), n + k - 1))
+    for j in range(k):
+        full[:, j:j + n] += X * kernel[j]
+    start = (k - 1) // 2
+    return full[:, start:start + n]
+
+
+def _ols(y, exog):
+    # statsmodels OLS(y, exog).fit() for a stack of regressions, exog is N x nobs x k
+    pinv = np.linalg.pinv(exog, rcond=1e-15)
+    params = (pinv @ y[:, :, None])[:, :, 0]
+    resid = y - (exog @ params[:, :, None])[:, :, 0]
+    ssr = np.sum(resid ** 2, axis=1)
+
+    singular_values = np.linalg.svd(exog, compute_uv=False)
+    tol = singular_values.max(axis=1) * singular_values.shape[1] * np.finfo(float).eps
+    rank = (singular_values > tol[:, None]).sum(axis=1)
+
+    nobs = y.shape[1]
+    llf = -nobs / 2 * np.log(2 * np.pi) - nobs / 2 * np.log(ssr / nobs) - nobs / 2
+    aic = -2 * llf + 2 * rank
+
+    scale = ssr / (nobs - rank)
+    normalized_cov = np.einsum("nij,nij->ni", pinv, pinv)
+    tvalues = params / np.sqrt(normalized_cov * scale[:, None])
+    return tvalues, aic
+
+
+def _adf_design(X, xdiff, lags, maxlag, has_const, prepend):
+    # Rows of statsmodels' lagmat(xdiff, maxlag, trim="both", original="in") with the first
+    # column replaced by the level of x, keeping the first `lags` lagged differences
+    n = X.shape[1]
+    nobs = n - 1 - maxlag
+    columns = [X[:, maxlag:n - 1]]
+    for lag in range(1, lags + 1):
+        columns.append(xdiff[:, maxlag - lag:n - 1 - lag])
+    const = np.broadcast_to(has_const[:, None], (len(X), nobs)).astype(float)
+    columns = [const] + columns if prepend else columns + [const]
+    return np.stack(columns, axis=2), xdiff[:, maxlag:]
+
+
+def _has_nonzero_constant_column(design):
+    # add_trend(..., has_constant="skip") does not add a constant if one is already there
+    return ((np.ptp(design, axis=1) == 0) & (design[:, 0, :] != 0)).any(axis=1)
+
+
+def _adfuller(X):
+    # statsmodels adfuller(x, autolag="AIC") with regression="c"
+    n_rows, n = X.shape
+    nan = np.full(n_rows, np.nan)
+    maxlag = int(np.ceil(12.0 * np.power(n / 100.0, 1 / 4.0)))
+    maxlag = min(n // 2 - 2, maxlag)
+    if maxlag < 0:
+        return {"teststat": nan, "pvalue": nan, "usedlag": nan}
+
+    xdiff = np.diff(X, axis=1)
+    constant = X.max(axis=1) == X.min(axis=1)
+
+    # Pick the number of lags by AIC, every candidate fitted on the same observations
+    full_design, _ = _adf_design(X, xdiff, maxlag, maxlag, np.zeros(n_rows, dtype=bool), True)
+    has_const = ~_has_nonzero_constant_column(full_design[:, :, 1:])
+    aics = []
+    for lags in range(maxlag + 1):
+        design, y = _adf_design(X, xdiff, lags, maxlag, has_const, True)
+        aics.append(_ols(y, design)[1])
+    usedlag = np.argmin(np.stack(aics, axis=1), axis=1)
+
+    # Rerun the regression with the chosen number of lags on as many observations as possible
+    teststat = np.full(n_rows, np.nan)
+    for lags in range(maxlag + 1):
+        rows = usedlag == lags
+        if not rows.any():
+            continue
+        design, y = _adf_design(X[rows], xdiff[rows], lags, lags, np.ones(rows.sum(), dtype=bool), False)
+        design[:, :, -1] *= ~_has_nonzero_constant_column(design[:, :, :-1])[:, None]
+        teststat[rows] = _ols(y, design)[0][:, 0]
+
+    teststat[constant] = np.nan
+    usedlag = np.where(constant, np.nan, usedlag)
+    return {"teststat": teststat, "pvalue": _mackinnonp(teststat), "usedlag": usedlag}
+
+
+def _mackinnonp(teststat):
+    # statsmodels mackinnonp(teststat, regression="c", N=1)
+    small_p = np.polyval([0.038269, 1.4412, 2.1659], teststat)
+    large_p = np.polyval([-0.010368, -0.12745, 0.93202, 1.7339], teststat)
+    pvalue = _normal_cdf(np.where(teststat <= -1.61, small_p, large_p))
+    pvalue = np.where(teststat > 2.74, 1.0, pvalue)
+    pvalue = np.where(teststat < -18.83, 0.0, pvalue)
+    return np.where(np.isnan(teststat), np.nan, pvalue)
+
+
+def _subchunks(X, length, every_n=1):
+    n = X.shape[1]
+    num_shifts = (n - length) // every_n + 1
+    if num_shifts <= 0:
+        return X[:, :0, None][:, :, :0]
+    indexer = np.arange(length)[None, :] + every_n * np.arange(num_shifts)[:, None]
+    return X[:, indexer]
+
+
+def _count_similar(windows, tolerance):
+    # For every window, how many windows (itself included) are within `tolerance` in max norm
+    distance = np.max(np.abs(windows[:, :, None, :] - windows[:, None, :, :]), axis=3)
+    return (distance <= tolerance[:, None, None]).sum(axis=2)
+
+
+def _longest_run(mask):
+    run = np.zeros(len(mask), dtype=int)
+    longest = np.zeros(len(mask), dtype=int)
+    for t in range(mask.shape[1]):
+        run = (run + 1) * mask[:, t]
+        longest = np.maximum(longest, run)
+    return longest
+
+
+@_calculator
+def abs_energy(b):
+    return np.sum(b.X * b.X, axis=1)
+
+
+@_calculator
+def absolute_maximum(b):
+    return np.max(np.abs(b.X), axis=1)
+
+
+@_calculator
+def absolute_sum_of_changes(b):
+    return np.sum(np.abs(b.diff), axis=1)
+
+
+@_calculator
+def agg_autocorrelation(b, f_agg, maxlag):
+    xo = b.X - b.mean[:, None]
+    n = b.length
+    acov = np.stack([np.sum(xo[:, lag:] * xo[:, :n - lag], axis=1) / (n - lag) for lag in range(n)], axis=1)
+    acf = (acov / acov[:, :1])[:, 1:maxlag + 1]
+    acf[(np.abs(b.var) < 10 ** -10) | (n == 1)] = 0
+    return getattr(np, f_agg)(acf, axis=1)
+
+
+@_calculator
+def agg_linear_trend(b, attr, chunk_len, f_agg):
+    if chunk_len >= b.length:
+        return np.full(b.n_rows, np.nan)
+    chunks = int(np.ceil(b.length / chunk_len))
+    aggregates = np.stack([getattr(np, f_agg)(b.X[:, i * chunk_len:(i + 1) * chunk_len], axis=1) for i in range(chunks)], axis=1)
+    return _linregress(np.arange(chunks), aggregates)[attr]
+
+
+@_calculator
+def approximate_entropy(b, m, r):
+    if b.length <= m + 1:
+        return np.zeros(b.n_rows)
+    tolerance = r * b.std
+
+    def phi(length):
+        windows = _subchunks(b.X, length) if length > 1 else b.X[:, :, None]
+        similar = _count_similar(windows, tolerance) / windows.shape[1]
+        return np.sum(np.log(similar), axis=1) / windows.shape[1]
+
+    return np.abs(phi(m) - phi(m + 1))
+
+
+@_calculator
+def augmented_dickey_fuller(b, attr, autolag="AIC"):
+    if autolag != "AIC":
+        raise Exception(f"augmented_dickey_fuller with autolag={autolag} is not supported")
+    return b.adf[attr]
+
+
+@_calculator
+def autocorrelation(b, lag):
+    n = b.length
+    if n < lag:
+        return np.full(b.n_rows, np.nan)
+    xo = b.X - b.mean[:, None]
+    sum_product = np.sum(xo[:, :n - lag] * xo[:, lag:], axis=1)
+    return _where_rows(np.isclose(b.var, 0), np.nan, sum_product / ((n - lag) * b.var))
+
+
+@_calculator
+def benford_correlation(b):
+    values = np.abs(np.nan_to_num(b.X))
+    exponent = np.floor(np.log10(np.where(values > 0, values, 1)))
+    # Round away representation error (0.3 / 0.1 = 2.9999...) before taking the leading digit
+    digits = np.floor(np.round(values / 10.0 ** exponent, 12)).astype(int)
+    digits = np.where(values > 0, np.minimum(digits, 9), 0)
+    benford = np.log10(1 + 1 / np.arange(1, 10))
+    observed = (digits[:, :, None] == np.arange(1, 10)).mean(axis=1)
+    benford_centered = benford - benford.mean()
+    observed_centered = observed - observed.mean(axis=1, keepdims=True)
+    covariance = observed_centered @ benford_centered
+    scale = np.sqrt(np.sum(observed_centered ** 2, axis=1) * np.sum(benford_centered ** 2))
+    return np.clip(covariance / scale, -1, 1)
+
+
+@_calculator
+def binned_entropy(b, max_bins):
+    return _binned_entropy(b.X, max_bins)
+
+
+@_calculator
+def c3(b, lag):
+    n = b.length
+    if 2 * lag >= n:
+        return np.zeros(b.n_rows)
+    X = b.X
+    return np.mean(X[:, 2 * lag:] * X[:, lag:n - lag] * X[:, :n - 2 * lag], axis=1)
+
+
+@_calculator
+def cid_ce(b, normalize):
+    X = b.X
+    if normalize:
+        std = np.where(b.std != 0, b.std, 1)
+        X = (X - b.mean[:, None]) / std[:, None]
+    diff = np.diff(X, axis=1)
+    result = np.sqrt(np.sum(diff * diff, axis=1))
+    if normalize:
+        result = np.where(b.std != 0, result, 0.0)
+    return result
+
+
+@_calculator
+def change_quantiles(b, ql, qh, isabs, f_agg):
+    if ql >= qh:
+        return np.zeros(b.n_rows)
+    low, high = np.quantile(b.X, [ql, qh], axis=1)
+    inside = (b.X >= low[:, None]) & (b.X <= high[:, None])
+    ind = inside[:, 1:] & inside[:, :-1]
+    count = ind.sum(axis=1)
+    div = np.abs(b.diff) if isabs else b.diff
+    safe_count = np.maximum(count, 1)
+    mean = np.sum(np.where(ind, div, 0), axis=1) / safe_count
+    if f_agg == "mean":
+        result = mean
+    elif f_agg == "var":
+        result = np.sum(np.where(ind, (div - mean[:, None]) ** 2, 0), axis=1) / safe_count
+    elif f_agg == "median":
+        result = np.nanmedian(np.where(ind, div, np.nan), axis=1)
+    elif f_agg == "std":
+        result = np.sqrt(np.sum(np.where(ind, (div - mean[:, None]) ** 2, 0), axis=1) / safe_count)
+    else:
+        raise Exception(f"change_quantiles with f_agg={f_agg} is not supported")
+    return np.where((low == high) | (count == 0), 0.0, result)
+
+
+@_calculator
+def count_above(b, t):
+    return np.sum(b.X >= t, axis=1) / b.length
+
+
+@_calculator
+def count_above_mean(b):
+    return np.sum(b.X > b.mean[:, None], axis=1)
+
+
+@_calculator
+def count_below(b, t):
+    return np.sum(b.X <= t, axis=1) / b.length
+
+
+@_calculator
+def count_below_mean(b):
+    return np.sum(b.X < b.mean[:, None], axis=1)
+
+
+@_calculator
+def cwt_coefficients(b, widths, coeff, w):
+    if coeff >= b.length:
+        return np.full(b.n_rows, np.nan)
+    return b.cwt(w)[:, coeff]
+
+
+@_calculator
+def energy_ratio_by_chunks(b, num_segments, segment_focus):
+    # Same boundaries as np.array_split(x, num_segments)
+    size, extra = divmod(b.length, num_segments)
+    start = segment_focus * size + min(segment_focus, extra)
+    end = start + size + (1 if segment_focus < extra else 0)
+    full_energy = np.sum(b.X ** 2, axis=1)
+    segment_energy = np.sum(b.X[:, start:end] ** 2.0, axis=1)
+    return _where_rows(full_energy == 0, np.nan, segment_energy / np.where(full_energy == 0, 1, full_energy))
+
+
+@_calculator
+def fft_aggregated(b, aggtype):
+    y = np.abs(b.fft)
+    index = np.arange(y.shape[1], dtype=float)
+    total = y.sum(axis=1)
+
+    def moment(m):
+        return y @ (index ** m) / total
+
+    centroid = moment(1)
+    variance = moment(2) - centroid ** 2
+    if aggtype == "centroid":
+        return centroid
+    if aggtype == "variance":
+        return variance
+    if aggtype == "skew":
+        skew = (moment(3) - 3 * centroid * variance - centroid ** 3) / variance ** 1.5
+        return _where_rows(variance < 0.5, np.nan, skew)
+    if aggtype == "kurtosis":
+        kurtosis = (moment(4) - 4 * centroid * moment(3) + 6 * moment(2) * centroid ** 2 - 3 * centroid) / variance ** 2
+        return _where_rows(variance < 0.5, np.nan, kurtosis)
+    raise Exception(f"fft_aggregated with aggtype={aggtype} is not supported")
+
+
+@_calculator
+def fft_coefficient(b, attr, coeff):
+    if coeff >= b.fft.shape[1]:
+        return np.full(b.n_rows, np.nan)
+    value = b.fft[:, coeff]
+    if attr == "real":
+        return value.real
+    if attr == "imag":
+        return value.imag
+    if attr == "abs":
+        return np.abs(value)
+    if attr == "angle":
+        return np.angle(value, deg=True)
+    raise Exception(f"fft_coefficient with attr={attr} is not supported")
+
+
+@_calculator
+def first_location_of_maximum(b):
+    return np.argmax(b.X, axis=1) / b.length
+
+
+@_calculator
+def first_location_of_minimum(b):
+    return np.argmin(b.X, axis=1) / b.length
+
+
+@_calculator
+def fourier_entropy(b, bins):
+    pxx = b.welch
+    normalised = pxx / np.max(pxx, axis=1, keepdims=True)
+    entropy = _binned_entropy(np.nan_to_num(normalised), bins)
+    return _where_rows(np.isnan(normalised).any(axis=1), np.nan, entropy)
+
+
+@_calculator
+def has_duplicate(b):
+    return np.sum(b.first_occurrence, axis=1) != b.length
+
+
+@_calculator
+def has_duplicate_max(b):
+    return np.sum(b.X == b.max[:, None], axis=1) >= 2
+
+
+@_calculator
+def has_duplicate_min(b):
+    return np.sum(b.X == b.min[:, None], axis=1) >= 2
+
+
+@_calculator
+def index_mass_quantile(b, q):
+    abs_x = np.abs(b.X)
+    total = np.sum(abs_x, axis=1)
+    mass = np.cumsum(abs_x, axis=1) / np.where(total == 0, 1, total)[:, None]
+    location = (np.argmax(mass >= q, axis=1) + 1) / b.length
+    return _where_rows(total == 0, np.nan, location)
+
+
+@_calculator
+def kurtosis(b):
+    # pandas Series.kurtosis
+    n = b.length
+    adjusted = b.X - (np.sum(b.X, axis=1) / n)[:, None]
+    adjusted2 = adjusted ** 2
+    m2 = adjusted2.sum(axis=1)
+    m4 = (adjusted2 ** 2).sum(axis=1)
+    if n < 4:
+        return np.full(b.n_rows, np.nan)
+    adj = 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))
+    numerator = n * (n + 1) * (n - 1) * m4
+    denominator = (n - 2) * (n - 3) * m2 ** 2
+    numerator = np.where(np.abs(numerator) < 1e-14, 0, numerator)
+    denominator = np.where(np.abs(denominator) < 1e-14, 0, denominator)
+    return np.where(denominator == 0, 0.0, numerator / np.where(denominator == 0, 1, denominator) - adj)
+
+
+@_calculator
+def large_standard_deviation(b, r):
+    return b.std > (r * (b.max - b.min))
+
+
+@_calculator
+def last_location_of_maximum(b):
+    return 1.0 - np.argmax(b.X[:, ::-1], axis=1) / b.length
+
+
+@_calculator
+def last_location_of_minimum(b):
+    return 1.0 - np.argmin(b.X[:, ::-1], axis=1) / b.length
+
+
+@_calculator
+def lempel_ziv_complexity(b, bins):
+    n_rows, n = b.n_rows, b.length
+    edges = _linspace(b.min, b.max, bins + 1)[:, 1:]
+    sequence = (edges[:, None, :] < b.X[:, :, None]).sum(axis=2)
+
+    # common[r, i, j]: length of the common prefix of sequence[r, i:] and sequence[r, j:]
+    common = np.zeros((n_rows, n + 1, n + 1), dtype=int)
+    for i in range(n - 1, -1, -1):
+        for j in range(n - 1, -1, -1):
+            common[:, i, j] = np.where(sequence[:, i] == sequence[:, j], common[:, i + 1, j + 1] + 1, 0)
+
+    # Run tsfresh's dictionary parse for every row in lock step; a sub-string is kept as (start, length)
+    rows = np.arange(n_rows)
+    seen_start = np.zeros((n_rows, n), dtype=int)
+    seen_length = np.zeros((n_rows, n), dtype=int)
+    seen = np.zeros(n_rows, dtype=int)
+    ind = np.zeros(n_rows, dtype=int)
+    inc = np.ones(n_rows, dtype=int)
+    active = ind + inc <= n
+    while active.any():
+        is_seen = (np.arange(n) < seen[:, None]) & (seen_length == inc[:, None]) & (common[rows[:, None], seen_start, ind[:, None]] >= inc[:, None])
+        found = active & is_seen.any(axis=1)
+        added = active & ~found
+        seen_start[added, seen[added]] = ind[added]
+        seen_length[added, seen[added]] = inc[added]
+        seen[added] += 1
+        ind[added] += inc[added]
+        inc = np.where(added, 1, np.where(found, inc + 1, inc))
+        active = ind + inc <= n
+    return seen / n
+
+
+@_calculator
+def linear_trend(b, attr):
+    return b.linear_trend[attr]
+
+
+@_calculator
+def longest_strike_above_mean(b):
+    return _longest_run(b.X > b.mean[:, None])
+
+
+@_calculator
+def longest_strike_below_mean(b):
+    return _longest_run(b.X < b.mean[:, None])
+
+
+@_calculator
+def maximum(b):
+    return b.max
+
+
+@_calculator
+def mean(b):
+    return b.mean
+
+
+@_calculator
+def mean_abs_change(b):
+    return np.mean(np.abs(b.diff), axis=1)
+
+
+@_calculator
+def mean_change(b):
+    if b.length <= 1:
+        return np.full(b.n_rows, np.nan)
+    return (b.X[:, -1] - b.X[:, 0]) / (b.length - 1)
+
+
+@_calculator
+def median(b):
+    return b.median
+
+
+@_calculator
+def minimum(b):
+    return b.min
+
+
+@_calculator
+def number_crossing_m(b, m):
+    positive = b.X > m
+    return np.sum(positive[:, 1:] != positive[:, :-1], axis=1)
+
+
+@_calculator
+def number_cwt_peaks(b, n):
+    # scipy.signal.find_peaks_cwt(x, widths=range(1, n + 1), wavelet=ricker), tracked for every row at once
+    n_rows, length = b.n_rows, b.length
+    cwt = np.stack([b.cwt(width) for width in range(1, n + 1)], axis=1)
+    is_max = np.zeros(cwt.shape, dtype=bool)
+    is_max[:, :, 1:-1] = (cwt[:, :, 1:-1] > cwt[:, :, :-2]) & (cwt[:, :, 1:-1] > cwt[:, :, 2:])
+
+    max_distances = np.arange(1, n + 1) / 4.0
+    gap_thresh = 1
+    min_length = np.ceil(n / 4)
+    capacity = n * length
+
+    # Ridge lines only need their latest point, length and gap to be connected and filtered
+    rows = np.arange(n_rows)
+    last_col = np.zeros((n_rows, capacity), dtype=int)
+    last_row = np.zeros((n_rows, capacity), dtype=int)
+    line_length = np.zeros((n_rows, capacity), dtype=int)
+    gap = np.zeros((n_rows, capacity), dtype=int)
+    active = np.zeros((n_rows, capacity), dtype=bool)
+    lines = np.zeros(n_rows, dtype=int)
+
+    for row in range(n - 1, -1, -1):
+        gap += active
+        previous_active = active.copy()
+        previous_col = last_col.copy()
+        for col in range(length):
+            has_max = is_max[:, row, col]
+            if not has_max.any():
+                continue
+            diffs = np.where(previous_active, np.abs(col - previous_col), np.iinfo(int).max)
+            closest = np.argmin(diffs, axis=1)
+            connect = has_max & (diffs[rows, closest] <= max_distances[row])
+            start = has_max & ~connect
+
+            target = np.where(connect, closest, lines)
+            update = connect | start
+            r, t = rows[update], target[update]
+            last_col[r, t] = col
+            last_row[r, t] = row
+            line_length[r, t] = np.where(connect[update], line_length[r, t] + 1, 1)
+            gap[r, t] = 0
+            active[r, t] = True
+            lines[start] += 1
+        active &= gap <= gap_thresh
+
+    window_size = int(np.ceil(length / 20))
+    half_window, odd = divmod(window_size, 2)
+    noises = np.stack([
+        np.percentile(cwt[:, 0, max(i - half_window, 0):min(i + half_window + odd, length)], 10, axis=1)
+        for i in range(length)
+    ], axis=1)
+
+    used = np.arange(capacity) < lines[:, None]
+    snr = np.abs(cwt[rows[:, None], last_row, last_col] / noises[rows[:, None], last_col])
+    kept = used & (line_length >= min_length) & ~(snr < 1)
+    return kept.sum(axis=1)
+
+
+@_calculator
+def number_peaks(b, n):
+    X = b.X
+    length = b.length
+    reduced = X[:, n:length - n]
+    result = np.ones(reduced.shape, dtype=bool)
+    for i in range(1, n + 1):
+        result &= reduced > np.roll(X, i, axis=1)[:, n:length - n]
+        result &= reduced > np.roll(X, -i, axis=1)[:, n:length - n]
+    return np.sum(result, axis=1)
+
+
+@_calculator
+def percentage_of_reoccurring_datapoints_to_all_datapoints(b):
+    return np.sum(b.occurrences > 1, axis=1) / b.length
+
+
+@_calculator
+def percentage_of_reoccurring_values_to_all_values(b):
+    unique = np.sum(b.first_occurrence, axis=1)
+    return np.sum(b.first_occurrence & (b.occurrences > 1), axis=1) / unique
+
+
+@_calculator
+def permutation_entropy(b, tau, dimension):
+    windows = _subchunks(b.X, dimension, tau)
+    count = windows.shape[1]
+    if count == 0:
+        return np.full(b.n_rows, np.nan)
+    permutations = np.argsort(np.argsort(windows, axis=2), axis=2)
+    codes = permutations @ (dimension ** np.arange(dimension))
+    frequency = (codes[:, :, None] == codes[:, None, :]).sum(axis=2) / count
+    # Every window contributes 1/count of its pattern's -p log p
+    return -np.sum(np.log(frequency), axis=1) / count
+
+
+@_calculator
+def quantile(b, q):
+    return np.quantile(b.X, q, axis=1)
+
+
+@_calculator
+def range_count(b, min, max):
+    return np.sum((b.X >= min) & (b.X < max), axis=1)
+
+
+@_calculator
+def ratio_beyond_r_sigma(b, r):
+    return np.sum(np.abs(b.X - b.mean[:, None]) > (r * b.std)[:, None], axis=1) / b.length
+
+
+@_calculator
+def ratio_value_number_to_time_series_length(b):
+    return np.sum(b.first_occurrence, axis=1) / b.length
+
+
+@_calculator
+def root_mean_square(b):
+    return np.sqrt(np.mean(np.square(b.X), axis=1))
+
+
+@_calculator
+def sample_entropy(b):
+    # tsfresh returns NaN for a history too short to have a window of 3 (A = B = 0)
+    if b.length < 3:
+        return np.full(b.n_rows, np.nan)
+    tolerance = 0.2 * b.std
+    B = np.sum(_count_similar(_subchunks(b.X, 2), tolerance) - 1, axis=1)
+    A = np.sum(_count_similar(_subchunks(b.X, 3), tolerance) - 1, axis=1)
+    return -np.log(A / B)
+
+
+@_calculator
+def skewness(b):
+    # pandas Series.skew
+    n = b.length
+    adjusted = b.X - (np.sum(b.X, axis=1) / n)[:, None]
+    adjusted2 = adjusted ** 2
+    m2 = adjusted2.sum(axis=1)
+    m3 = (adjusted2 * adjusted).sum(axis=1)
+    if n < 3:
+        return np.full(b.n_rows, np.nan)
+    m2 = np.where(np.abs(m2) < 1e-14, 0, m2)
+    m3 = np.where(np.abs(m3) < 1e-14, 0, m3)
+    result = (n * (n - 1) ** 0.5 / (n - 2)) * (m3 / np.where(m2 == 0, 1, m2) ** 1.5)
+    return np.where(m2 == 0, 0.0, result)
+
+
+@_calculator
+def spkt_welch_density(b, coeff):
+    if coeff >= b.welch.shape[1]:
+        return np.full(b.n_rows, np.nan)
+    return b.welch[:, coeff]
+
+
+@_calculator
+def standard_deviation(b):
+    return b.std
+
+
+@_calculator
+def sum_of_reoccurring_data_points(b):
+    return np.sum(np.where(b.occurrences > 1, b.X, 0), axis=1)
+
+
+@_calculator
+def sum_of_reoccurring_values(b):
+    return np.sum(np.where(b.first_occurrence & (b.occurrences > 1), b.X, 0), axis=1)
+
+
+@_calculator
+def sum_values(b):
+    return np.sum(b.X, axis=1)
+
+
+@_calculator
+def symmetry_looking(b, r):
+    return np.abs(b.mean - b.median) < (r * (b.max - b.min))
+
+
+@_calculator
+def time_reversal_asymmetry_statistic(b, lag):
+    n = b.length
+    if 2 * lag >= n:
+        return np.zeros(b.n_rows)
+    X = b.X
+    one_lag = X[:, lag:n - lag]
+    two_lag = X[:, 2 * lag:]
+    x = X[:, :n - 2 * lag]
+    return np.mean(two_lag * two_lag * one_lag - one_lag * x * x, axis=1)
+
+
+@_calculator
+def value_count(b, value):
+    if np.isnan(value):
+        return np.sum(np.isnan(b.X), axis=1)
+    return np.sum(b.X == value, axis=1)
+
+
+@_calculator
+def variance(b):
+    return b.var
+
+
+@_calculator
+def variance_larger_than_standard_deviation(b):
+    return b.var > np.sqrt(b.var)
+
+
+@_calculator
+def variation_coefficient(b):
+    return _where_rows(b.mean != 0, b.std / np.where(b.mean != 0, b.mean, 1), np.nan)
+
+
+@lru_cache(maxsize=None)
+def get_batch_plan():
+    # (output column, calculator, params) for every feature, in relevant_features.csv order
+    plan = []
+    for i, name in enumerate(get_feature_spec().feature_names):
+        _, calculator, params = parse_feature_name(name)
+        if calculator not in _CALCULATORS:
+            raise Exception(f"No vectorized implementation of feature calculator {calculator}")
+        plan.append((i + 1, _CALCULATORS[calculator], params or {}))
+    return plan
+
+
+def compute_feature_matrix(payment_histories, credit_utilisation_ratios):
+    # payment_histories: N x T repayment statuses, credit_utilisation_ratios: N values.
+    # Returns the N x 247 matrix predict expects, columns as in get_feature_spec().columns
+    X = np.asarray(payment_histories, dtype=float)
+    if X.ndim != 2:
+        raise Exception("payment_histories must be a 2-dimensional matrix")
+    ratios = np.asarray(credit_utilisation_ratios, dtype=float).reshape(-1)
+    if len(ratios) != len(X):
+        raise Exception("Expected one credit utilisation ratio per payment history")
+
+    plan = get_batch_plan()
+    features = np.empty((len(X), len(plan) + 1))
+    features[:, 0] = ratios
+    if len(X) == 0:
+        return features
+
+    batch = _Batch(X)
+    with np.errstate(all="ignore"):
+        for column, calculator, params in plan:
+            features[:, column] = calculator(batch, **params)
+
+    # Same as imputing each customer's row on its own in preprocess
+    features[:, 1:][~np.isfinite(features[:, 1:])] = 0
+    return features
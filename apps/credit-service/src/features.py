@@ -0,0 +1,166 @@
+import ast
+import csv
+import os
+import re
+import threading
+import warnings
+from functools import lru_cache
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RELEVANT_FEATURES_PATH = os.path.join(BASE_DIR, "relevant_features.csv")
+CREDIT_UTILISATION_RATIO_COLUMN = "CREDIT_UTILISATION_RATIO"
+
+
+def clean_column_name(column):
+    # LightGBM does not accept quotes, brackets etc. in feature names
+    return re.sub(r'[^a-zA-Z0-9_]', '_', column)
+
+
+def parse_feature_name(column):
+    # Same format as tsfresh's from_columns: <kind>__<calculator>__<param>_<value>__...
+    parts = column.split("__")
+    if len(parts) < 2:
+        raise Exception(f"{column} is not a tsfresh feature name")
+    kind, calculator = parts[0], parts[1]
+
+    params = None
+    if len(parts) > 2:
+        params = {}
+        for part in parts[2:]:
+            key, value = part.rsplit("_", 1)
+            if value.lower() == "nan":
+                params[key] = np.nan
+            elif value.lower() == "-inf":
+                params[key] = -np.inf
+            elif value.lower() == "inf":
+                params[key] = np.inf
+            else:
+                params[key] = ast.literal_eval(value)
+    return kind, calculator, params
+
+
+class FeatureSpec:
+    """The tsfresh features the model was trained on, parsed into a per-calculator plan
+    so that only those calculators are ever run.
+
+    The plan calls tsfresh's calculators, so it is only built (and tsfresh imported) the
+    first time extract is used; the NumPy path in feature_matrix.py only needs the names."""
+
+    def __init__(self, feature_names):
+        self.feature_names = list(feature_names)
+        self.columns = [CREDIT_UTILISATION_RATIO_COLUMN] + [clean_column_name(name) for name in self.feature_names]
+        self._planned = False
+        self._plan_lock = threading.Lock()
+
+    def _plan(self):
+        with self._plan_lock:
+            if not self._planned:
+                self._build_plan()
+
+    def _build_plan(self):
+        from tsfresh.feature_extraction import feature_calculators
+
+        # Simple calculators return one value per parameter set, so each one maps to a single output
+        self.simple = []
+        # change_quantiles features grouped by corridor, see _change_quantiles
+        self.change_quantiles = {}
+        # Combiners take every parameter set at once and return (suffix, value) pairs
+        self.combiners = {}
+        self._combiner_index = {}
+
+        for i, name in enumerate(self.feature_names):
+            _, calculator, params = parse_feature_name(name)
+            if not hasattr(feature_calculators, calculator):
+                raise Exception(f"Unknown feature calculator {calculator}")
+            func = getattr(feature_calculators, calculator)
+            if calculator == "change_quantiles":
+                corridor = (params["ql"], params["qh"])
+                self.change_quantiles.setdefault(corridor, []).append((i, params["isabs"], params["f_agg"]))
+            elif getattr(func, "fctype", None) == "combiner":
+                self.combiners.setdefault(calculator, []).append(params)
+                suffix = name.split("__", 2)[2]
+                self._combiner_index[f"{calculator}__{suffix}"] = i
+            else:
+                self.simple.append((i, func, params))
+
+        self.combiners = [(getattr(feature_calculators, calculator), params) for calculator, params in self.combiners.items()]
+
+        # Fail before extracting anything if a combiner names its outputs differently
+        with warnings.catch_warnings(), np.errstate(all="ignore"):
+            warnings.simplefilter("ignore")
+            returned = {f"{func.__name__}__{suffix}" for func, params in self.combiners for suffix, _ in func(np.zeros(6), param=params)}
+        missing = set(self._combiner_index) - returned
+        if missing:
+            raise Exception(f"Feature calculators did not return {sorted(missing)}")
+        self._planned = True
+
+    def __len__(self):
+        return len(self.feature_names)
+
+    def extract(self, payment_history):
+        import pandas as pd
+        if not self._planned:
+            self._plan()
+        x = np.asarray(payment_history)
+        values = np.empty(len(self.feature_names))
+        series = None
+
+        with warnings.catch_warnings(), np.errstate(all="ignore"):
+            warnings.simplefilter("ignore")
+
+            for i, func, params in self.simple:
+                if getattr(func, "input", None) == "pd.Series":
+                    if series is None:
+                        series = pd.Series(x)
+                    data = series
+                else:
+                    data = x
+                values[i] = func(data, **params) if params else func(data)
+
+            for corridor, outputs in self.change_quantiles.items():
+                _change_quantiles(x, *corridor, outputs, values)
+
+            for func, params in self.combiners:
+                for suffix, value in func(x, param=params):
+                    i = self._combiner_index.get(f"{func.__name__}__{suffix}")
+                    if i is not None:
+                        values[i] = value
+
+        # Equivalent to tsfresh's impute on a single row: no finite value in the column to fall back on
+        values[~np.isfinite(values)] = 0
+        return values
+
+
+def _change_quantiles(x, ql, qh, outputs, values):
+    # tsfresh's change_quantiles runs pd.qcut once per feature. The model uses 56 of them over
+    # a handful of corridors, so the corridor is computed once and shared by every aggregate on it.
+    if ql >= qh:
+        for i, _, _ in outputs:
+            values[i] = 0
+        return
+
+    # pd.qcut(x, [ql, qh]) puts [quantile(ql), quantile(qh)] in bin 0 and fails on equal edges
+    low, high = np.quantile(x, [ql, qh])
+    inside = (x >= low) & (x <= high)
+    ind = inside[1:] & inside[:-1]
+    if low == high or not ind.any():
+        for i, _, _ in outputs:
+            values[i] = 0
+        return
+
+    div = np.diff(x)[ind]
+    abs_div = np.abs(div)
+    for i, isabs, f_agg in outputs:
+        values[i] = getattr(np, f_agg)(abs_div if isabs else div)
+
+
+@lru_cache(maxsize=None)
+def get_feature_spec(path=RELEVANT_FEATURES_PATH):
+    with open(path, newline="") as f:
+        feature_names = [row["features"] for row in csv.DictReader(f)]
+    return FeatureSpec(feature_names)
+
+
+def extract_relevant_features(payment_history):
+    return get_feature_spec().extract(payment_history)
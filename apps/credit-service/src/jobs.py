@@ -0,0 +1,200 @@
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Worker processes scoring uploaded reports, and how many jobs may wait for one before submissions get a 429
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "16"))
+# "memory" keeps jobs in this process, "file" writes them to JOB_DIR so any worker process can answer a
+# poll. server.py uses "file" whenever it runs more than one worker.
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "memory")
+JOB_DIR = os.getenv("JOB_DIR", os.path.join(BASE_DIR, "job_cache"))
+# How long (in seconds) a finished job can still be polled
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "3600"))
+
+PENDING, DONE, FAILED = "pending", "done", "failed"
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class QueueFull(Exception):
+    pass
+
+
+def score_report(path, remove=False):
+    # Runs in a worker process: everything /get-first-credit-rating does with an uploaded report
+    # except the database writes, which the web process does when the job finishes. With remove
+    # the report (a spooled upload) is deleted afterwards.
+    from service import extract_payment_history_and_credit_utilisation_ratio_from_report, preprocess, predict
+    try:
+        payment_history, credit_utilisation_ratio = extract_payment_history_and_credit_utilisation_ratio_from_report(path)
+    finally:
+        if remove:
+            os.remove(path)
+    X = preprocess(credit_utilisation_ratio, payment_history)
+    # Pool workers exit without running atexit handlers, so scores queued for the shadow log
+    # would be lost: jobs are not shadow-scored
+    credit_score, model_version = predict(X, with_version=True, shadow_models=[])
+    return {
+        "credit_score": int(credit_score[0]),
+        "model_version": model_version,
+        "payment_history": [int(status) for status in payment_history],
+        "credit_utilisation_ratio": float(credit_utilisation_ratio),
+    }
+
+
+def warm_up_worker():
+    from service import warm_up
+    warm_up()
+
+
+class MemoryJobStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def put(self, job):
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def prune(self, before):
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job.get("finished_at") is not None and job["finished_at"] < before:
+                    del self._jobs[job_id]
+
+
+class FileJobStore:
+    """One JSON file per job, written atomically like the CCI artifacts."""
+
+    def __init__(self, directory=JOB_DIR):
+        self.directory = directory
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def put(self, job):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, f".{job['job_id']}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._path(job["job_id"]))
+
+    def get(self, job_id):
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def prune(self, before):
+        if not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            job = self.get(filename[:-len(".json")])
+            if job is not None and job.get("finished_at") is not None and job["finished_at"] < before:
+                try:
+                    os.remove(self._path(job["job_id"]))
+                except FileNotFoundError:
+                    pass
+
+
+def make_job_store(backend=JOB_QUEUE_BACKEND):
+    if backend == "memory":
+        return MemoryJobStore()
+    if backend == "file":
+        return FileJobStore()
+    raise Exception(f"Unknown job queue backend {backend}")
+
+
+class JobQueue:
+    """Runs jobs on a local process pool and records their status in a job store.
+
+    At most max_pending jobs submitted by this process are waiting or running at a time, any
+    more are rejected with QueueFull instead of piling up. The pool is started on the first
+    submission, its processes are spawned (not forked from the threaded web server) and load
+    the model once."""
+
+    def __init__(self, store=None, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE, executor=None, result_ttl=JOB_RESULT_TTL):
+        self.store = store if store is not None else make_job_store()
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=warm_up_worker,
+                )
+            return self._executor
+
+    def submit(self, kind, fn, *args, on_done=None):
+        # on_done(result) runs in this process once fn has returned, before the job is marked done
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"Too many pending jobs ({self.max_pending}), try again later")
+            self._pending += 1
+
+        now = time.time()
+        self.store.prune(now - self.result_ttl)
+        job = {"job_id": uuid.uuid4().hex, "kind": kind, "status": PENDING, "submitted_at": now, "finished_at": None, "result": None, "error": None}
+        try:
+            self.store.put(job)
+            future = self.executor().submit(fn, *args)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(lambda future: self._finish(job, future, on_done))
+        return job
+
+    def _finish(self, job, future, on_done):
+        try:
+            result = future.result()
+            if on_done is not None:
+                on_done(result)
+            job = {**job, "status": DONE, "result": result}
+        except Exception as e:
+            logger.exception("Job %s failed", job["job_id"])
+            job = {**job, "status": FAILED, "error": str(e)}
+        job["finished_at"] = time.time()
+        # The slot is free before the job shows up as finished, so a client that saw it finish can submit again
+        with self._lock:
+            self._pending -= 1
+        self.store.put(job)
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def stats(self):
+        return {"pending": self._pending, "max_pending": self.max_pending, "workers": self.max_workers}
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+job_queue = JobQueue()
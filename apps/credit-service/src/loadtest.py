@@ -0,0 +1,400 @@
+"""Load-tests one worker of the service end to end, over HTTP.
+
+    python3 loadtest.py [--mix update-credit-rating=8,get-first-credit-rating=2] [--concurrency 1,2,4,8] [--duration 10]
+    python3 loadtest.py --rate 10,20,40 --max-concurrency 32 [--profile server.folded] [--output results.json]
+
+A database is seeded as for benchmark.py (a temporary SQLite file unless --database-uri is
+given), then the app from create_app is served by the werkzeug server in a process of its own:
+one worker, handling one request at a time unless --threaded. Requests are picked from the mix by
+weight and sent over keep-alive connections, one per client thread. The admin endpoints send
+different inputs on every request, so they are not answered from the result cache; their
+-repeated variants always send the same inputs and measure cache hits.
+
+Each step of --concurrency is a closed loop: that many clients send their next request as soon as
+the previous one is answered. Each step of --rate is an open loop: requests are due at a fixed
+rate whatever the server does, and their latency is counted from when they were due, so a server
+that falls behind shows it in the percentiles instead of slowing the load down. Every step reports
+throughput, latency percentiles and the error rate overall and by endpoint, with the time the
+server spent in each scoring stage (from /metrics). --profile writes the server's sampled stacks
+over the whole run in the folded format, see profiling.py.
+"""
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPORT_PATH = os.path.join(BASE_DIR, "Consumer-Credit-Report.pdf")
+
+DEFAULT_MIX = "update-credit-rating=8,get-first-credit-rating=2"
+DEFAULT_DURATION = 10
+DEFAULT_WARMUP = 2
+DEFAULT_MAX_CONCURRENCY = 32
+BATCH_SIZE = 50
+SERVER_START_TIMEOUT = 120
+PERCENTILES = (50, 90, 95, 99)
+# Monthly statuses of the random admin what-if histories, on time most often
+ADMIN_STATUSES = [-1, -1, -1, -1, 2, 3, 4, 5, 6]
+STAGE_PATTERN = re.compile(r'^credit_service_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$', re.MULTILINE)
+
+
+def multipart(fields, files=()):
+    # multipart/form-data body and headers, files are (field name, filename, content)
+    boundary = uuid.uuid4().hex
+    body = b""
+    for name, value in fields.items():
+        body += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+    for name, filename, content in files:
+        body += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\nContent-Type: application/pdf\r\n\r\n'.encode()
+        body += content + b"\r\n"
+    body += f"--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def json_body(data):
+    return json.dumps(data).encode(), {"Content-Type": "application/json"}
+
+
+class RequestFactory:
+    """Builds the requests of each endpoint of the mix for random seeded customers."""
+
+    def __init__(self, customer_ids, seed=0):
+        self.customer_ids = customer_ids
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._report = None
+
+    def report(self):
+        if self._report is None:
+            with open(REPORT_PATH, "rb") as f:
+                self._report = f.read()
+        return self._report
+
+    def build(self, endpoint):
+        # (method, path, body, headers)
+        with self._lock:
+            customer_id = self.rng.choice(self.customer_ids)
+            batch = self.rng.sample(self.customer_ids, min(BATCH_SIZE, len(self.customer_ids)))
+        if endpoint == "update-credit-rating":
+            return ("POST", "/update-credit-rating", *json_body({"customer_id": customer_id}))
+        if endpoint == "batch-update-credit-rating":
+            return ("POST", "/batch-update-credit-rating", *json_body({"customer_ids": batch}))
+        if endpoint == "get-first-credit-rating":
+            # Scored from the Consumer Credit Index
+            return ("POST", "/get-first-credit-rating", *multipart({"customer_id": customer_id}))
+        if endpoint == "get-first-credit-rating-report":
+            return ("POST", "/get-first-credit-rating", *multipart({"customer_id": customer_id}, [("file", "Consumer-Credit-Report.pdf", self.report())]))
+        # Admin what-if scores are cached by their inputs (see result_cache.py): the plain endpoints
+        # send inputs that differ on every request so they measure scoring, the -repeated ones
+        # always send the same inputs so they measure cache hits
+        if endpoint == "admin-update-credit-rating":
+            with self._lock:
+                body = {"creditUtilisationRatio": round(self.rng.random(), 6), "paymentHistory": self.rng.choices(ADMIN_STATUSES, k=6)}
+            return ("POST", "/admin-update-credit-rating", *json_body(body))
+        if endpoint == "admin-update-credit-rating-repeated":
+            return ("POST", "/admin-update-credit-rating", *json_body({"creditUtilisationRatio": 0.3, "paymentHistory": [-1] * 6}))
+        if endpoint == "get-admin-credit-rating":
+            # A PDF comment after the end of the file changes its hash but not what is parsed
+            with self._lock:
+                report = self.report() + f"\n%{self.rng.getrandbits(64):016x}\n".encode()
+            return ("POST", "/get-admin-credit-rating", *multipart({}, [("file", "Consumer-Credit-Report.pdf", report)]))
+        if endpoint == "get-admin-credit-rating-repeated":
+            return ("POST", "/get-admin-credit-rating", *multipart({}, [("file", "Consumer-Credit-Report.pdf", self.report())]))
+        raise Exception(f"Unknown endpoint {endpoint}")
+
+
+ENDPOINTS = [
+    "update-credit-rating",
+    "batch-update-credit-rating",
+    "get-first-credit-rating",
+    "get-first-credit-rating-report",
+    "admin-update-credit-rating",
+    "admin-update-credit-rating-repeated",
+    "get-admin-credit-rating",
+    "get-admin-credit-rating-repeated",
+]
+
+
+def parse_mix(mix):
+    # "update-credit-rating=8,get-first-credit-rating=2" -> {endpoint: weight}
+    weights = {}
+    for item in mix.split(","):
+        endpoint, _, weight = item.strip().partition("=")
+        if endpoint not in ENDPOINTS:
+            raise Exception(f"Unknown endpoint {endpoint}, expected one of {', '.join(ENDPOINTS)}")
+        weights[endpoint] = float(weight or 1)
+    if sum(weights.values()) <= 0:
+        raise Exception("The mix needs at least one endpoint with a positive weight")
+    return weights
+
+
+def serve(database_uri, threaded, port_queue, stop_event, profile_path=None):
+    # Runs in the server process until stop_event is set
+    os.environ["SQLALCHEMY_DATABASE_URI"] = database_uri
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    from werkzeug.serving import make_server
+    from main import create_app
+    from profiling import StackSampler
+
+    server = make_server("127.0.0.1", 0, create_app(), threaded=threaded)
+    thread = threading.Thread(target=server.serve_forever, name="server", daemon=True)
+    thread.start()
+    # Every thread but this one, which only waits for the end of the run
+    sampler = StackSampler(exclude={threading.get_ident()}).start() if profile_path else None
+    port_queue.put(server.port)
+    stop_event.wait()
+    server.shutdown()
+    thread.join()
+    if sampler:
+        sampler.stop()
+        with open(profile_path, "w") as f:
+            f.write(sampler.folded())
+
+
+class Server:
+    """The app served in a spawned process, started and stopped with the with block."""
+
+    def __init__(self, database_uri, threaded=False, profile_path=None):
+        self.database_uri = database_uri
+        self.threaded = threaded
+        self.profile_path = profile_path
+        self.port = None
+
+    def __enter__(self):
+        context = multiprocessing.get_context("spawn")
+        port_queue = context.Queue()
+        self.stop_event = context.Event()
+        self.process = context.Process(target=serve, args=(self.database_uri, self.threaded, port_queue, self.stop_event, self.profile_path), daemon=True)
+        self.process.start()
+        try:
+            self.port = port_queue.get(timeout=SERVER_START_TIMEOUT)
+        except Exception:
+            self.process.terminate()
+            raise Exception("The server did not start")
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.process.join(timeout=30)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def get(self, path):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port)
+        try:
+            connection.request("GET", path)
+            return connection.getresponse().read().decode()
+        finally:
+            connection.close()
+
+
+def stage_totals(metrics_text):
+    # {stage: [seconds, count]} from the server's /metrics
+    totals = defaultdict(lambda: [0.0, 0])
+    for kind, stage_name, value in STAGE_PATTERN.findall(metrics_text):
+        totals[stage_name][0 if kind == "sum" else 1] += float(value)
+    return totals
+
+
+def stage_breakdown(before, after):
+    breakdown = {}
+    for stage_name, (seconds, count) in after.items():
+        seconds -= before.get(stage_name, [0.0, 0])[0]
+        count -= before.get(stage_name, [0.0, 0])[1]
+        if count > 0:
+            breakdown[stage_name] = {"count": int(count), "seconds": seconds, "mean_ms": seconds / count * 1000}
+    return breakdown
+
+
+def summarise(records, elapsed):
+    # records are (endpoint, status, latency in seconds), status None when no response came back
+    latencies = np.array([latency for _, _, latency in records]) * 1000
+    errors = sum(1 for _, status, _ in records if status is None or status >= 400)
+    summary = {
+        "requests": len(records),
+        "errors": errors,
+        "error_rate": errors / len(records) if records else 0,
+        "throughput": len(records) / elapsed if elapsed else 0,
+        "statuses": dict(Counter(str(status) for _, status, _ in records)),
+    }
+    if len(records):
+        summary.update({f"p{p}_ms": float(np.percentile(latencies, p)) for p in PERCENTILES})
+        summary["max_ms"] = float(latencies.max())
+    return summary
+
+
+def send(connection, request):
+    method, path, body, headers = request
+    try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except (OSError, http.client.HTTPException):
+        # Reconnects on the next request
+        connection.close()
+        return None
+
+
+def run_step(port, factory, mix, duration, concurrency=1, rate=None, seed=0):
+    # Closed loop at concurrency, or open loop at rate requests per second with concurrency clients
+    endpoints, weights = list(mix), list(mix.values())
+    records = []
+    lock = threading.Lock()
+    next_request = 0
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def client(i):
+        nonlocal next_request
+        rng = random.Random(seed * 1000 + i)
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        try:
+            while True:
+                if rate:
+                    with lock:
+                        due = start + next_request / rate
+                        next_request += 1
+                    if due >= deadline:
+                        return
+                    time.sleep(max(0, due - time.perf_counter()))
+                else:
+                    due = time.perf_counter()
+                    if due >= deadline:
+                        return
+                endpoint = rng.choices(endpoints, weights)[0]
+                status = send(connection, factory.build(endpoint))
+                with lock:
+                    records.append((endpoint, status, time.perf_counter() - due))
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    by_endpoint = defaultdict(list)
+    for record in records:
+        by_endpoint[record[0]].append(record)
+    return {
+        "concurrency": concurrency,
+        "rate": rate,
+        "duration": elapsed,
+        "overall": summarise(records, elapsed),
+        "endpoints": {endpoint: summarise(endpoint_records, elapsed) for endpoint, endpoint_records in sorted(by_endpoint.items())},
+    }
+
+
+def seed_database(database_uri, scale, seed=0):
+    # Fills the database (unless an earlier run did) and returns the customer ids to send
+    os.environ["SQLALCHEMY_DATABASE_URI"] = database_uri
+    from sqlalchemy import func
+    from main import create_app
+    from models import db, Customer, InstalmentPayment
+    from benchmark import build_database, SCALES
+
+    app = create_app(warm_up=False)
+    with app.app_context():
+        db.create_all()
+        if db.session.query(func.count(InstalmentPayment.instalment_payment_id)).scalar() == 0:
+            build_database(db, SCALES[scale], seed)
+        customer_ids = [customer_id for (customer_id,) in db.session.query(Customer.customer_id)]
+        db.session.remove()
+        db.engine.dispose()
+    return customer_ids
+
+
+def load_test(database_uri, mix=DEFAULT_MIX, concurrency=(1,), rates=(), duration=DEFAULT_DURATION, warmup=DEFAULT_WARMUP,
+              max_concurrency=DEFAULT_MAX_CONCURRENCY, scale="1k", threaded=False, profile_path=None, seed=0):
+    from benchmark import git_commit
+    mix = parse_mix(mix) if isinstance(mix, str) else mix
+    customer_ids = seed_database(database_uri, scale, seed)
+    factory = RequestFactory(customer_ids, seed)
+    steps = [{"rate": rate, "concurrency": max_concurrency} for rate in rates] or [{"rate": None, "concurrency": c} for c in concurrency]
+
+    results = []
+    with Server(database_uri, threaded, profile_path) as server:
+        if warmup:
+            run_step(server.port, factory, mix, warmup, seed=seed)
+        for step in steps:
+            before = stage_totals(server.get("/metrics"))
+            result = run_step(server.port, factory, mix, duration, step["concurrency"], step["rate"], seed)
+            result["stages"] = stage_breakdown(before, stage_totals(server.get("/metrics")))
+            overall = result["overall"]
+            logger.info("concurrency %d%s: %.1f requests/s, p50 %.1fms, p95 %.1fms, error rate %.1f%%",
+                        step["concurrency"], f", rate {step['rate']}/s" if step["rate"] else "", overall["throughput"],
+                        overall.get("p50_ms", 0), overall.get("p95_ms", 0), overall["error_rate"] * 100)
+            results.append(result)
+
+    return {
+        "commit": git_commit(),
+        "mix": mix,
+        "threaded": threaded,
+        "scale": scale,
+        "customers": len(customer_ids),
+        "profile": profile_path,
+        "steps": results,
+    }
+
+
+def parse_steps(value, kind):
+    return [kind(step) for step in value.split(",")] if value else []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test one worker of the service over HTTP")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"endpoint=weight pairs, endpoints: {', '.join(ENDPOINTS)}")
+    parser.add_argument("--concurrency", default="1", help="closed-loop steps, comma-separated client counts")
+    parser.add_argument("--rate", help="open-loop steps, comma-separated requests per second (overrides --concurrency)")
+    parser.add_argument("--max-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="clients sending the open-loop requests")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds per step")
+    parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP, help="seconds of unmeasured requests first")
+    parser.add_argument("--scale", default="1k", help="size of the seeded database, see benchmark.py")
+    parser.add_argument("--database-uri", help="database to fill (or reuse), a temporary SQLite file by default")
+    parser.add_argument("--threaded", action="store_true", help="serve requests on threads instead of one at a time")
+    parser.add_argument("--profile", help="write the server's sampled stacks to this file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    temporary_dir = None
+    database_uri = args.database_uri
+    if database_uri is None:
+        temporary_dir = tempfile.mkdtemp()
+        database_uri = f"sqlite:///{os.path.join(temporary_dir, 'loadtest.db')}"
+        # The Consumer Credit Index artifacts of the run are kept out of the service's cache too
+        os.environ.setdefault("CCI_CACHE_DIR", os.path.join(temporary_dir, "cci_cache"))
+    try:
+        result = load_test(database_uri, args.mix, parse_steps(args.concurrency, int), parse_steps(args.rate, float), args.duration,
+                           args.warmup, args.max_concurrency, args.scale, args.threaded, args.profile, args.seed)
+    finally:
+        if temporary_dir:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
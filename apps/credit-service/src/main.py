@@ -2,20 +2,57 @@ from flask import Flask
 from dotenv import load_dotenv
 from routes import bp as main_routes
 from models import db
+from service import warm_up as warm_up_scoring, prewarm_feature_cache
 import os
 from flask_cors import CORS
+import metrics
+import profiling
+import payment_status  # expires materialised payment statuses when instalments change
 
-def create_app():
+def engine_options(database_uri):
+    # Every worker process has a pool of its own, so a node opens up to workers * (DB_POOL_SIZE +
+    # DB_MAX_OVERFLOW) connections. Pre-ping and recycling drop connections the database or a
+    # proxy closed while the worker was idle instead of failing the next request on them.
+    options = {
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    }
+    # SQLite (tests, benchmarks) is not pooled by size
+    if database_uri and not database_uri.startswith("sqlite"):
+        options["pool_size"] = int(os.getenv("DB_POOL_SIZE", "5"))
+        options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+        options["pool_timeout"] = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    return options
+
+def create_app(warm_up=True):
     app = Flask(__name__)
     CORS(app)
     CORS(app, origins=["http://localhost:3000"]) 
     load_dotenv()
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("SQLALCHEMY_DATABASE_URI")
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
     db.init_app(app)
     app.register_blueprint(main_routes)
+    # Request counts, latencies and stage timings at /metrics, and opt-in profiles of slow requests
+    metrics.init_app(app)
+    profiling.init_app(app)
+
+    # Load the model and parse the feature spec before the first request instead of on it
+    if warm_up:
+        warm_up_scoring()
+
+    # Optionally compute the features of the N most common credit score histories up front
+    prewarm_limit = int(os.getenv("FEATURE_CACHE_PREWARM", "0"))
+    if prewarm_limit > 0:
+        try:
+            with app.app_context():
+                prewarm_feature_cache(db, prewarm_limit)
+        except Exception as e:
+            app.logger.warning("Could not prewarm the feature cache: %s", e)
 
     return app
 
 if __name__ == "__main__":
+    # Development server, production runs python3 server.py (see server.py)
     app = create_app()
     app.run(debug=True)
@@ -0,0 +1,281 @@
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, request, Response
+
+# In-process counters and histograms exposed in the Prometheus text format at /metrics. Each
+# process keeps its own. Behind a single port (server.py's pre-forked workers) a scrape reaches
+# one worker only, so each worker also writes its values to a shared directory about once a
+# second (see enable_multiprocess) and /metrics adds up those of every worker, including the
+# ones that have exited so counters never go backwards.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labels), 0)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def render(self, snapshots=()):
+        # snapshots are the values of other processes, added to this one's
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                values[tuple(key)] = values.get(tuple(key), 0) + value
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # key -> [per-bucket counts (last one is +Inf), sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][i] += 1
+            counts[1] += value
+
+    def count(self, **labels):
+        counts = self._values.get(tuple(labels[name] for name in self.labels))
+        return sum(counts[0]) if counts else 0
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(counts), total] for key, (counts, total) in self._values.items()]
+
+    def render(self, snapshots=()):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for snapshot in snapshots:
+            for key, counts, total in snapshot:
+                key = tuple(key)
+                own_counts, own_total = values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+                values[key] = ([a + b for a, b in zip(own_counts, counts)], own_total + total)
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def reset(self):
+        for metric in self._metrics:
+            metric.reset()
+
+    def render(self, snapshots=()):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render([snapshot.get(metric.name, []) for snapshot in snapshots])
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# Shared directory of the server processes' values, None when this process is the only one
+MULTIPROCESS_DIR = None
+# name -> function returning a dict of counts, written with the metrics and added up by combined_stats
+STATS = {}
+_state_path = {}
+
+
+def enable_multiprocess(directory):
+    global MULTIPROCESS_DIR
+    os.makedirs(directory, exist_ok=True)
+    MULTIPROCESS_DIR = directory
+
+
+def state_path():
+    # A file per process start, so a reused pid does not overwrite an exited worker's counters
+    pid = os.getpid()
+    if pid not in _state_path:
+        _state_path[pid] = os.path.join(MULTIPROCESS_DIR, f"{pid}-{uuid.uuid4().hex}.json")
+    return _state_path[pid]
+
+
+def write_process_state(alive=True):
+    # Called by each server worker every second or so, and with alive=False when it exits
+    path = state_path()
+    state = {"pid": os.getpid(), "metrics": metrics.snapshot(), "stats": {name: stats() for name, stats in STATS.items()} if alive else {}}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def other_process_states():
+    if MULTIPROCESS_DIR is None:
+        return []
+    own_path = _state_path.get(os.getpid())
+    states = []
+    for filename in os.listdir(MULTIPROCESS_DIR):
+        path = os.path.join(MULTIPROCESS_DIR, filename)
+        if not filename.endswith(".json") or path == own_path:
+            continue
+        try:
+            with open(path) as f:
+                states.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return states
+
+
+def is_running(pid):
+    # A worker that was killed never wrote that it exited
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render_metrics():
+    return metrics.render([state["metrics"] for state in other_process_states()])
+
+
+def combined_stats(name):
+    # STATS[name] of this process added to that of every other live process. Sizes and counts are
+    # summed, limits are per process and the hit rate is recomputed from the sums.
+    stats = STATS[name]()
+    if MULTIPROCESS_DIR is None:
+        return stats
+    others = [state["stats"][name] for state in other_process_states() if name in state["stats"] and is_running(state["pid"])]
+    for other in others:
+        for key, value in other.items():
+            if key not in ("maxsize", "ttl", "hit_rate"):
+                stats[key] += value
+    answered = stats.get("hits", 0) + stats.get("coalesced", 0)
+    lookups = answered + stats.get("misses", 0)
+    stats["hit_rate"] = answered / lookups if lookups else 0.0
+    stats["workers"] = 1 + len(others)
+    return stats
+
+REQUESTS = metrics.counter("credit_service_requests_total", "Requests handled, by endpoint, method and status code.", ["endpoint", "method", "status"])
+REQUEST_ERRORS = metrics.counter("credit_service_request_errors_total", "Requests answered with a 5xx status, by endpoint.", ["endpoint"])
+REQUEST_SECONDS = metrics.histogram("credit_service_request_duration_seconds", "Time spent handling a request, by endpoint.", ["endpoint"])
+STAGE_SECONDS = metrics.histogram("credit_service_stage_duration_seconds", "Time spent in each scoring stage.", ["stage"])
+SHADOW_SCORES = metrics.counter("credit_service_shadow_scores_total", "Shadow model scores queued for the shadow log or dropped because its queue was full.", ["outcome"])
+
+# Stage names used with stage()
+DB_FETCH = "db_fetch"
+MONTHLY_STATUS = "monthly_status"
+FEATURE_EXTRACTION = "feature_extraction"
+MODEL_INFERENCE = "model_inference"
+SHADOW_INFERENCE = "shadow_inference"
+PDF_PARSING = "pdf_parsing"
+COMMIT = "commit"
+
+
+@contextmanager
+def stage(name):
+    # Times a block (or, as a decorator, every call of a function) into STAGE_SECONDS
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+
+def endpoint_label():
+    # The route pattern rather than the path, so /jobs/<job_id> is one series
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def init_app(app):
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+        endpoint = endpoint_label()
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+        if response.status_code >= 500:
+            REQUEST_ERRORS.inc(endpoint=endpoint)
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def prometheus_metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODEL_NAME = "lgb_model_v3"
+DEFAULT_MODEL_PATH = os.path.join(BASE_DIR, "lgb_model_v3.txt")
+
+# How often (in seconds) a model file is stat'ed to see whether it has been replaced
+DEFAULT_CHECK_INTERVAL = float(os.getenv("MODEL_RELOAD_CHECK_INTERVAL", "5"))
+
+# "compiled" evaluates the trees with NumPy (see tree_engine.py), "lightgbm" uses lgb.Booster
+DEFAULT_BACKEND = os.getenv("CREDIT_MODEL_BACKEND", "compiled")
+BACKENDS = ("compiled", "lightgbm")
+
+
+def load_booster(path, sha256, backend):
+    if backend == "compiled":
+        from tree_engine import load_compiled_model
+        return load_compiled_model(path, sha256)
+    if backend == "lightgbm":
+        import lightgbm as lgb
+        return lgb.Booster(model_file=path)
+    raise Exception(f"Unknown model backend {backend}")
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LoadedModel:
+    """A model file loaded into memory. A request holding a reference keeps scoring
+    with the same booster even if the registry swaps in a newer version meanwhile."""
+
+    def __init__(self, name, path, booster, sha256, mtime, backend=DEFAULT_BACKEND):
+        self.name = name
+        self.path = path
+        self.booster = booster
+        self.backend = backend
+        self.sha256 = sha256
+        self.mtime = mtime
+        self.version = f"{name}@{sha256[:12]}"
+
+    def predict(self, X):
+        return self.booster.predict(X)
+
+    def __repr__(self):
+        return f'<LoadedModel {self.version}>'
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models, shared across request threads.
+
+    Each registered model file is parsed once and reloaded only when its mtime changes
+    and its content hash differs from the one currently served."""
+
+    def __init__(self, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._backends = {}
+        self._models = {}
+        self._last_checked = {}
+        self._primary = None
+
+    def register(self, name, path, primary=False, backend=DEFAULT_BACKEND):
+        if backend not in BACKENDS:
+            raise Exception(f"Unknown model backend {backend}")
+        with self._lock:
+            self._paths[name] = path
+            self._backends[name] = backend
+            self._models.pop(name, None)
+            self._last_checked.pop(name, None)
+            if primary or self._primary is None:
+                self._primary = name
+
+    @property
+    def primary(self):
+        return self._primary
+
+    def names(self):
+        return list(self._paths)
+
+    def shadow_names(self):
+        # Every registered model but the primary one, scored alongside it (see shadow_log.py)
+        return [name for name in self._paths if name != self._primary]
+
+    def get(self, name=None):
+        name = name or self._primary
+        if name not in self._paths:
+            raise Exception(f"Model {name} is not registered")
+
+        model = self._models.get(name)
+        if model is not None and time.monotonic() - self._last_checked.get(name, 0) < self.check_interval:
+            return model
+
+        with self._lock:
+            # Another thread may have (re)loaded the model while we were waiting for the lock
+            model = self._models.get(name)
+            if model is not None and time.monotonic() - self._last_checked.get(name, 0) < self.check_interval:
+                return model
+            return self._load_if_changed(name, model)
+
+    def _load_if_changed(self, name, current):
+        path = self._paths[name]
+        self._last_checked[name] = time.monotonic()
+        try:
+            mtime = os.stat(path).st_mtime
+            if current is not None and current.mtime == mtime:
+                return current
+            sha256 = file_sha256(path)
+            if current is not None and current.sha256 == sha256:
+                current.mtime = mtime
+                return current
+            booster = load_booster(path, sha256, self._backends[name])
+        except Exception:
+            if current is None:
+                raise
+            # The file may be half-written by a deploy, keep serving the last good version
+            logger.exception("Failed to reload model %s from %s, keeping %s", name, path, current.version)
+            return current
+
+        model = LoadedModel(name, path, booster, sha256, mtime, self._backends[name])
+        self._models[name] = model
+        if current is not None:
+            logger.info("Reloaded model %s: %s -> %s", name, current.version, model.version)
+        return model
+
+    def warm_up(self):
+        return [self.get(name) for name in self.names()]
+
+
+def parse_shadow_models(value):
+    # "lgb_model_v4=/models/lgb_model_v4.txt,..." -> [(name, path)]
+    models = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, separator, path = item.partition("=")
+        if not separator or not name.strip() or not path.strip():
+            raise Exception(f"SHADOW_MODELS entries are name=path, got {item!r}")
+        models.append((name.strip(), path.strip()))
+    return models
+
+
+registry = ModelRegistry()
+registry.register(DEFAULT_MODEL_NAME, os.getenv("CREDIT_MODEL_PATH", DEFAULT_MODEL_PATH), primary=True)
+# Candidate models shadow-scored on live traffic
+for name, path in parse_shadow_models(os.getenv("SHADOW_MODELS", "")):
+    registry.register(name, path)
@@ -1,7 +1,7 @@
 import enum
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import ForeignKey, Float, Integer, String, DateTime, Enum
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from datetime import datetime
 
 db = SQLAlchemy()
@@ -22,6 +22,10 @@ class TransactionStatus(enum.Enum):
 
 class InstalmentPayment(db.Model):
     __tablename__ = 'InstalmentPayment'
+    # Matches @@index([transaction_id, status, due_date]) in schema.prisma, covers the outstanding balance and recent instalment lookups
+    __table_args__ = (
+        db.Index('InstalmentPayment_transaction_id_status_due_date_idx', 'transaction_id', 'status', 'due_date'),
+    )
     
     instalment_payment_id = db.Column(String, primary_key=True, default=db.text('gen_random_uuid()'))
     amount_due = db.Column(Float, nullable=False)
@@ -45,6 +49,9 @@ class InstalmentPayment(db.Model):
 
 class Transaction(db.Model):
     __tablename__ = 'Transaction'  # Specify the table name
+    __table_args__ = (
+        db.Index('Transaction_customer_id_idx', 'customer_id'),  # Matches @@index([customer_id]) in schema.prisma
+    )
 
     transaction_id = db.Column(db.String, primary_key=True, default=db.text('gen_random_uuid()'))  # Automatically generate a unique ID
     amount = db.Column(db.Float, nullable=False)  # Amount of the transaction
@@ -63,14 +70,31 @@ class Transaction(db.Model):
     def __repr__(self):
         return f'<Transaction {self.transaction_id} - Amount: {self.amount}>'
 
+class CustomerPaymentStatus(db.Model):
+    __tablename__ = 'CustomerPaymentStatus'
+    # Matches model CustomerPaymentStatus in schema.prisma, the roll-forward finds expired rows by valid_until
+    __table_args__ = (
+        db.Index('CustomerPaymentStatus_valid_until_idx', 'valid_until'),
+    )
+
+    # Materialised monthly payment statuses of a customer's recent instalments, see payment_status.py
+    customer_id = db.Column(db.String, db.ForeignKey('Customer.customer_id'), primary_key=True)
+    statuses = db.Column(db.String, nullable=False)  # Comma-separated worst status per month, oldest first ("" without recent instalments)
+    computed_at = db.Column(db.DateTime, nullable=False)
+    valid_until = db.Column(db.DateTime, nullable=False)  # When time alone changes the statuses (a month starts, an unpaid instalment ages, an instalment leaves the window)
+
+    def __repr__(self):
+        return f'<CustomerPaymentStatus {self.customer_id}: {self.statuses}>'
+
 class Customer(db.Model):
     __tablename__ = 'Customer'  # Specify the table name
 
     customer_id = db.Column(db.String, primary_key=True, default=db.text('gen_random_uuid()'))  # Automatically generate a unique ID
     name = db.Column(db.String, nullable=False)  # Customer's name
-    profile_picture = db.Column(db.LargeBinary)  # Profile picture stored as bytes
+    # Large or sensitive columns are only loaded when accessed, not with every Customer query
+    profile_picture = deferred(db.Column(db.LargeBinary))  # Profile picture stored as bytes
     email = db.Column(db.String, unique=True, nullable=False)  # Unique email for the customer
-    password = db.Column(db.String, nullable=False)  # Customer's password
+    password = deferred(db.Column(db.String, nullable=False))  # Customer's password
     contact_number = db.Column(db.String, nullable=False)  # Customer's contact number
     address = db.Column(db.String, nullable=False)  # Customer's address
     date_of_birth = db.Column(db.DateTime, nullable=False)  # Customer's date of birth
@@ -0,0 +1,126 @@
+"""Maintains the materialised monthly payment statuses (the CustomerPaymentStatus table) that
+scoring reads instead of recomputing them from the instalments.
+
+    python3 payment_status.py rebuild        # recompute every customer's statuses
+    python3 payment_status.py roll-forward   # recompute the statuses that time has made stale
+    python3 payment_status.py check          # compare the table with the live computation
+
+Scoring only reads the table with USE_MATERIALISED_PAYMENT_STATUS=1 (see service.py).
+
+Statuses change for two reasons. An instalment is added or paid: changes made through this
+service expire the customer's row straight away (see expire_on_instalment_change), other writers
+(the backend, through Prisma) must call POST /refresh-payment-status before the table is turned
+on. Or time passes: every row records when time alone changes it
+(an unpaid instalment is another month overdue, a month starts, an instalment leaves the 6 month
+window) and scoring never serves a row past that point. roll-forward recomputes those rows ahead
+of scoring; run it daily, which also rolls every row forward on the first of the month.
+"""
+import argparse
+import json
+import logging
+import sys
+from datetime import datetime
+from sqlalchemy import event, select, update
+from models import db, Customer, CustomerPaymentStatus, InstalmentPayment, Transaction
+from repository import get_payment_statuses, get_expired_payment_status_customer_ids
+from service import compute_payment_statuses, refresh_payment_statuses
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+# Written as valid_until to expire a row
+EXPIRED = datetime(1970, 1, 1)
+
+
+def stream_customer_id_chunks(chunk_size):
+    # Server-side cursor (on PostgreSQL) over every customer_id, on a connection of its own so the
+    # chunks can be saved while it stays open
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(
+            select(Customer.customer_id).order_by(Customer.customer_id)
+        )
+        for customer_ids in result.scalars().partitions():
+            yield list(customer_ids)
+
+
+def rebuild(db, chunk_size=DEFAULT_CHUNK_SIZE, now=None):
+    now = now or datetime.now()
+    rebuilt = 0
+    for customer_ids in stream_customer_id_chunks(chunk_size):
+        refresh_payment_statuses(db, customer_ids, now)
+        rebuilt += len(customer_ids)
+        logger.info("Rebuilt the payment statuses of %d customers", rebuilt)
+    return {"rebuilt": rebuilt}
+
+
+def roll_forward(db, chunk_size=DEFAULT_CHUNK_SIZE, now=None):
+    # Refreshed rows are valid past now, so every round takes the next expired rows
+    now = now or datetime.now()
+    refreshed = 0
+    while True:
+        customer_ids = get_expired_payment_status_customer_ids(db, now, chunk_size)
+        if not customer_ids:
+            break
+        refresh_payment_statuses(db, customer_ids, now)
+        refreshed += len(customer_ids)
+    logger.info("Rolled forward the payment statuses of %d customers", refreshed)
+    return {"refreshed": refreshed}
+
+
+def check(db, chunk_size=DEFAULT_CHUNK_SIZE, now=None, max_reported=100):
+    # Every row scoring would serve at now must equal the statuses computed from the instalments
+    now = now or datetime.now()
+    report = {"checked": 0, "missing": 0, "stale": 0, "mismatched": 0, "mismatches": []}
+    for customer_ids in stream_customer_id_chunks(chunk_size):
+        materialised = get_payment_statuses(db, customer_ids, now)
+        stored = set(db.session.scalars(select(CustomerPaymentStatus.customer_id).where(CustomerPaymentStatus.customer_id.in_(customer_ids))))
+        live = compute_payment_statuses(db, list(materialised), now)
+        for customer_id in customer_ids:
+            if customer_id not in stored:
+                report["missing"] += 1
+            elif customer_id not in materialised:
+                report["stale"] += 1
+            else:
+                report["checked"] += 1
+                if materialised[customer_id] != live[customer_id][0]:
+                    report["mismatched"] += 1
+                    if len(report["mismatches"]) < max_reported:
+                        report["mismatches"].append({"customer_id": customer_id, "materialised": materialised[customer_id], "live": live[customer_id][0]})
+    return report
+
+
+@event.listens_for(InstalmentPayment, "after_insert")
+@event.listens_for(InstalmentPayment, "after_update")
+@event.listens_for(InstalmentPayment, "after_delete")
+def expire_on_instalment_change(mapper, connection, target):
+    # Runs inside the flush, so the expiry commits (or rolls back) with the instalment change
+    connection.execute(
+        update(CustomerPaymentStatus).where(
+            CustomerPaymentStatus.customer_id == select(Transaction.customer_id).where(Transaction.transaction_id == target.transaction_id).scalar_subquery()
+        ).values(valid_until=EXPIRED)
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the materialised monthly payment statuses")
+    parser.add_argument("command", choices=["rebuild", "roll-forward", "check"])
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    from main import create_app
+    app = create_app(warm_up=False)
+    with app.app_context():
+        if args.command == "rebuild":
+            result = rebuild(db, args.chunk_size)
+        elif args.command == "roll-forward":
+            result = roll_forward(db, args.chunk_size)
+        else:
+            result = check(db, args.chunk_size)
+    print(json.dumps(result, indent=2))
+    if args.command == "check" and result["mismatched"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
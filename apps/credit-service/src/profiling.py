@@ -0,0 +1,94 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Opt-in: requests slower than this many seconds have their sampled stacks written to PROFILE_DIR.
+# Unset (the default) means requests are not sampled at all.
+PROFILE_SLOW_REQUESTS_SECONDS = os.getenv("PROFILE_SLOW_REQUESTS_SECONDS")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples one thread's Python stack every interval seconds from a background thread, or with
+    thread_id None every thread's except its own and those in exclude.
+
+    The samples are written in the folded format (one "outer;...;inner count" line per distinct
+    stack) that flamegraph.pl, speedscope and inferno read."""
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL, exclude=()):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.exclude = set(exclude)
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frames = {self.thread_id: frames.get(self.thread_id)}
+            for thread_id, frame in frames.items():
+                if thread_id == self._thread.ident or thread_id in self.exclude:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+def write_profile(sampler, name, directory=PROFILE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{re.sub(r'[^a-zA-Z0-9_-]', '_', name)}.folded")
+    with open(path, "w") as f:
+        f.write(sampler.folded())
+    return path
+
+
+def init_app(app, threshold=PROFILE_SLOW_REQUESTS_SECONDS, interval=PROFILE_INTERVAL, directory=PROFILE_DIR):
+    if threshold in (None, ""):
+        return
+    threshold = float(threshold)
+
+    @app.before_request
+    def start_sampler():
+        g.profile_start = time.perf_counter()
+        g.stack_sampler = StackSampler(threading.get_ident(), interval).start()
+
+    @app.teardown_request
+    def stop_sampler(exc):
+        sampler = g.pop("stack_sampler", None)
+        if sampler is None:
+            return
+        sampler.stop()
+        elapsed = time.perf_counter() - g.pop("profile_start")
+        if elapsed >= threshold and sampler.samples:
+            path = write_profile(sampler, request.path.strip("/") or "root", directory)
+            logger.warning("%s took %.3fs, profile written to %s", request.path, elapsed, path)
@@ -1,23 +1,36 @@
-from models import Customer, InstalmentPayment, InstalmentPaymentStatus, CreditTier
-from sqlalchemy import func
+from models import db, Customer, Transaction, InstalmentPayment, InstalmentPaymentStatus, CustomerPaymentStatus
+from credit_tiers import credit_tier_cache
+from sqlalchemy import func, select, and_, update, values, column, Integer, String, Float
+from collections import defaultdict
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from metrics import stage, COMMIT
     
+def get_customer_columns(customer_id, *columns):
+    # Reads just the given columns instead of materialising the whole Customer row
+    row = db.session.query(*columns).filter(Customer.customer_id == customer_id).first()
+    if row is None:
+        raise Exception("Customer not found")
+    return row
+
 def get_customer_credit_limit(customer_id):
-    customer = Customer.query.get(customer_id)
-    credit_tiers = CreditTier.query.filter(
-        CreditTier.min_credit_score <= customer.credit_score,
-        CreditTier.max_credit_score >= customer.credit_score
-    ).all()
-    if len(credit_tiers) > 1:
-        raise Exception("More than 1 credit tier exists in database")
-    if len(credit_tiers) == 0:
-        raise Exception("Customer credit score does not belong to any credit tier in database")
-    return credit_tiers[0].credit_limit
+    customer = get_customer_columns(customer_id, Customer.credit_score)
+    return get_credit_limit(customer.credit_score)
+
+def get_credit_limit(credit_score):
+    # Tiers are served from an in-memory index, see credit_tiers.py
+    return credit_tier_cache.get().credit_limit(credit_score)
 
 def get_credit_score_history(customer_id):
-    customer = Customer.query.get(customer_id)
-    return customer.credit_score_history
+    return get_customer_columns(customer_id, Customer.credit_score_history).credit_score_history
+
+def get_most_common_credit_score_histories(db, limit):
+    # Most shared credit score histories first, used to prewarm the feature cache
+    count = func.count(Customer.customer_id)
+    rows = db.session.query(Customer.credit_score_history, count).filter(
+        Customer.credit_score_history.isnot(None)
+    ).group_by(Customer.credit_score_history).order_by(count.desc()).limit(limit).all()
+    return [row.credit_score_history for row in rows]
 
 def get_customer_outstanding_balance(customer_id):
     today = datetime.now()
@@ -31,67 +44,258 @@ def get_customer_outstanding_balance(customer_id):
     else:
         return outstanding_balance
 
+
+def outstanding_balance_subquery(today):
+    # Unpaid instalments already due, summed per customer in the enclosing query
+    return select(func.sum(InstalmentPayment.amount_due)).join(
+        InstalmentPayment.transaction
+    ).where(
+        Transaction.customer_id == Customer.customer_id,
+        InstalmentPayment.status == InstalmentPaymentStatus.UNPAID,
+        InstalmentPayment.due_date <= today
+    ).scalar_subquery()
+
+def get_credit_snapshot(db, customer_id, now=None):
+    # Everything scoring reads about a customer in one round-trip: the customer's columns, its
+    # outstanding balance as a correlated subquery, and one row per recent instalment (a customer
+    # without any still returns a single row). The tier's credit limit comes from the tier cache.
+    today = now or datetime.now()
+    six_months_ago = today - relativedelta(months=6)
+    outstanding_balance = outstanding_balance_subquery(today)
+
+    rows = db.session.query(
+        Customer.credit_score_history,
+        Customer.credit_utilisation_ratio,
+        Customer.credit_score,
+        outstanding_balance.label("outstanding_balance"),
+        InstalmentPayment.due_date,
+        InstalmentPayment.paid_date,
+    ).select_from(Customer).outerjoin(
+        Transaction, Transaction.customer_id == Customer.customer_id
+    ).outerjoin(
+        InstalmentPayment, and_(
+            InstalmentPayment.transaction_id == Transaction.transaction_id,
+            InstalmentPayment.due_date >= six_months_ago
+        )
+    ).filter(Customer.customer_id == customer_id).all()
+
+    if len(rows) == 0:
+        raise Exception("Customer not found")
+    return {
+        "credit_score_history": rows[0].credit_score_history,
+        "credit_utilisation_ratio": rows[0].credit_utilisation_ratio,
+        "credit_limit": get_credit_limit(rows[0].credit_score),
+        "outstanding_balance": rows[0].outstanding_balance or 0,
+        "instalment_payments": [serialise(row) for row in rows if row.due_date is not None],
+    }
+
+def get_credit_snapshot_with_payment_statuses(db, customer_id, now):
+    # Same as get_credit_snapshot, with the materialised monthly payment statuses instead of the
+    # instalments: payment_statuses is None when they are missing or no longer valid at now
+    row = db.session.query(
+        Customer.credit_score_history,
+        Customer.credit_utilisation_ratio,
+        Customer.credit_score,
+        outstanding_balance_subquery(now).label("outstanding_balance"),
+        CustomerPaymentStatus.statuses,
+        CustomerPaymentStatus.valid_until,
+    ).select_from(Customer).outerjoin(
+        CustomerPaymentStatus, CustomerPaymentStatus.customer_id == Customer.customer_id
+    ).filter(Customer.customer_id == customer_id).first()
+
+    if row is None:
+        raise Exception("Customer not found")
+    payment_statuses = None
+    if row.statuses is not None and row.valid_until > now:
+        payment_statuses = parse_payment_statuses(row.statuses)
+    return {
+        "credit_score_history": row.credit_score_history,
+        "credit_utilisation_ratio": row.credit_utilisation_ratio,
+        "credit_limit": get_credit_limit(row.credit_score),
+        "outstanding_balance": row.outstanding_balance or 0,
+        "payment_statuses": payment_statuses,
+    }
+
+def get_customer_outstanding_balances(customer_ids):
+    # Outstanding balance of many customers in one grouped query, customers owing nothing are left out
+    today = datetime.now()
+    rows = db.session.query(Transaction.customer_id, func.sum(InstalmentPayment.amount_due)).join(
+        InstalmentPayment.transaction
+    ).filter(
+        InstalmentPayment.status == InstalmentPaymentStatus.UNPAID,
+        InstalmentPayment.due_date <= today,
+        Transaction.customer_id.in_(list(customer_ids))
+    ).group_by(Transaction.customer_id).all()
+    return {customer_id: outstanding_balance for customer_id, outstanding_balance in rows}
+
+def get_customers_for_scoring(customer_ids):
+    customers = db.session.query(
+        Customer.customer_id,
+        Customer.credit_score,
+        Customer.credit_score_history,
+        Customer.credit_utilisation_ratio,
+    ).filter(Customer.customer_id.in_(list(customer_ids))).all()
+    return {
+        customer.customer_id: {
+            "credit_score": customer.credit_score,
+            "credit_score_history": customer.credit_score_history,
+            "credit_utilisation_ratio": customer.credit_utilisation_ratio,
+        }
+        for customer in customers
+    }
     
-def update_customer_credit_rating(db, customer_id, credit_score):
-    customer = Customer.query.get(customer_id)
-    customer.credit_score = int(credit_score)
+# Column types of the credit fields scoring writes, used to type the VALUES list of bulk updates
+CREDIT_FIELDS = {"credit_score": Integer, "credit_score_history": String, "credit_utilisation_ratio": Float}
+BULK_UPDATE_CHUNK_SIZE = 1000
+
+def credit_values(credit_score=None, credit_score_history=None, credit_utilisation_ratio=None):
+    # The fields that were given, converted to plain Python values
+    values = {}
+    if credit_score is not None:
+        values["credit_score"] = int(credit_score)
+    if credit_score_history is not None:
+        values["credit_score_history"] = credit_score_history
+    if credit_utilisation_ratio is not None:
+        values["credit_utilisation_ratio"] = float(credit_utilisation_ratio)
+    return values
+
+@stage(COMMIT)
+def update_customer_credit(db, customer_id, credit_score=None, credit_score_history=None, credit_utilisation_ratio=None):
+    # Writes every given credit field of one customer in a single UPDATE and commit, without loading the row
+    fields = credit_values(credit_score, credit_score_history, credit_utilisation_ratio)
+    if not fields:
+        return
+    result = db.session.execute(
+        update(Customer).where(Customer.customer_id == customer_id).values(**fields).execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.session.rollback()
+        raise Exception("Customer not found")
     db.session.commit()
 
-def update_customer_credit_rating_history(db, customer_id, credit_score_history):
-    customer = Customer.query.get(customer_id)
-    customer.credit_score_history = credit_score_history
+def bulk_update_statement(fields, rows):
+    # UPDATE "Customer" SET ... FROM (VALUES ...) AS credit_updates WHERE customer_id matches, one statement for all rows
+    credit_updates = values(
+        column("customer_id", String), *[column(field, CREDIT_FIELDS[field]) for field in fields], name="credit_updates"
+    ).data([(row["customer_id"], *[row[field] for field in fields]) for row in rows])
+    return update(Customer).where(Customer.customer_id == credit_updates.c.customer_id).values(
+        {field: credit_updates.c[field] for field in fields}
+    ).execution_options(synchronize_session=False)
+
+@stage(COMMIT)
+def update_customer_credits(db, credits):
+    # credits maps customer_id to the credit fields to write (as keyword arguments of update_customer_credit).
+    # Everything is written in one transaction: on PostgreSQL as one UPDATE ... FROM VALUES per
+    # BULK_UPDATE_CHUNK_SIZE customers, elsewhere as an executemany UPDATE by primary key.
+    rows_by_fields = defaultdict(list)
+    for customer_id, fields in credits.items():
+        row = credit_values(**fields)
+        if row:
+            rows_by_fields[tuple(sorted(row))].append({"customer_id": customer_id, **row})
+
+    use_values = db.session.get_bind().dialect.name == "postgresql"
+    for fields, rows in rows_by_fields.items():
+        if use_values:
+            for i in range(0, len(rows), BULK_UPDATE_CHUNK_SIZE):
+                db.session.execute(bulk_update_statement(fields, rows[i:i + BULK_UPDATE_CHUNK_SIZE]))
+        else:
+            db.session.execute(update(Customer).execution_options(synchronize_session=False), rows)
     db.session.commit()
 
+def update_customer_credit_rating(db, customer_id, credit_score):
+    update_customer_credit(db, customer_id, credit_score=credit_score)
+
+def update_customer_credit_ratings(db, credit_scores):
+    # credit_scores maps customer_id to its new score, all written in one transaction
+    update_customer_credits(db, {customer_id: {"credit_score": credit_score} for customer_id, credit_score in credit_scores.items()})
+
+def update_customer_credit_rating_history(db, customer_id, credit_score_history):
+    update_customer_credit(db, customer_id, credit_score_history=credit_score_history)
+
 def update_customer_credit_utilisation_ratio(db, customer_id, credit_utilisation_ratio):
-    customer = Customer.query.get(customer_id)
-    customer.credit_utilisation_ratio = credit_utilisation_ratio
-    db.session.commit()
+    update_customer_credit(db, customer_id, credit_utilisation_ratio=credit_utilisation_ratio)
 
 def get_first_customer_credit_utilisation_ratio(customer_id):
-    customer = Customer.query.get(customer_id)
-    return customer.credit_utilisation_ratio
+    return get_customer_columns(customer_id, Customer.credit_utilisation_ratio).credit_utilisation_ratio
     
 def get_lowest_credit_tier(db):
-    credit_tiers = CreditTier.query.all()
-    if len(credit_tiers) == 0 :
-        raise Exception("No credit tier exists in database")
-    lowest = credit_tiers[0]
-    for credit_tier in credit_tiers:
-        if credit_tier.credit_limit < lowest.credit_limit:
-            lowest = credit_tier
-    return lowest
+    return credit_tier_cache.get().lowest_credit_tier()
 
 def get_most_recent_6_months_instalment_payments(db, customer_id):
-    try:
-        customer = Customer.query.get(customer_id)
-        instalment_payments = []
-        six_months_ago = datetime.now() - relativedelta(months=6)
-        
-        for transaction in customer.transactions:
-            # Filter instalment payments that are within the last 6 months
-            recent_payments = [
-                payment for payment in transaction.instalment_payments
-                if payment.due_date >= six_months_ago
-            ]
-            instalment_payments.extend(recent_payments)
-        return serialise(instalment_payments)
-    except Exception as e:
-        return str(e)
-
-
-def serialise(instalment_payments):
-    return [
-            {
-                "instalment_payment_id": payment.instalment_payment_id,
-                "amount_due": payment.amount_due,
-                "late_payment_amount_due": payment.late_payment_amount_due,
-                "status": payment.status.name,  # Assuming Enum has name attribute
-                "due_date": payment.due_date,
-                "paid_date": payment.paid_date,
-                "instalment_number": payment.instalment_number,
-                "amount_deducted_from_wallet": payment.amount_deducted_from_wallet,
-                "amount_discount_from_voucher": payment.amount_discount_from_voucher,
-                "amount_deducted_from_cashback_wallet": payment.amount_deducted_from_cashback_wallet,
-            }
-            for payment in instalment_payments
-        ]
\ No newline at end of file
+    # One query joining through Transaction, filtered in SQL and projected to the columns used for scoring
+    six_months_ago = datetime.now() - relativedelta(months=6)
+    rows = recent_instalment_payments_query(six_months_ago).filter(
+        Transaction.customer_id == customer_id
+    ).all()
+    return [serialise(row) for row in rows]
+
+def get_most_recent_6_months_instalment_payments_by_customer(db, customer_ids, now=None):
+    # Recent instalments of many customers in one query, grouped by customer_id
+    six_months_ago = (now or datetime.now()) - relativedelta(months=6)
+    rows = recent_instalment_payments_query(six_months_ago).filter(
+        Transaction.customer_id.in_(list(customer_ids))
+    ).all()
+    instalment_payments = {}
+    for row in rows:
+        instalment_payments.setdefault(row.customer_id, []).append(serialise(row))
+    return instalment_payments
+
+def recent_instalment_payments_query(since):
+    return db.session.query(
+        Transaction.customer_id,
+        InstalmentPayment.due_date,
+        InstalmentPayment.paid_date,
+    ).join(
+        InstalmentPayment.transaction
+    ).filter(
+        InstalmentPayment.due_date >= since
+    )
+
+
+def serialise(row):
+    return {
+        "due_date": row.due_date,
+        "paid_date": row.paid_date,
+    }
+
+
+def format_payment_statuses(statuses):
+    return ",".join(str(status) for status in statuses)
+
+def parse_payment_statuses(statuses):
+    return [int(status) for status in statuses.split(",")] if statuses else []
+
+def get_payment_statuses(db, customer_ids, now):
+    # Materialised monthly payment statuses that are still valid at now, by customer_id
+    rows = db.session.query(CustomerPaymentStatus.customer_id, CustomerPaymentStatus.statuses).filter(
+        CustomerPaymentStatus.customer_id.in_(list(customer_ids)),
+        CustomerPaymentStatus.valid_until > now,
+    ).all()
+    return {row.customer_id: parse_payment_statuses(row.statuses) for row in rows}
+
+def save_payment_statuses(db, payment_statuses, now):
+    # payment_statuses maps customer_id to (statuses, valid_until), inserted or replaced in one executemany
+    if not payment_statuses:
+        return
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise Exception(f"Saving payment statuses is not supported on {dialect}")
+    statement = insert(CustomerPaymentStatus)
+    statement = statement.on_conflict_do_update(
+        index_elements=[CustomerPaymentStatus.customer_id],
+        set_={column: statement.excluded[column] for column in ("statuses", "computed_at", "valid_until")},
+    )
+    db.session.execute(statement, [
+        {"customer_id": customer_id, "statuses": format_payment_statuses(statuses), "computed_at": now, "valid_until": valid_until}
+        for customer_id, (statuses, valid_until) in payment_statuses.items()
+    ])
+    db.session.commit()
+
+def get_expired_payment_status_customer_ids(db, now, limit):
+    return [row.customer_id for row in db.session.query(CustomerPaymentStatus.customer_id).filter(
+        CustomerPaymentStatus.valid_until <= now
+    ).order_by(CustomerPaymentStatus.valid_until).limit(limit)]
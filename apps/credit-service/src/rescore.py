@@ -0,0 +1,174 @@
+"""Rescores every ACTIVE customer, e.g. nightly once new instalments have landed.
+
+    python3 rescore.py [--chunk-size 1000] [--workers 4] [--checkpoint rescore_checkpoint.json] [--reset]
+
+Customers are streamed in customer_id order through a server-side cursor, chunk_size at a time.
+For each chunk the recent instalments and outstanding balances are read in a few queries, the
+features and scores are computed on a process pool and the scores are written back in bulk.
+After a chunk is written its last customer_id is saved to the checkpoint file, so an interrupted
+run picks up where it stopped. At most 2 chunks per worker are in flight, which bounds memory
+whatever the size of the table.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from sqlalchemy import select
+from models import db, Customer, CustomerStatus
+from repository import update_customer_credits
+from service import get_payment_histories_and_credit_utilisation_ratios, preprocess_batch, predict
+from jobs import warm_up_worker
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CHECKPOINT_PATH = os.path.join(BASE_DIR, "rescore_checkpoint.json")
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def score_chunk(payment_histories, credit_utilisation_ratios):
+    # Runs in a worker process
+    if len(payment_histories) == 0:
+        return []
+    X = preprocess_batch(credit_utilisation_ratios, payment_histories)
+    # Batch rescoring is not live traffic, so it is not shadow-scored
+    return [int(credit_score) for credit_score in predict(X, shadow_models=[])]
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, checkpoint):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def stream_customer_chunks(connection, chunk_size, after=None):
+    # Server-side cursor (on PostgreSQL) over the ACTIVE customers, chunk_size rows at a time
+    query = select(
+        Customer.customer_id,
+        Customer.credit_score,
+        Customer.credit_score_history,
+        Customer.credit_utilisation_ratio,
+    ).where(Customer.status == CustomerStatus.ACTIVE).order_by(Customer.customer_id)
+    if after is not None:
+        query = query.where(Customer.customer_id > after)
+    result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+    for rows in result.partitions():
+        yield {
+            row.customer_id: {
+                "credit_score": row.credit_score,
+                "credit_score_history": row.credit_score_history,
+                "credit_utilisation_ratio": row.credit_utilisation_ratio,
+            }
+            for row in rows
+        }
+
+
+class InlineExecutor:
+    """Runs submissions straight away, for --workers 0."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def rescore(db, chunk_size=DEFAULT_CHUNK_SIZE, workers=os.cpu_count(), checkpoint_path=DEFAULT_CHECKPOINT_PATH, reset=False):
+    checkpoint = None if reset else read_checkpoint(checkpoint_path)
+    if checkpoint is None:
+        checkpoint = {"last_customer_id": None, "scored": 0, "errors": 0, "started_at": time.time()}
+    elif checkpoint["last_customer_id"] is not None:
+        logger.info("Resuming after customer %s (%d already scored)", checkpoint["last_customer_id"], checkpoint["scored"])
+
+    if workers > 0:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=warm_up_worker)
+    else:
+        executor = InlineExecutor()
+    in_flight = deque()
+    start = time.perf_counter()
+    scored = 0
+
+    def write_oldest():
+        nonlocal scored
+        customer_ids, last_customer_id, errors, future = in_flight.popleft()
+        update_customer_credits(db, {customer_id: {"credit_score": credit_score} for customer_id, credit_score in zip(customer_ids, future.result())})
+        scored += len(customer_ids)
+        checkpoint.update(
+            last_customer_id=last_customer_id,
+            scored=checkpoint["scored"] + len(customer_ids),
+            errors=checkpoint["errors"] + errors,
+            updated_at=time.time(),
+        )
+        write_checkpoint(checkpoint_path, checkpoint)
+        elapsed = time.perf_counter() - start
+        logger.info("Scored %d customers (%d this run, %.0f customers/s), up to customer %s", checkpoint["scored"], scored, scored / elapsed if elapsed else 0, last_customer_id)
+
+    try:
+        # Streamed on a connection of its own, so the bulk writes can commit while the cursor stays open
+        with db.engine.connect() as connection:
+            for customers in stream_customer_chunks(connection, chunk_size, checkpoint["last_customer_id"]):
+                customer_ids = list(customers)
+                histories, errors = get_payment_histories_and_credit_utilisation_ratios(db, customer_ids, customers)
+                for customer_id, error in errors.items():
+                    logger.debug("Customer %s cannot be scored: %s", customer_id, error)
+                scored_ids = list(histories)
+                future = executor.submit(score_chunk, [histories[customer_id][0] for customer_id in scored_ids], [histories[customer_id][1] for customer_id in scored_ids])
+                in_flight.append((scored_ids, customer_ids[-1], len(errors), future))
+                # Chunks are written in order, so the checkpoint never skips an unwritten chunk
+                while len(in_flight) >= max(workers, 1) * 2:
+                    write_oldest()
+            while in_flight:
+                write_oldest()
+    finally:
+        executor.shutdown(wait=True)
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "scored": checkpoint["scored"],
+        "errors": checkpoint["errors"],
+        "scored_this_run": scored,
+        "seconds": elapsed,
+        "customers_per_second": scored / elapsed if elapsed else 0,
+    }
+    # A finished run starts from the beginning next time
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rescore every ACTIVE customer")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes, 0 scores in this process")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_PATH)
+    parser.add_argument("--reset", action="store_true", help="ignore the checkpoint and start from the first customer")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    from main import create_app
+    app = create_app(warm_up=False)
+    with app.app_context():
+        summary = rescore(db, args.chunk_size, args.workers, args.checkpoint, args.reset)
+    logger.info("Done: %s", json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Number of results kept (0 turns the cache off) and how long each is served, in seconds
+DEFAULT_MAXSIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+DEFAULT_TTL = float(os.getenv("RESULT_CACHE_TTL", "300"))
+
+
+class Flight:
+    """One computation in progress, which identical requests wait for instead of repeating it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ResultCache:
+    """LRU cache of what-if scoring results, each served for ttl seconds.
+
+    Keys are the normalised inputs with the model version, so a new model is never answered from
+    results of the old one. Concurrent requests for a key that is not cached are coalesced: the
+    first computes the result, the others wait for it (single flight). Failures are not cached,
+    the waiting requests get the same exception. Each worker process has a cache of its own."""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._results = OrderedDict()  # key -> (expires_at, result)
+        self._flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                if entry[0] > self.clock():
+                    self._results.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._results[key]
+                self.expirations += 1
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                flight = self._flights[key] = Flight()
+                self.misses += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = compute()
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        else:
+            with self._lock:
+                self._store(key, flight.result)
+            return flight.result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _store(self, key, result):
+        if self.maxsize <= 0:
+            return
+        self._results[key] = (self.clock() + self.ttl, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.coalesced = self.expirations = self.evictions = self.errors = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._results),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "errors": self.errors,
+            # Requests answered without a computation of their own
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+result_cache = ResultCache()
@@ -1,11 +1,23 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from models import db
-from service import get_payment_history_and_credit_utilisation_ratio, get_credit_utilisation_ratio, preprocess, predict, extract_payment_history_and_credit_utilisation_ratio_from_report, extract_payment_history_and_credit_utilisation_ratio_from_cci
-from repository import update_customer_credit_rating, get_lowest_credit_tier, update_customer_credit_rating_history, update_customer_credit_utilisation_ratio
+from service import get_payment_history_and_credit_utilisation_ratio, get_payment_histories_and_credit_utilisation_ratios, get_credit_utilisation_ratio, preprocess, preprocess_batch, predict, extract_payment_history_and_credit_utilisation_ratio_from_report, extract_payment_history_and_credit_utilisation_ratio_from_cci, simulate_payment_history_from_cci, score_cci_simulation, refresh_payment_statuses, current_model_version
+from repository import update_customer_credit, update_customer_credit_rating, update_customer_credit_ratings, get_lowest_credit_tier
+from credit_tiers import credit_tier_cache
+from cci import cci_store, BASE_DIR
+from feature_cache import feature_cache, history_key
+from result_cache import result_cache
+from jobs import job_queue, score_report, QueueFull
+from credit_report import spool_to_file, upload_sha256
+from metrics import STATS, combined_stats
+import math
 import os 
 
 bp = Blueprint('main', __name__)
 
+# Written by each server worker along with its metrics, so the stats routes cover every worker
+STATS["feature_cache"] = feature_cache.stats
+STATS["result_cache"] = result_cache.stats
+
 
 
 @bp.route("/update-credit-rating", methods=["POST"])
@@ -18,13 +30,41 @@ def update_credit_rating():
 
         payment_history , credit_utilisation_ratio= get_payment_history_and_credit_utilisation_ratio(db, customer_id) # Most recent 6 months
         # credit_utilisation_ratio = get_credit_utilisation_ratio(customer_id)
-        print("hello")
-        print(payment_history, credit_utilisation_ratio)
         X = preprocess(credit_utilisation_ratio, payment_history)
-        credit_score = predict(X)
+        credit_score, model_version = predict(X, with_version=True)
         credit_score = int(credit_score[0])
         update_customer_credit_rating(db, customer_id, credit_score)
-        return jsonify({"credit_score": credit_score}), 200
+        return jsonify({"credit_score": credit_score, "model_version": model_version}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@bp.route("/batch-update-credit-rating", methods=["POST"])
+def batch_update_credit_rating():
+    try:
+        data = request.get_json()
+        customer_ids = data.get("customer_ids")
+        if not isinstance(customer_ids, list) or len(customer_ids) == 0:
+            return jsonify({"error": "customer_ids is required"}), 401
+        customer_ids = list(dict.fromkeys(customer_ids))
+
+        # Customers that cannot be scored are reported in errors instead of failing the batch
+        histories, errors = get_payment_histories_and_credit_utilisation_ratios(db, customer_ids)
+        scored_ids = list(histories)
+        results = {}
+        model_version = None
+        if scored_ids:
+            payment_histories = [histories[customer_id][0] for customer_id in scored_ids]
+            credit_utilisation_ratios = [histories[customer_id][1] for customer_id in scored_ids]
+            X = preprocess_batch(credit_utilisation_ratios, payment_histories)
+            credit_scores, model_version = predict(X, with_version=True)
+            results = {customer_id: int(credit_score) for customer_id, credit_score in zip(scored_ids, credit_scores)}
+            update_customer_credit_ratings(db, results)
+
+        return jsonify({
+            "results": [{"customer_id": customer_id, "credit_score": credit_score} for customer_id, credit_score in results.items()],
+            "errors": [{"customer_id": customer_id, "error": error} for customer_id, error in errors.items()],
+            "model_version": model_version,
+        }), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -32,51 +72,167 @@ def update_credit_rating():
 def admin_update_credit_rating():
     try:
         data = request.get_json()
-        credit_utilisation_ratio = data.get("creditUtilisationRatio")
-        payment_history = data.get("paymentHistory")
-        X = preprocess(credit_utilisation_ratio, payment_history)
-        credit_score = int(predict(X)[0])
-        return jsonify({"credit_score": credit_score}), 200
+        # Normalised before the cache lookup, so the key and the score use the same values
+        try:
+            credit_utilisation_ratio = float(data.get("creditUtilisationRatio"))
+            payment_history = list(history_key(data.get("paymentHistory")))
+            if not all(isinstance(status, float) for status in payment_history):
+                raise ValueError("paymentHistory is nested")
+            # NaN never equals itself, so its cache entry could never be hit
+            if not math.isfinite(credit_utilisation_ratio) or len(payment_history) == 0 or not all(map(math.isfinite, payment_history)):
+                raise ValueError("creditUtilisationRatio or paymentHistory is out of range")
+        except (TypeError, ValueError):
+            return jsonify({"error": "creditUtilisationRatio must be a finite number and paymentHistory a non-empty list of finite numbers"}), 400
+
+        def score():
+            X = preprocess(credit_utilisation_ratio, payment_history)
+            credit_score, model_version = predict(X, with_version=True)
+            return {"credit_score": int(credit_score[0]), "model_version": model_version}
+        # A what-if score only depends on its inputs and the model, repeated ones come from the result cache
+        key = ("admin-update-credit-rating", current_model_version(), credit_utilisation_ratio, tuple(payment_history))
+        return jsonify(result_cache.get_or_compute(key, score)), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@bp.route("/invalidate-credit-tiers", methods=["POST"])
+def invalidate_credit_tiers():
+    # Called after credit tiers are edited elsewhere so the next score reads them again
+    credit_tier_cache.invalidate()
+    return jsonify({"message": "Credit tiers will be reloaded on the next request"}), 200
+
+@bp.route("/refresh-payment-status", methods=["POST"])
+def refresh_payment_status():
+    # Called when instalments are paid or added elsewhere, so scoring does not wait for the roll-forward
+    try:
+        customer_ids = request.get_json().get("customer_ids")
+        if not isinstance(customer_ids, list) or len(customer_ids) == 0:
+            return jsonify({"error": "customer_ids is required"}), 401
+        payment_statuses = refresh_payment_statuses(db, list(dict.fromkeys(customer_ids)))
+        return jsonify({"payment_statuses": {customer_id: statuses for customer_id, (statuses, _) in payment_statuses.items()}}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@bp.route("/feature-cache-stats", methods=["GET"])
+def feature_cache_stats():
+    # Summed over every server worker, see metrics.combined_stats
+    return jsonify(combined_stats("feature_cache")), 200
+
+@bp.route("/result-cache-stats", methods=["GET"])
+def result_cache_stats():
+    return jsonify(combined_stats("result_cache")), 200
+
 @bp.route("/upload-cci", methods=["POST"])
 def upload_cci():
     try:
         files = request.files['file']
-        file_path = os.path.join("../", files.filename)
-        files.save(file_path)
-        return jsonify({"message": files.filename + " uploaded successfully"}), 200
+        content = files.read()
+        # Parse the delinquency table now so scoring never has to open the PDF
+        cci = cci_store.add(content, files.filename)
+        file_path = os.path.join(BASE_DIR, files.filename)
+        with open(file_path, "wb") as f:
+            f.write(content)
+        return jsonify({"message": files.filename + " uploaded successfully", "version": cci["version"]}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+# Upper bound on simulation_samples so one request cannot tie up a worker
+MAX_CCI_SIMULATION_SAMPLES = int(os.getenv("MAX_CCI_SIMULATION_SAMPLES", "100000"))
+
+def get_cci_simulation_params(data):
+    # Optional simulation_samples (and seed) form fields turn on Monte Carlo scoring of the CCI
+    n_samples = data.get("simulation_samples")
+    if n_samples in (None, ""):
+        return None
+    n_samples = int(n_samples)
+    if n_samples < 1 or n_samples > MAX_CCI_SIMULATION_SAMPLES:
+        raise ValueError(f"simulation_samples must be between 1 and {MAX_CCI_SIMULATION_SAMPLES}")
+    seed = data.get("seed")
+    return n_samples, int(seed) if seed not in (None, "") else None
+
+def simulation_summary(simulation):
+    return {key: simulation[key] for key in ("mean", "quantiles", "n_samples", "seed")}
+
+def save_first_credit_rating(db, customer_id, payment_history, credit_utilisation_ratio, credit_rating):
+    # One UPDATE and commit for all three fields
+    update_customer_credit(db, customer_id,
+        credit_score=credit_rating,
+        credit_score_history=",".join(map(str, payment_history)),
+        credit_utilisation_ratio=credit_utilisation_ratio,
+    )
+
+def is_async(data):
+    # async=true on a report upload returns a job id straight away instead of the score, see /jobs/<job_id>
+    return str(data.get("async", "")).lower() in ("1", "true")
+
+def uploaded_report():
+    # The report is the last uploaded file, whatever its field name, None without one
+    files = list(request.files.values())
+    return files[-1] if files else None
+
+def submit_report_job(kind, on_done=None):
+    # The worker reads the spooled report from disk and removes it
+    report = uploaded_report()
+    if report is None:
+        return jsonify({"error": "report is required"}), 400
+    path = spool_to_file(report)
+    try:
+        job = job_queue.submit(kind, score_report, path, True, on_done=on_done)
+    except QueueFull as e:
+        os.remove(path)
+        return jsonify({"error": str(e)}), 429, {"Retry-After": "1"}
+    except Exception:
+        os.remove(path)
+        raise
+    return jsonify({"job_id": job["job_id"], "status": job["status"]}), 202
+
+@bp.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
 @bp.route("/get-first-credit-rating", methods=["POST"])
 def get_first_credit_rating():
     credit_rating = 0
+    try:
+        simulation_params = get_cci_simulation_params(request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     try:
         data = request.form
         customer_id = data.get("customer_id")
         if customer_id == "" or customer_id is None:
             return jsonify({"error": "customer_id is required"}), 401
 
+        if len(request.files) > 0 and is_async(data):
+            app = current_app._get_current_object()
+
+            def save(result):
+                with app.app_context():
+                    save_first_credit_rating(db, customer_id, result["payment_history"], result["credit_utilisation_ratio"], result["credit_score"])
+            return submit_report_job("first-credit-rating", on_done=save)
+
         payment_history = []
         credit_utilisation_ratio = 0
+        simulation = None
 
         # Check if user past payment history is provided
         if len(request.files)==0:
-            containsCCI = False
-            file_path = "../"
-            for filename in os.listdir("../"):
-                if "CONSUMER-CREDIT-INDEX" in filename:
-                    file_path += filename
-                    containsCCI =  True
-            if not containsCCI:
+            # Parsed once when it was uploaded, no PDF is opened here
+            cci = cci_store.latest()
+            if cci is None:
                 return jsonify({"error": "No Consumer Credit Index found"}), 400
             
-            payment_history , credit_utilisation_ratio = extract_payment_history_and_credit_utilisation_ratio_from_cci(file_path) # Most recent 6 months
-            X = preprocess(credit_utilisation_ratio, payment_history)
-            credit_rating = predict(X)
+            if simulation_params:
+                simulation = score_cci_simulation(cci["average_delinquency"], *simulation_params)
+                payment_history, credit_utilisation_ratio = simulation["payment_history"], simulation["credit_utilisation_ratio"]
+                credit_rating, model_version = [simulation["mean"]], simulation["model_version"]
+            else:
+                payment_history , credit_utilisation_ratio = simulate_payment_history_from_cci(cci["average_delinquency"]) # Most recent 6 months
+                X = preprocess(credit_utilisation_ratio, payment_history)
+                credit_rating, model_version = predict(X, with_version=True)
             credit_tier = get_lowest_credit_tier(db)
             # credit_rating = min(credit_rating[0],credit_tier.max_credit_score)
             if credit_rating[0] > credit_tier.max_credit_score:
@@ -86,16 +242,17 @@ def get_first_credit_rating():
                 credit_rating = credit_rating[0]
 
         else:
-            for file in request.files.values():
-                payment_history,  credit_utilisation_ratio = extract_payment_history_and_credit_utilisation_ratio_from_report(file) # Most recent 6 months
+            payment_history,  credit_utilisation_ratio = extract_payment_history_and_credit_utilisation_ratio_from_report(uploaded_report()) # Most recent 6 months
             X = preprocess(credit_utilisation_ratio, payment_history)
-            credit_rating = predict(X)[0]
+            credit_rating, model_version = predict(X, with_version=True)
+            credit_rating = credit_rating[0]
 
-        update_customer_credit_rating_history(db, customer_id,",".join(map(str, payment_history)))
-        update_customer_credit_utilisation_ratio(db, customer_id,credit_utilisation_ratio)
-        update_customer_credit_rating(db, customer_id, credit_rating)
+        save_first_credit_rating(db, customer_id, payment_history, credit_utilisation_ratio, credit_rating)
        
-        return jsonify({"credit_score": int(credit_rating)}), 200
+        response = {"credit_score": int(credit_rating), "model_version": model_version}
+        if simulation:
+            response["simulation"] = simulation_summary(simulation)
+        return jsonify(response), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -103,30 +260,47 @@ def get_first_credit_rating():
 def get_admin_credit_rating():
     credit_rating = 0
     try:
+        simulation_params = get_cci_simulation_params(request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        if len(request.files) > 0 and is_async(request.form):
+            return submit_report_job("admin-credit-rating")
+
         payment_history = []
         credit_utilisation_ratio = 0
+        simulation = None
 
         # Check if user past payment history is provided
         if len(request.files)==0:
-            containsCCI = False
-            file_path = "../"
-            for filename in os.listdir("../"):
-                if "CONSUMER-CREDIT-INDEX" in filename:
-                    file_path += filename
-                    containsCCI =  True
-            if not containsCCI:
+            # Parsed once when it was uploaded, no PDF is opened here
+            cci = cci_store.latest()
+            if cci is None:
                 return jsonify({"error": "No Consumer Credit Index found"}), 400
             
-            payment_history , credit_utilisation_ratio = extract_payment_history_and_credit_utilisation_ratio_from_cci(file_path) # Most recent 6 months
-            X = preprocess(credit_utilisation_ratio, payment_history)
-            credit_rating = predict(X)
+            if simulation_params:
+                simulation = score_cci_simulation(cci["average_delinquency"], *simulation_params)
+                credit_rating, model_version = [simulation["mean"]], simulation["model_version"]
+            else:
+                payment_history , credit_utilisation_ratio = simulate_payment_history_from_cci(cci["average_delinquency"]) # Most recent 6 months
+                X = preprocess(credit_utilisation_ratio, payment_history)
+                credit_rating, model_version = predict(X, with_version=True)
             credit_tier = get_lowest_credit_tier(db)
             credit_rating = min(credit_rating[0],credit_tier.max_credit_score)
         else:
-            for file in request.files.values():
-                payment_history,  credit_utilisation_ratio = extract_payment_history_and_credit_utilisation_ratio_from_report(file) # Most recent 6 months
-            X = preprocess(credit_utilisation_ratio, payment_history)
-            credit_rating = predict(X)[0]
-        return jsonify({"credit_score": int(credit_rating)}), 200
+            report = uploaded_report()
+
+            def score_uploaded_report():
+                payment_history,  credit_utilisation_ratio = extract_payment_history_and_credit_utilisation_ratio_from_report(report) # Most recent 6 months
+                X = preprocess(credit_utilisation_ratio, payment_history)
+                credit_rating, model_version = predict(X, with_version=True)
+                return {"credit_score": int(credit_rating[0]), "model_version": model_version}
+            # The same report always scores the same, so it is cached by its content hash
+            key = ("get-admin-credit-rating", current_model_version(), upload_sha256(report))
+            return jsonify(result_cache.get_or_compute(key, score_uploaded_report)), 200
+        response = {"credit_score": int(credit_rating), "model_version": model_version}
+        if simulation:
+            response["simulation"] = simulation_summary(simulation)
+        return jsonify(response), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
\ No newline at end of file
@@ -0,0 +1,381 @@
+"""Production server: a master process that loads the app once and forks the workers serving it.
+
+    python3 server.py [--host 0.0.0.0] [--port 5000] [--workers 4]
+
+The master builds the app with create_app, which loads the model, parses the feature spec and
+prewarms the feature cache, and loads the credit tiers and the Consumer Credit Index. Then it
+freezes the garbage collector and forks the workers. The workers share all of that memory
+copy-on-write instead of each loading a copy, so adding workers adds little more than their
+request-handling memory. Each worker opens its own database connections (see
+main.engine_options) and handles one request at a time from the shared listening socket.
+
+Workers do not reload the model: that would give each a private copy. The master checks the model
+file instead (every MODEL_RELOAD_CHECK_INTERVAL seconds, see model_registry.py). When a new
+version loads, it replaces the workers one at a time: a new worker is forked with the new model,
+then an old one finishes its request and exits. The same goes for the shadow models (see
+shadow_log.py).
+
+Signals to the master:
+    SIGTERM, SIGINT  workers finish the request they are handling, then everything exits
+    SIGHUP           replace every worker, one at a time
+    SIGUSR1          log each worker's memory (RSS, PSS and private)
+    SIGUSR2          invalidate the credit tier cache of every worker
+
+SERVER_MAX_REQUESTS replaces a worker after that many requests (0, the default, never).
+
+Any worker may answer any request, so state the app keeps per process must be shared:
+    jobs      a job is polled from any worker, so the in-memory job store (JOB_QUEUE_BACKEND=memory,
+              the default) is replaced by the file store in JOB_DIR when there is more than one
+              worker. A stopping worker waits for the jobs it is running.
+    credit tiers  a worker that invalidates its tier cache (/invalidate-credit-tiers, or a tier
+              edit it committed) sends SIGUSR2 to the master, which passes it on to every worker:
+              all of them reload the tiers within about a second.
+    metrics   each worker writes its metrics and cache stats to METRICS_MULTIPROC_DIR (a temporary
+              directory by default) every METRICS_WRITE_INTERVAL seconds. /metrics,
+              /feature-cache-stats and /result-cache-stats add up those of every worker, so they
+              may lag the other workers by that interval.
+"""
+import argparse
+import gc
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", str(os.cpu_count() or 1)))
+SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", "0"))
+# Seconds a stopping worker has to finish its request before it is killed
+SERVER_GRACEFUL_TIMEOUT = float(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+# How often the master checks on its workers and the model file
+POLL_INTERVAL = 0.5
+# Where and how often each worker writes its metrics for the others (see metrics.py)
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+METRICS_WRITE_INTERVAL = float(os.getenv("METRICS_WRITE_INTERVAL", "1"))
+# A worker that exits sooner than this after starting is respawned after a pause, not in a loop
+MIN_WORKER_LIFETIME = 1.0
+
+
+def listen(host, port, backlog=SERVER_BACKLOG):
+    # Non-blocking, so a worker that loses the race for a connection goes back to waiting
+    # (and can notice it is asked to stop) instead of blocking in accept
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def preload(app):
+    # Everything the workers should share, loaded before they are forked
+    from models import db
+    from credit_tiers import credit_tier_cache
+    from cci import cci_store
+    with app.app_context():
+        for name, load in (("credit tiers", credit_tier_cache.get), ("Consumer Credit Index", cci_store.latest)):
+            try:
+                load()
+            except Exception as e:
+                logger.warning("Could not preload the %s: %s", name, e)
+        # Connections must not be shared with the workers, each opens its own
+        db.engine.dispose()
+
+
+def share_job_store(workers):
+    # Jobs kept in one worker's memory would be "not found" when polled from the others
+    from jobs import job_queue, MemoryJobStore, FileJobStore, JOB_DIR
+    if workers > 1 and isinstance(job_queue.store, MemoryJobStore):
+        logger.warning("The memory job store is not shared between workers, using the file store in %s", JOB_DIR)
+        job_queue.store = FileJobStore(JOB_DIR)
+
+
+def memory_usage(pid):
+    # {"rss": ..., "pss": ..., "private": ...} in bytes from /proc (Linux), {} elsewhere.
+    # PSS counts shared pages divided by the number of processes sharing them.
+    fields = {"Rss": "rss", "Pss": "pss", "Private_Clean": "private", "Private_Dirty": "private"}
+    usage = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in fields:
+                    usage[fields[name]] = usage.get(fields[name], 0) + int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return usage
+
+
+def run_worker(app, sock, max_requests=SERVER_MAX_REQUESTS):
+    # Runs in a forked worker until SIGTERM or max_requests, returns the exit code
+    from models import db
+    from model_registry import registry as model_registry
+    from shadow_log import shadow_log
+    from jobs import job_queue
+    from credit_tiers import credit_tier_cache
+    import metrics
+    from feature_cache import feature_cache
+    from result_cache import result_cache
+    stopping = False
+    tiers_invalidated = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    def invalidate_tiers(signum, frame):
+        # Handled between requests: the handler may interrupt a thread holding the cache's lock
+        nonlocal tiers_invalidated
+        tiers_invalidated = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGUSR2, invalidate_tiers)
+    # Ctrl-C reaches the whole process group, the master stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    master = os.getppid()
+    credit_tier_cache.listeners.append(lambda: os.kill(master, signal.SIGUSR2))
+    gc.enable()
+    # Forked workers would otherwise all draw the same random numbers
+    random.seed()
+    model_registry.check_interval = float("inf")
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    handled = 0
+
+    def counted(environ, start_response):
+        nonlocal handled
+        handled += 1
+        return app(environ, start_response)
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, counted, fd=sock.fileno())
+    server.timeout = POLL_INTERVAL
+    multiprocess = metrics.MULTIPROCESS_DIR is not None
+    if multiprocess:
+        # The master wrote what it counted before forking, it must not be counted again per worker.
+        # The caches' contents are kept, only their counters start over.
+        metrics.metrics.reset()
+        feature_cache.reset_stats()
+        result_cache.reset_stats()
+    written_at = 0
+    try:
+        while not stopping and not (max_requests and handled >= max_requests):
+            if multiprocess and time.monotonic() - written_at >= METRICS_WRITE_INTERVAL:
+                metrics.write_process_state()
+                written_at = time.monotonic()
+            server.handle_request()
+            if tiers_invalidated:
+                tiers_invalidated = False
+                credit_tier_cache.invalidate(notify=False)
+    finally:
+        server.server_close()
+        if multiprocess:
+            # Its counters still count, its caches are gone
+            metrics.write_process_state(alive=False)
+        # Finishes the jobs this worker started and writes the shadow scores still queued
+        job_queue.shutdown(wait=True)
+        shadow_log.close()
+    return 0
+
+
+class Master:
+    """Forks and watches the workers, see the module docstring."""
+
+    def __init__(self, app, sock, workers=SERVER_WORKERS, max_requests=SERVER_MAX_REQUESTS, graceful_timeout=SERVER_GRACEFUL_TIMEOUT):
+        from model_registry import registry as model_registry
+        self.app = app
+        self.sock = sock
+        self.n_workers = workers
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.model_registry = model_registry
+        self.model_version = self.current_model_version()
+        self.workers = {}  # pid -> {"model_version": ..., "started_at": ...}
+        self.stopping = False
+        self.recycle_requested = False
+        self.memory_requested = False
+        self.tiers_invalidated = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = run_worker(self.app, self.sock, self.max_requests)
+            except BaseException:
+                logger.exception("Worker %d failed", os.getpid())
+            finally:
+                os._exit(code)
+        self.workers[pid] = {"model_version": self.model_version, "started_at": time.monotonic()}
+        logger.info("Started worker %d (%s)", pid, self.model_version)
+        return pid
+
+    def handle_signal(self, signum, frame):
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            self.stopping = True
+        elif signum == signal.SIGHUP:
+            self.recycle_requested = True
+        elif signum == signal.SIGUSR1:
+            self.memory_requested = True
+        elif signum == signal.SIGUSR2:
+            self.tiers_invalidated = True
+
+    def reap(self):
+        # Collects exited workers and, unless stopping, replaces them
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None or self.stopping:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0:
+                logger.warning("Worker %d exited with %d", pid, code)
+            if time.monotonic() - worker["started_at"] < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            self.spawn()
+
+    def terminate(self, pid):
+        # Asks a worker to finish its request and exit, kills it after graceful_timeout
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.monotonic() + self.graceful_timeout
+        while True:
+            try:
+                exited, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if exited:
+                break
+            if time.monotonic() > deadline:
+                logger.warning("Worker %d did not stop in %ss, killing it", pid, self.graceful_timeout)
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                break
+            time.sleep(0.05)
+        self.workers.pop(pid, None)
+
+    def recycle(self, outdated_only=False):
+        # One worker at a time, the replacement starts before the old worker stops
+        for pid in list(self.workers):
+            if self.stopping:
+                return
+            if outdated_only and self.workers.get(pid, {}).get("model_version") == self.model_version:
+                continue
+            self.spawn()
+            self.terminate(pid)
+
+    def current_model_version(self):
+        # The primary model followed by the shadow models, so updating any of them replaces the workers
+        return ",".join(model.version for model in self.model_registry.warm_up())
+
+    def check_model(self):
+        # The registry reloads the model files in the master when they have changed
+        version = self.current_model_version()
+        if version == self.model_version:
+            return
+        logger.info("Model updated to %s, replacing the workers", version)
+        self.model_version = version
+        gc.collect()
+        gc.freeze()
+        self.recycle(outdated_only=True)
+
+    def invalidate_tiers(self):
+        # Workers forked from now on must not inherit the preloaded tiers either
+        from credit_tiers import credit_tier_cache
+        credit_tier_cache.invalidate(notify=False)
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGUSR2)
+            except ProcessLookupError:
+                pass
+
+    def log_memory(self):
+        for pid in self.workers:
+            usage = memory_usage(pid)
+            logger.info("Worker %d: RSS %.1f MiB, PSS %.1f MiB, private %.1f MiB", pid,
+                        usage.get("rss", 0) / 2**20, usage.get("pss", 0) / 2**20, usage.get("private", 0) / 2**20)
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+            signal.signal(signum, self.handle_signal)
+        # Objects loaded so far are never collected, so collections in the workers do not write to
+        # (and unshare) their pages
+        gc.collect()
+        gc.freeze()
+        for _ in range(self.n_workers):
+            self.spawn()
+        while not self.stopping:
+            self.reap()
+            self.check_model()
+            if self.recycle_requested:
+                self.recycle_requested = False
+                self.recycle()
+            if self.memory_requested:
+                self.memory_requested = False
+                self.log_memory()
+            if self.tiers_invalidated:
+                self.tiers_invalidated = False
+                self.invalidate_tiers()
+            time.sleep(POLL_INTERVAL)
+
+        logger.info("Stopping %d workers", len(self.workers))
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.workers):
+            self.terminate(pid)
+        self.sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the credit service with pre-forked workers")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVER_PORT", "5000")))
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--max-requests", type=int, default=SERVER_MAX_REQUESTS, help="replace a worker after this many requests, 0 never")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(process)d %(levelname)s %(message)s")
+
+    from main import create_app
+    import metrics
+    sock = listen(args.host, args.port)
+    share_job_store(args.workers)
+    metrics_dir = METRICS_MULTIPROC_DIR or tempfile.mkdtemp(prefix="credit-service-metrics-")
+    # Values left by a previous run would be added to this one's
+    for filename in os.listdir(metrics_dir) if os.path.isdir(metrics_dir) else []:
+        if filename.endswith(".json"):
+            os.remove(os.path.join(metrics_dir, filename))
+    metrics.enable_multiprocess(metrics_dir)
+    app = create_app()
+    preload(app)
+    # What the start-up counted, e.g. the warm-up's scoring stages
+    metrics.write_process_state(alive=False)
+    logger.info("Listening on %s:%d with %d workers", args.host, sock.getsockname()[1], args.workers)
+    try:
+        Master(app, sock, args.workers, args.max_requests).run()
+    finally:
+        if METRICS_MULTIPROC_DIR is None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,72 @@
-import pandas as pd
+import logging
+import numpy as np
+import os
 import re
-from tsfresh import extract_features
-from tsfresh.utilities.dataframe_functions import impute
 from collections import defaultdict
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-import lightgbm as lgb
-import fitz 
-import re
-from repository import get_most_recent_6_months_instalment_payments, update_customer_credit_rating, get_customer_credit_limit, get_customer_outstanding_balance, get_credit_score_history, get_first_customer_credit_utilisation_ratio
-import pdfplumber
+from flask import has_request_context
+from repository import get_most_recent_6_months_instalment_payments, update_customer_credit_rating, get_customer_credit_limit, get_customer_outstanding_balance, get_credit_score_history, get_first_customer_credit_utilisation_ratio, get_customers_for_scoring, get_most_recent_6_months_instalment_payments_by_customer, get_customer_outstanding_balances, get_credit_limit, get_credit_snapshot, get_most_common_credit_score_histories, get_credit_snapshot_with_payment_statuses, get_payment_statuses, save_payment_statuses
 import random
-
-def predict(X):
-    # Load the trained LightGBM model
-    model = lgb.Booster(model_file='../lgb_model_v3.txt') 
-    default_likelihood = model.predict(X)
-    credit_rating = (1-default_likelihood) * 1000
+from model_registry import registry as model_registry
+from features import get_feature_spec, RELEVANT_FEATURES_PATH
+from feature_matrix import compute_feature_matrix, get_batch_plan
+from status_matrix import compute_status_matrix, status_lists
+from cci import parse_cci_delinquency
+from credit_report import read_credit_report
+from feature_cache import feature_cache
+from metrics import stage, endpoint_label, DB_FETCH, MONTHLY_STATUS, FEATURE_EXTRACTION, MODEL_INFERENCE, SHADOW_INFERENCE
+from shadow_log import shadow_log
+
+logger = logging.getLogger(__name__)
+
+# pandas, tsfresh and fitz are imported inside the functions that use them, so importing the
+# service (and starting a worker) does not pay for them up front
+
+# Compute features with tsfresh's calculators (features.FeatureSpec) instead of the NumPy port
+USE_TSFRESH_FEATURES = os.getenv("USE_TSFRESH_FEATURES", "0") == "1"
+# Read monthly payment statuses from the CustomerPaymentStatus table (see payment_status.py)
+# instead of computing them from the instalments on every score. Off by default: the backend
+# creates and pays instalments without going through this service, so turn it on only once every
+# such write also calls /refresh-payment-status, or scores mix fresh balances with stale statuses.
+USE_MATERIALISED_PAYMENT_STATUS = os.getenv("USE_MATERIALISED_PAYMENT_STATUS", "0") == "1"
+
+def predict(X, with_version=False, shadow_models=None):
+    # The trained LightGBM model is loaded once per process and shared across requests
+    with stage(MODEL_INFERENCE):
+        model = model_registry.get()
+        default_likelihood = model.predict(X)
+        credit_rating = (1-default_likelihood) * 1000
+    # The same feature matrix is scored by each shadow model (every other registered model unless
+    # shadow_models names them) and logged in the background, see shadow_log.py. Only the primary
+    # score is returned, and a shadow model that fails is skipped.
+    shadow_models = model_registry.shadow_names() if shadow_models is None else shadow_models
+    if shadow_models:
+        shadow_ratings = {}
+        with stage(SHADOW_INFERENCE):
+            for name in shadow_models:
+                try:
+                    shadow_model = model_registry.get(name)
+                    shadow_ratings[shadow_model.version] = (1-shadow_model.predict(X)) * 1000
+                except Exception:
+                    logger.exception("Shadow model %s could not score", name)
+        endpoint = endpoint_label() if has_request_context() else ""
+        shadow_log.append(model.version, credit_rating, shadow_ratings, endpoint)
+    if with_version:
+        return credit_rating, model.version
     return credit_rating
 
+def current_model_version():
+    # Version predict would score with now, used to tag cached results
+    return model_registry.get().version
+
+def warm_up():
+    # One-off costs paid before the first request: loading (or compiling) the model, parsing the
+    # feature spec and running a first prediction, which imports pandas and touches every code path
+    model_registry.warm_up()
+    get_batch_plan()
+    predict(preprocess(0, [-1] * 6), shadow_models=[])
+
 def map_payment_status(payment_status):
     status_mapping = {
         'A': -1,  # on time (0 or 1 Payment Overdue Cycle)
@@ -36,56 +84,72 @@ def map_payment_status(payment_status):
     }
     return [status_mapping[status] for status in payment_status]
 
+AVERAGE_CREDIT_UTILISATION_RATIO = 2.3217
+
 def extract_payment_history_and_credit_utilisation_ratio_from_cci(file):
-    AVERAGE_CREDIT_UTILISATION_RATIO = 2.3217
+    return simulate_payment_history_from_cci(parse_cci_delinquency(file)["average_delinquency"])
+
+def simulate_payment_history_from_cci(average_delinquency_per_month):
+    # One simulated customer: defaults in a month with that month's average delinquency rate
     payment_history = []
-    # balance = 0
-    # credit_limit = 10
+    for avg_delinquency in average_delinquency_per_month:
+        # print(f"{month}: {avg_delinquency:.2f}%")
+        
+        random_float = random.random()
 
-    pdf_document = fitz.open(file, filetype="pdf")
+        status = get_status_this_month(payment_history, len(payment_history), 0, random_float < avg_delinquency/100)
+        payment_history.append(status)
     
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document[page_num]
-        text = page.get_text()
-        start_section = ["Unsecured Credit Card by Age Groups", "Delinquency"]
-        if all(substring in text for substring in start_section):
-            lines = text.strip().split('\n')
-            COLS = 8
-            ROWS = 6
-            recent_6_months = lines[-COLS*(ROWS+1):-COLS]
-
-            months = []
-            delinquency_data = []
-
-            for i in range(0, len(recent_6_months), COLS):  # 8 elements per month (1 month + 7 delinquency rates)
-                month = recent_6_months[i].strip()
-                delinquency_rates = [float(x.strip().strip('%')) for x in recent_6_months[i+1:i+COLS]]  # Convert to float and remove '%'
-                months.append(month)
-                delinquency_data.append(delinquency_rates)
-
-            # Calculate the average delinquency for each month
-            average_delinquency_per_month = [sum(month_data) / len(month_data) for month_data in delinquency_data]
-
-            for avg_delinquency in average_delinquency_per_month:
-                # print(f"{month}: {avg_delinquency:.2f}%")
-                
-                random_float = random.random()
-                print(random_float, avg_delinquency/100, random_float < avg_delinquency/100)
-    
-                status = get_status_this_month(payment_history, len(payment_history), 0, random_float < avg_delinquency/100)
-                payment_history.append(status)
-            
-            # Convert months that only defaulted by 1 month to -1, so that it is consistent with CBS report
-            for i, status in enumerate(payment_history):
-                if status == 1:
-                    payment_history[i] = -1
-            
-
-    pdf_document.close()
+    # Convert months that only defaulted by 1 month to -1, so that it is consistent with CBS report
+    for i, status in enumerate(payment_history):
+        if status == 1:
+            payment_history[i] = -1
 
-        
     return payment_history, AVERAGE_CREDIT_UTILISATION_RATIO
 
+CCI_SIMULATION_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+def simulate_payment_histories_from_cci(average_delinquency_per_month, n_samples, rng=None):
+    # n_samples runs of simulate_payment_history_from_cci at once, one simulated customer per row
+    rng = rng if rng is not None else np.random.default_rng()
+    default_probability = np.asarray(average_delinquency_per_month, dtype=float) / 100
+    defaults = rng.random((n_samples, len(default_probability))) < default_probability
+    return payment_histories_from_defaults(defaults)
+
+def payment_histories_from_defaults(defaults):
+    # Same statuses as get_status_this_month, with the run of consecutive defaults carried forward
+    # month by month instead of recounted recursively
+    payment_histories = np.full(defaults.shape, -1)
+    run_length = np.zeros(len(defaults), dtype=int)
+    for month in range(defaults.shape[1]):
+        run_length = np.where(defaults[:, month], run_length + 1, 0)
+        payment_histories[:, month] = np.where(defaults[:, month], np.minimum(run_length, 6), -1)
+    # Convert months that only defaulted by 1 month to -1, so that it is consistent with CBS report
+    payment_histories[payment_histories == 1] = -1
+    return payment_histories
+
+def score_cci_simulation(average_delinquency_per_month, n_samples, seed=None):
+    # Expected first credit score of a customer behaving like the CCI population, estimated over
+    # n_samples simulated histories instead of a single draw
+    payment_histories = simulate_payment_histories_from_cci(average_delinquency_per_month, n_samples, np.random.default_rng(seed))
+
+    # There are at most 2^6 distinct histories, so each one is featurised and scored only once
+    unique_histories, inverse, counts = np.unique(payment_histories, axis=0, return_inverse=True, return_counts=True)
+    X = preprocess_batch(np.full(len(unique_histories), AVERAGE_CREDIT_UTILISATION_RATIO), unique_histories)
+    unique_credit_ratings, model_version = predict(X, with_version=True, shadow_models=[])
+    credit_ratings = unique_credit_ratings[inverse.reshape(-1)]
+
+    return {
+        "mean": float(np.mean(credit_ratings)),
+        "quantiles": {str(q): float(np.quantile(credit_ratings, q)) for q in CCI_SIMULATION_QUANTILES},
+        "n_samples": n_samples,
+        "seed": seed,
+        # The most frequently simulated history, stored as the customer's credit score history
+        "payment_history": unique_histories[np.argmax(counts)].tolist(),
+        "credit_utilisation_ratio": AVERAGE_CREDIT_UTILISATION_RATIO,
+        "model_version": model_version,
+    }
+
 def get_status_this_month(payment_history, idx, defaulted_months, hasDefaultThisMonth):
     
     # Base case: if the customer didn't default this month, return -1
@@ -114,59 +178,9 @@ def get_status_this_month(payment_history, idx, defaulted_months, hasDefaultThis
 
     
 def extract_payment_history_and_credit_utilisation_ratio_from_report(file):
-    payment_history = [0]
-    balance = 0
-    credit_limit = 10
-
-    # Load the PDF file
-    pdf_document = fitz.open(stream=file.read(), filetype="pdf")
-    
-
-    # Iterate through each page to find the status section
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document[page_num]
-        text = page.get_text()
-
-
-        start_section = ["Unsecured Credit Card", "Account Status History"]
-        end_section = "HDB Loan" 
-
-        # Check if the section we want is in this page
-        if all(substring in text for substring in start_section):
-            
-            # Extract the part of the text between start_section and end_section
-            section_start = text.find(start_section[0])
-            section_end = text.find(end_section, section_start)
-            relevant_text = text[section_start:section_end].strip()
-            
-            status_sequences = re.findall(r'[ABCD*GHRSW]*', relevant_text)
-            
-            for status_sequence in status_sequences:
-                if len(status_sequence) == 12:
-                    payment_history = list(status_sequence[:6])
-                    continue
-            
-            balance_match = re.search(r'\d+\.\d+', relevant_text)
-            if balance_match:
-                balance_str = balance_match.group()
-                balance = int(float(balance_str))
-            else:
-                raise Exception("No balance found in PDF")
-            
-        start_section = "Unsecured Credit Limit"
-        end_section = "Applicant Type" 
-
-        if start_section in text:
-            section_start = text.find(start_section)
-            section_end = text.find(end_section, section_start)
-            relevant_text = text[section_start+len(start_section):section_end].strip()
-
-            credit_limit = int(relevant_text.replace(",", ""))
-        
-    # Close the PDF document
-    pdf_document.close()
-
-    return map_payment_status(payment_history), balance/credit_limit
+    # file is a path or an uploaded report, see credit_report.py
+    status_history, balance, credit_limit = read_credit_report(file)
+    return map_payment_status(status_history), balance/credit_limit
 
 def get_credit_utilisation_ratio(customer_id):
     credit_limit = get_customer_credit_limit(customer_id)
@@ -175,9 +189,83 @@ def get_credit_utilisation_ratio(customer_id):
     return outstanding_balance/credit_limit
 
 def get_payment_history_and_credit_utilisation_ratio(db, customer_id):
-    instalment_payments = get_most_recent_6_months_instalment_payments(db, customer_id)
+    now = datetime.now()
+    if USE_MATERIALISED_PAYMENT_STATUS:
+        with stage(DB_FETCH):
+            snapshot = get_credit_snapshot_with_payment_statuses(db, customer_id, now)
+        status_list = snapshot["payment_statuses"]
+        if status_list is None:
+            status_list = get_current_payment_statuses(db, [customer_id], now)[customer_id]
+    else:
+        with stage(DB_FETCH):
+            snapshot = get_credit_snapshot(db, customer_id, now)
+        status_list = get_monthly_payment_statuses(snapshot["instalment_payments"], now)
+
+    # The statuses are empty exactly when there are no recent instalments
+    credit_utilisation_ratio = snapshot["outstanding_balance"] / snapshot["credit_limit"]
+    if len(status_list) == 0:
+        credit_utilisation_ratio = snapshot["credit_utilisation_ratio"]
+
+    # if there is less than 6 payment status, append this to the most recent 6-n payment status from credit report
+    if len(status_list) < 6:
+        status_list = pad_with_credit_score_history(status_list, snapshot["credit_score_history"])
+    return status_list, credit_utilisation_ratio
+
+def payment_statuses_valid_until(instalment_payments, now):
+    # Without any instalment being added or paid, get_monthly_payment_statuses only gives a
+    # different result once a month starts, an instalment leaves the 6 month window or an unpaid
+    # instalment's months overdue (relativedelta(now, due_date).months) ticks over, which happens
+    # at due_date + k months
+    boundaries = [datetime(now.year, now.month, 1) + relativedelta(months=1)]
+    for instalment in instalment_payments:
+        due_date = instalment["due_date"]
+        boundaries.append(due_date + relativedelta(months=6))
+        if instalment["paid_date"] is None:
+            boundaries += [due_date + relativedelta(months=k) for k in range(-7, 7)]
+    return min(boundary for boundary in boundaries if boundary > now)
+
+def compute_payment_statuses(db, customer_ids, now):
+    # Monthly payment statuses (and how long they stay valid) from the instalments, by customer_id.
+    # The statuses of all the customers are computed at once by status_matrix.
+    customer_ids = list(customer_ids)
+    instalment_payments = get_most_recent_6_months_instalment_payments_by_customer(db, customer_ids, now)
+    customer_rows, due_dates, paid_dates = [], [], []
+    for row, customer_id in enumerate(customer_ids):
+        for payment in instalment_payments.get(customer_id, []):
+            customer_rows.append(row)
+            due_dates.append(payment["due_date"])
+            paid_dates.append(payment["paid_date"])
+    with stage(MONTHLY_STATUS):
+        statuses, lengths = compute_status_matrix(customer_rows, np.array(due_dates, dtype="M8[us]"), np.array(paid_dates, dtype="M8[us]"), len(customer_ids), now)
+    return {
+        customer_id: (status_list, payment_statuses_valid_until(instalment_payments.get(customer_id, []), now))
+        for customer_id, status_list in zip(customer_ids, status_lists(statuses, lengths))
+    }
+
+def refresh_payment_statuses(db, customer_ids, now=None):
+    # Recomputes and saves the materialised statuses of the given customers
+    now = now or datetime.now()
+    payment_statuses = compute_payment_statuses(db, customer_ids, now)
+    save_payment_statuses(db, payment_statuses, now)
+    return payment_statuses
+
+def get_current_payment_statuses(db, customer_ids, now):
+    # Monthly payment statuses of many customers: the materialised ones still valid at now, the
+    # rest computed from the instalments (and saved for next time)
+    if not USE_MATERIALISED_PAYMENT_STATUS:
+        return {customer_id: statuses for customer_id, (statuses, _) in compute_payment_statuses(db, customer_ids, now).items()}
+    with stage(DB_FETCH):
+        payment_statuses = get_payment_statuses(db, customer_ids, now)
+    missing = [customer_id for customer_id in customer_ids if customer_id not in payment_statuses]
+    if missing:
+        payment_statuses.update({customer_id: statuses for customer_id, (statuses, _) in refresh_payment_statuses(db, missing, now).items()})
+    return payment_statuses
+
+@stage(MONTHLY_STATUS)
+def get_monthly_payment_statuses(instalment_payments, now=None):
+    now = now or datetime.now()
     monthly_status = defaultdict(lambda: -2)  # Default to -2: no payment for the month
-    earliest_date = datetime.now()
+    earliest_date = now
     for instalment in instalment_payments:
         due_date = instalment["due_date"]
         if due_date < earliest_date:
@@ -192,7 +280,7 @@ def get_payment_history_and_credit_utilisation_ratio(db, customer_id):
                 months_late = -1 # 1 month late will be deemed as paid on time
         else:
             # Consider as missed without payment (worst case of 9 months late)
-            difference = relativedelta(datetime.now(), instalment["due_date"])
+            difference = relativedelta(now, instalment["due_date"])
             months =  difference.years * 12 + difference.months
             months_late = min(6,months)
             if months_late == 0:
@@ -206,47 +294,128 @@ def get_payment_history_and_credit_utilisation_ratio(db, customer_id):
             monthly_status[month_year] = months_late
     
     # Determine the time frame for the status list
-    end_date = datetime.now()
+    end_date = now
     start_date =  earliest_date # For example, the last year
     total_months = (end_date.year - start_date.year) * 12 + (end_date.month - start_date.month) + 1
 
-    credit_utilisation_ratio = get_credit_utilisation_ratio(customer_id)
     if len(instalment_payments) == 0:
         total_months = 0
-        credit_utilisation_ratio = get_first_customer_credit_utilisation_ratio(customer_id)
 
     # Initialize the status list with the default value
     status_list = [-2] * total_months
 
     # Fill the status list with actual statuses
     for month_diff in range(total_months):
-        current_month = (start_date.year, start_date.month + month_diff)
-        # If the month overflows, move to the next year
-        if current_month[1] > 12:
-            current_month = (current_month[0] + 1, 1)
+        # Months counted from year 0, so a list spanning a new year carries into the next year correctly
+        months = start_date.year * 12 + start_date.month - 1 + month_diff
+        current_month = (months // 12, months % 12 + 1)
         
         # Check if there is a recorded status for the current month
         if current_month in monthly_status:
             status_list[month_diff] = monthly_status[current_month]
-
-    # if there is less than 6 payment status, append this to the most recent 6-n payment status from credit report
-    if len(status_list) < 6:
-        
-        credit_score_history = get_credit_score_history(customer_id)
-        credit_score_history_list = credit_score_history.split(",")
-        if len(credit_score_history_list) != 6:
-            raise Exception("credit score history length is not 6")
-        credit_score_history_int = []
-        for credit_score in credit_score_history_list:
-            credit_score_history_int.append(int(credit_score))
-        credit_score_history_int = credit_score_history_int[-(6-len(status_list)):]
-        credit_score_history_int.extend(status_list)
-        status_list = credit_score_history_int
-    return status_list, credit_utilisation_ratio
-
-
-
+    return status_list
+
+def pad_with_credit_score_history(status_list, credit_score_history):
+    credit_score_history_list = credit_score_history.split(",")
+    if len(credit_score_history_list) != 6:
+        raise Exception("credit score history length is not 6")
+    credit_score_history_int = []
+    for credit_score in credit_score_history_list:
+        credit_score_history_int.append(int(credit_score))
+    credit_score_history_int = credit_score_history_int[-(6-len(status_list)):]
+    credit_score_history_int.extend(status_list)
+    return credit_score_history_int
+
+def get_payment_histories_and_credit_utilisation_ratios(db, customer_ids, customers=None):
+    # Bulk version of get_payment_history_and_credit_utilisation_ratio: a fixed number of queries
+    # however many customers are scored. Customers that cannot be scored are returned in errors.
+    # customers (as returned by get_customers_for_scoring) skips reading the customers again.
+    now = datetime.now()
+    with stage(DB_FETCH):
+        if customers is None:
+            customers = get_customers_for_scoring(customer_ids)
+        outstanding_balances = get_customer_outstanding_balances(customers.keys())
+    payment_statuses = get_current_payment_statuses(db, list(customers), now)
+
+    histories, errors = {}, {}
+    for customer_id in customer_ids:
+        customer = customers.get(customer_id)
+        if customer is None:
+            errors[customer_id] = "Customer not found"
+            continue
+        try:
+            status_list = payment_statuses[customer_id]
+
+            credit_limit = get_credit_limit(customer["credit_score"])
+            credit_utilisation_ratio = outstanding_balances.get(customer_id, 0) / credit_limit
+            if len(status_list) == 0:
+                credit_utilisation_ratio = customer["credit_utilisation_ratio"]
+
+            if len(status_list) < 6:
+                status_list = pad_with_credit_score_history(status_list, customer["credit_score_history"])
+            histories[customer_id] = (status_list, credit_utilisation_ratio)
+        except Exception as e:
+            errors[customer_id] = str(e)
+    return histories, errors
+
+def compute_history_features(payment_histories):
+    # Every feature except the credit utilisation ratio (column 0), one row per payment history.
+    # Histories are usually 6 months long but can be longer, so rows are computed per length.
+    feature_spec = get_feature_spec()
+    if USE_TSFRESH_FEATURES:
+        return np.array([feature_spec.extract(payment_history) for payment_history in payment_histories])
+
+    rows_by_length = defaultdict(list)
+    for i, payment_history in enumerate(payment_histories):
+        rows_by_length[len(payment_history)].append(i)
+    features = np.empty((len(payment_histories), len(feature_spec.columns) - 1))
+    for rows in rows_by_length.values():
+        features[rows] = compute_feature_matrix([payment_histories[i] for i in rows], np.zeros(len(rows)))[:, 1:]
+    return features
+
+@stage(FEATURE_EXTRACTION)
 def preprocess(credit_utilisation_ratio, payment_history):
+    # Only the calculators listed in relevant_features.csv are run, in the same column order.
+    # The history features come from the feature cache, only the ratio changes per customer.
+    import pandas as pd
+    feature_spec = get_feature_spec()
+    row = np.empty(len(feature_spec.columns))
+    row[0] = credit_utilisation_ratio
+    row[1:] = feature_cache.lookup([payment_history], compute_history_features)[0]
+    return pd.DataFrame([row], columns=feature_spec.columns)
+
+@stage(FEATURE_EXTRACTION)
+def preprocess_batch(credit_utilisation_ratios, payment_histories):
+    # Features for many customers at once, one credit utilisation ratio per payment history
+    import pandas as pd
+    columns = get_feature_spec().columns
+    credit_utilisation_ratios = np.asarray(credit_utilisation_ratios, dtype=float)
+    if isinstance(payment_histories, np.ndarray) and payment_histories.ndim == 2:
+        # Simulated histories are scored in one pass and not cached, they would only push out
+        # the histories real customers have
+        return pd.DataFrame(compute_feature_matrix(payment_histories, credit_utilisation_ratios), columns=columns)
+
+    features = np.empty((len(payment_histories), len(columns)))
+    features[:, 0] = credit_utilisation_ratios
+    if len(payment_histories):
+        features[:, 1:] = feature_cache.lookup(payment_histories, compute_history_features)
+    return pd.DataFrame(features, columns=columns)
+
+def prewarm_feature_cache(db, limit):
+    # Computes the features of the most common credit score histories up front
+    payment_histories = []
+    for credit_score_history in get_most_common_credit_score_histories(db, limit):
+        try:
+            payment_histories.append(pad_with_credit_score_history([], credit_score_history))
+        except Exception:
+            continue
+    return feature_cache.prewarm(payment_histories, compute_history_features)
+
+def preprocess_tsfresh(credit_utilisation_ratio, payment_history):
+    # Original tsfresh pipeline, kept as the reference the targeted extractor is checked against
+    import pandas as pd
+    from tsfresh import extract_features
+    from tsfresh.utilities.dataframe_functions import impute
     df = pd.DataFrame()
 
     # Calculate TOTAL_BILL and CREDIT_UTILISATION_RATIO
@@ -278,7 +447,7 @@ def preprocess(credit_utilisation_ratio, payment_history):
     df.reset_index(drop=True, inplace=True)
     extracted_features.reset_index(inplace=True)
 
-    relevant_features_df = pd.read_csv('../relevant_features.csv')
+    relevant_features_df = pd.read_csv(RELEVANT_FEATURES_PATH)
     relevant_feature_names = relevant_features_df['features'].tolist()
 
     extracted_features = extracted_features[relevant_feature_names]
@@ -0,0 +1,252 @@
+"""Append-only log of shadow model scores, for comparing candidate models with the primary one
+offline.
+
+    python3 shadow_log.py [directory]   # per shadow model: rows, score differences and agreement
+
+predict queues the scores of every row it scores (see service.predict) and returns straight away.
+A background thread writes them every SHADOW_LOG_FLUSH_INTERVAL seconds (or
+SHADOW_LOG_FLUSH_ROWS rows) as one block. If the queue is full the scores are dropped rather than
+making the request wait, and they are counted in credit_service_shadow_scores_total. Each process
+appends to a file of its own in SHADOW_LOG_DIR, so pre-forked workers never interleave their
+writes, and a process that is killed loses at most its last flush interval.
+
+A block is columnar: the magic bytes, the length of a JSON header, the header (row count, column
+names and dtypes, and the values of the string columns) and then each column's values back to
+back. Timestamps are float64 and scores float32. The endpoint and model versions are stored as
+uint16 indexes into the header's values. Shadow score columns are named by model version, and a
+block only has the columns of the models scored while it was filled.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import numpy as np
+from metrics import SHADOW_SCORES
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHADOW_LOG_DIR = os.getenv("SHADOW_LOG_DIR", os.path.join(BASE_DIR, "shadow_log"))
+SHADOW_LOG_QUEUE_SIZE = int(os.getenv("SHADOW_LOG_QUEUE_SIZE", "10000"))
+SHADOW_LOG_FLUSH_ROWS = int(os.getenv("SHADOW_LOG_FLUSH_ROWS", "5000"))
+SHADOW_LOG_FLUSH_INTERVAL = float(os.getenv("SHADOW_LOG_FLUSH_INTERVAL", "1"))
+
+MAGIC = b"SHDW"
+BLOCK_FORMAT = 1
+HEADER_LENGTH = struct.Struct("<I")
+STRING_COLUMNS = ("endpoint", "primary_version")
+# Prefix of the shadow score columns, followed by the model version
+SCORE_PREFIX = "score:"
+
+
+def encode_block(records):
+    # records are (timestamp, endpoint, primary_version, primary_scores, {shadow_version: scores})
+    sizes = [len(primary_scores) for _, _, _, primary_scores, _ in records]
+    n_rows = sum(sizes)
+    strings = {name: [] for name in STRING_COLUMNS}
+    codes = {name: np.empty(n_rows, dtype="<u2") for name in STRING_COLUMNS}
+    timestamps = np.repeat([record[0] for record in records], sizes).astype("<f8")
+    rows = np.concatenate([np.arange(size, dtype="<u4") for size in sizes])
+    primary_scores = np.concatenate([record[3] for record in records]).astype("<f4")
+    shadow_versions = list(dict.fromkeys(version for record in records for version in record[4]))
+    shadow_scores = {version: np.full(n_rows, np.nan, dtype="<f4") for version in shadow_versions}
+
+    start = 0
+    for (_, endpoint, primary_version, _, scores), size in zip(records, sizes):
+        for name, value in zip(STRING_COLUMNS, (endpoint, primary_version)):
+            if value not in strings[name]:
+                strings[name].append(value)
+            codes[name][start:start + size] = strings[name].index(value)
+        for version, values in scores.items():
+            shadow_scores[version][start:start + size] = values
+        start += size
+
+    columns = [("timestamp", timestamps), ("row", rows), *((name, codes[name]) for name in STRING_COLUMNS), ("primary_score", primary_scores)]
+    columns += [(SCORE_PREFIX + version, shadow_scores[version]) for version in shadow_versions]
+    header = json.dumps({
+        "format": BLOCK_FORMAT,
+        "rows": n_rows,
+        "columns": [{"name": name, "dtype": values.dtype.str} for name, values in columns],
+        "strings": strings,
+    }).encode()
+    return b"".join([MAGIC, HEADER_LENGTH.pack(len(header)), header, *(values.tobytes() for _, values in columns)])
+
+
+def read_blocks(path):
+    # Yields each block as {column: array}, with the string columns decoded. A block cut short
+    # (by a process killed mid-write) ends the file.
+    with open(path, "rb") as f:
+        while True:
+            magic = f.read(len(MAGIC))
+            if len(magic) < len(MAGIC):
+                return
+            if magic != MAGIC:
+                raise Exception(f"{path} is not a shadow log")
+            length = f.read(HEADER_LENGTH.size)
+            if len(length) < HEADER_LENGTH.size:
+                return
+            header = f.read(HEADER_LENGTH.unpack(length)[0])
+            try:
+                header = json.loads(header)
+            except ValueError:
+                return
+            block = {}
+            for column in header["columns"]:
+                dtype = np.dtype(column["dtype"])
+                data = f.read(header["rows"] * dtype.itemsize)
+                if len(data) < header["rows"] * dtype.itemsize:
+                    return
+                block[column["name"]] = np.frombuffer(data, dtype=dtype)
+            for name, values in header["strings"].items():
+                block[name] = np.array(values, dtype=object)[block[name]] if values else np.array([], dtype=object)
+            yield block
+
+
+def log_paths(directory=SHADOW_LOG_DIR):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, filename) for filename in os.listdir(directory) if filename.endswith(".log"))
+
+
+def read_shadow_log(paths=None):
+    # Every block of the given files (all of SHADOW_LOG_DIR by default) as one DataFrame, with a
+    # score:<version> column per shadow model (NaN where it was not scored)
+    import pandas as pd
+    paths = log_paths() if paths is None else paths
+    frames = [pd.DataFrame(block) for path in paths for block in read_blocks(path)]
+    if not frames:
+        return pd.DataFrame(columns=["timestamp", "row", *STRING_COLUMNS, "primary_score"])
+    frame = pd.concat(frames, ignore_index=True)
+    frame["timestamp"] = pd.to_datetime(frame["timestamp"], unit="s")
+    return frame
+
+
+def summarise(frame):
+    # Per shadow model: how many rows it scored and how far its scores are from the primary model's
+    summary = {}
+    for column in frame.columns:
+        if not column.startswith(SCORE_PREFIX):
+            continue
+        scored = frame[frame[column].notna()]
+        difference = scored[column] - scored["primary_score"]
+        summary[column[len(SCORE_PREFIX):]] = {
+            "rows": int(len(scored)),
+            "mean_difference": float(difference.mean()) if len(scored) else None,
+            "mean_absolute_difference": float(difference.abs().mean()) if len(scored) else None,
+            "p95_absolute_difference": float(difference.abs().quantile(0.95)) if len(scored) else None,
+            "correlation": float(scored[column].corr(scored["primary_score"])) if len(scored) > 1 else None,
+        }
+    return summary
+
+
+class ShadowLog:
+    """Queues shadow scores and writes them from a background thread, see the module docstring."""
+
+    _flush = object()
+    _stop = object()
+
+    def __init__(self, directory=SHADOW_LOG_DIR, queue_size=SHADOW_LOG_QUEUE_SIZE, flush_rows=SHADOW_LOG_FLUSH_ROWS, flush_interval=SHADOW_LOG_FLUSH_INTERVAL):
+        self.directory = directory
+        self.queue_size = queue_size
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.path = None
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        # Started by the first append in each process: a thread does not survive a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self.path = os.path.join(self.directory, f"shadow-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.log")
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, args=(self._queue, self.path), name="shadow-log", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            # Writes what is still queued when the process exits normally
+            atexit.register(self.close)
+
+    def append(self, primary_version, primary_scores, shadow_scores, endpoint=""):
+        self._start()
+        primary_scores = np.asarray(primary_scores, dtype=np.float32).reshape(-1)
+        record = (time.time(), endpoint, primary_version, primary_scores, {version: np.asarray(scores, dtype=np.float32).reshape(-1) for version, scores in shadow_scores.items()})
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            SHADOW_SCORES.inc(len(primary_scores), outcome="dropped")
+            return False
+        SHADOW_SCORES.inc(len(primary_scores), outcome="queued")
+        return True
+
+    def _run(self, records, path):
+        pending, n_rows = [], 0
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = records.get(timeout=max(0, next_flush - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if isinstance(item, tuple) and len(item) == 5:
+                pending.append(item)
+                n_rows += len(item[3])
+                if n_rows < self.flush_rows and time.monotonic() < next_flush:
+                    continue
+            if pending:
+                try:
+                    with open(path, "ab") as f:
+                        f.write(encode_block(pending))
+                except Exception:
+                    logger.exception("Could not write %d shadow scores to %s", n_rows, path)
+                pending, n_rows = [], 0
+            next_flush = time.monotonic() + self.flush_interval
+            if isinstance(item, tuple) and item[0] is self._flush:
+                item[1].set()
+            elif item is self._stop:
+                return
+
+    def flush(self, timeout=10):
+        # Waits until everything queued so far is written
+        if self._pid != os.getpid():
+            return
+        written = threading.Event()
+        try:
+            self._queue.put((self._flush, written), timeout=timeout)
+        except queue.Full:
+            return
+        written.wait(timeout)
+
+    def close(self, timeout=10):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            try:
+                self._queue.put(self._stop, timeout=timeout)
+            except queue.Full:
+                logger.warning("Shadow log writer is stuck, %d queued scores are lost", self._queue.qsize())
+            else:
+                self._thread.join(timeout)
+            self._pid = None
+
+
+shadow_log = ShadowLog()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    directory = argv[0] if argv else SHADOW_LOG_DIR
+    print(json.dumps(summarise(read_shadow_log(log_paths(directory))), indent=2))
+
+
+if __name__ == "__main__":
+    main()
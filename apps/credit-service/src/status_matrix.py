@@ -0,0 +1,67 @@
+import numpy as np
+
+# Vectorized get_monthly_payment_statuses for many customers at once: instalments come in as
+# columns (customer row, due date, paid date) and every months-late calculation is datetime64
+# month arithmetic, so there is no Python loop over customers or instalments.
+
+ONE_DAY = np.timedelta64(1, "D")
+
+
+def add_months(dates, months):
+    # dates + relativedelta(months=months): the same day of the target month (clipped to its last
+    # day) at the same time of day
+    month = dates.astype("M8[M]")
+    target = month + months
+    offset = dates - month.astype(dates.dtype)
+    days = offset // ONE_DAY
+    days_in_target = ((target + 1).astype("M8[D]") - target.astype("M8[D]")) // ONE_DAY
+    return target.astype(dates.dtype) + np.minimum(days, days_in_target - 1) * ONE_DAY + (offset - days * ONE_DAY)
+
+
+def months_between(now, dates):
+    # relativedelta(now, dates) in whole months (years * 12 + months), negative for dates after now
+    months = now.astype("M8[M]").astype(np.int64) - dates.astype("M8[M]").astype(np.int64)
+    anniversary = add_months(dates, months)
+    return np.where(now >= dates, months - (now < anniversary), months + (now > anniversary))
+
+
+def months_late(due_dates, paid_dates, now):
+    # Status of each instalment, as in get_monthly_payment_statuses: paid ones by how many calendar
+    # months late they were paid (1 month counts as on time, capped at 9), unpaid ones by how many
+    # months they are overdue (capped at 6, due this month counts as on time)
+    is_paid = ~np.isnat(paid_dates)
+    paid_late = paid_dates.astype("M8[M]").astype(np.int64) - due_dates.astype("M8[M]").astype(np.int64)
+    paid_late = np.where(paid_late > 1, np.minimum(paid_late, 9), -1)
+    overdue = np.minimum(months_between(now, due_dates), 6)
+    overdue = np.where(overdue == 0, -1, overdue)
+    return np.where(is_paid, paid_late, overdue)
+
+
+def compute_status_matrix(customer_rows, due_dates, paid_dates, n_customers, now):
+    # customer_rows[i] is the customer (0 to n_customers - 1) of instalment i, paid_dates is NaT for
+    # unpaid instalments. Returns (statuses, lengths): statuses[c, -lengths[c]:] is customer c's
+    # status list (oldest month first, the current month last), earlier columns are filler.
+    customer_rows = np.asarray(customer_rows, dtype=np.intp)
+    due_dates = np.asarray(due_dates, dtype="M8[us]")
+    paid_dates = np.asarray(paid_dates, dtype="M8[us]")
+    now = np.datetime64(now, "us")
+
+    now_month = now.astype("M8[M]").astype(np.int64)
+    due_months = due_dates.astype("M8[M]").astype(np.int64)
+    # Each customer's list runs from the month of its earliest instalment (or now) to now
+    earliest = np.full(n_customers, now_month)
+    np.minimum.at(earliest, customer_rows, due_months)
+    has_instalments = np.bincount(customer_rows, minlength=n_customers) > 0
+    lengths = np.where(has_instalments, now_month - earliest + 1, 0)
+
+    width = int(lengths.max()) if n_customers else 0
+    statuses = np.full((n_customers, width), -2, dtype=np.int64)
+    # Worst status per month, instalments due after this month are not part of the list
+    in_list = due_months <= now_month
+    columns = width - 1 - (now_month - due_months[in_list])
+    np.maximum.at(statuses, (customer_rows[in_list], columns), months_late(due_dates[in_list], paid_dates[in_list], now))
+    return statuses, lengths
+
+
+def status_lists(statuses, lengths):
+    return [statuses[i, statuses.shape[1] - length:].tolist() for i, length in enumerate(lengths)]
@@ -0,0 +1,215 @@
+import json
+import os
+import shutil
+import numpy as np
+
+# Evaluates LightGBM text models with NumPy instead of lightgbm. The trees are compiled into
+# flat arrays (one entry per node across all trees) that are cached on disk as .npy files and
+# memory-mapped, so loading a model is a few mmaps instead of parsing the text file.
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMPILED_MODEL_DIR = os.getenv("COMPILED_MODEL_DIR", os.path.join(BASE_DIR, "model_cache"))
+
+# Bump when the compiled layout changes so stale caches are compiled again
+COMPILED_FORMAT = 1
+
+# Same as LightGBM's kZeroThreshold
+ZERO_THRESHOLD = 1e-35
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+
+ARRAYS = ["split_feature", "threshold", "default_left", "missing_type", "left_child", "right_child", "node_value", "roots"]
+
+
+def _parse_sections(path):
+    # The header and each Tree=<i> block are "key=value" lines separated by blank lines
+    header, trees, current = {}, [], None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line == "end of trees":
+                break
+            if line.startswith("Tree="):
+                current = {}
+                trees.append(current)
+                continue
+            if "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            (current if current is not None else header)[key] = value
+    return header, trees
+
+
+def _tree_depth(left_child, right_child):
+    def depth(node):
+        if node < 0:
+            return 0
+        return 1 + max(depth(left_child[node]), depth(right_child[node]))
+    return depth(0) if left_child else 0
+
+
+def compile_lightgbm_model(path):
+    header, trees = _parse_sections(path)
+    if int(header.get("num_class", 1)) != 1 or int(header.get("num_tree_per_iteration", 1)) != 1:
+        raise Exception("Only single-output LightGBM models can be compiled")
+
+    objective = header.get("objective", "").split()
+    if objective and objective[0] == "binary":
+        sigmoid = float(dict(option.split(":") for option in objective[1:]).get("sigmoid", 1))
+    elif objective and objective[0] == "regression":
+        sigmoid = None
+    else:
+        raise Exception(f"Objective {header.get('objective')} cannot be compiled")
+
+    # Split nodes and leaves of every tree share one node table. A leaf loops back to itself,
+    # so every row can take the same number of steps down all trees at once.
+    split_feature, threshold, decision_type, left_child, right_child, node_value = [], [], [], [], [], []
+    roots = []
+    depth = 0
+    for tree in trees:
+        if int(tree.get("num_cat", 0)) > 0:
+            raise Exception("Categorical splits cannot be compiled")
+        if int(tree.get("is_linear", 0)):
+            raise Exception("Linear trees cannot be compiled")
+
+        leaves = [float(value) for value in tree["leaf_value"].split()]
+        tree_left = [int(value) for value in tree.get("left_child", "").split()]
+        tree_right = [int(value) for value in tree.get("right_child", "").split()]
+        num_splits = len(tree_left)
+        offset = len(split_feature)
+        leaf_offset = offset + num_splits
+
+        def encode(child):
+            return offset + child if child >= 0 else leaf_offset + ~child
+
+        roots.append(offset if num_splits else leaf_offset)
+        depth = max(depth, _tree_depth(tree_left, tree_right))
+        if num_splits:
+            split_feature += [int(value) for value in tree["split_feature"].split()]
+            threshold += [float(value) for value in tree["threshold"].split()]
+            decision_type += [int(value) for value in tree["decision_type"].split()]
+            left_child += [encode(child) for child in tree_left]
+            right_child += [encode(child) for child in tree_right]
+            node_value += [0.0] * num_splits
+        for i, value in enumerate(leaves):
+            split_feature.append(0)
+            threshold.append(np.inf)
+            decision_type.append(0)
+            left_child.append(leaf_offset + i)
+            right_child.append(leaf_offset + i)
+            node_value.append(value)
+
+    decision_type = np.array(decision_type, dtype=np.int32)
+    arrays = {
+        "split_feature": np.array(split_feature, dtype=np.intp),
+        "threshold": np.array(threshold, dtype=np.float64),
+        "default_left": (decision_type & 2) != 0,
+        "missing_type": ((decision_type >> 2) & 3).astype(np.int8),
+        "left_child": np.array(left_child, dtype=np.intp),
+        "right_child": np.array(right_child, dtype=np.intp),
+        "node_value": np.array(node_value, dtype=np.float64),
+        "roots": np.array(roots, dtype=np.intp),
+    }
+    meta = {
+        "format": COMPILED_FORMAT,
+        "num_features": int(header["max_feature_idx"]) + 1,
+        "feature_names": header.get("feature_names", "").split(),
+        "sigmoid": sigmoid,
+        "average_output": "average_output" in header,
+        "depth": depth,
+    }
+    return CompiledModel(arrays, meta)
+
+
+class CompiledModel:
+    """A LightGBM model as flat NumPy arrays, predicting every row through every tree at once."""
+
+    def __init__(self, arrays, meta):
+        self.arrays = arrays
+        self.meta = meta
+        for name in ARRAYS:
+            # A plain ndarray view of the (possibly memory-mapped) array, np.memmap slows every indexing op
+            setattr(self, name, np.asarray(arrays[name]))
+        # children[2 * node + (value > threshold)] is the next node
+        self.children = np.stack([self.left_child, self.right_child], axis=1).reshape(-1)
+        self.num_features = meta["num_features"]
+        self.sigmoid = meta["sigmoid"]
+        self.depth = meta["depth"]
+        # Without zero/NaN missing handling a missing value is just compared as 0, like LightGBM does
+        self.handles_missing = bool(np.any(self.missing_type != MISSING_NONE))
+
+    def predict_raw(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[None, :]
+        if X.shape[1] != self.num_features:
+            raise Exception(f"The model expects {self.num_features} features, got {X.shape[1]}")
+        if not self.handles_missing and np.isnan(X).any():
+            X = np.where(np.isnan(X), 0.0, X)
+
+        # node[r, t]: where row r currently is in tree t
+        node = np.tile(self.roots, (len(X), 1))
+        row_offsets = np.arange(len(X))[:, None] * X.shape[1]
+        X = X.reshape(-1)
+        for _ in range(self.depth):
+            value = np.take(X, np.take(self.split_feature, node) + row_offsets)
+            go_left = value <= np.take(self.threshold, node)
+            if self.handles_missing:
+                go_left = self._missing_decision(node, value, go_left)
+            node = np.take(self.children, 2 * node + ~go_left)
+
+        raw = np.take(self.node_value, node).sum(axis=1)
+        if self.meta["average_output"]:
+            raw /= len(self.roots)
+        return raw
+
+    def _missing_decision(self, node, value, go_left):
+        # The rest of LightGBM's NumericalDecision for splits with a zero or NaN missing type
+        missing_type = self.missing_type[node]
+        is_nan = np.isnan(value)
+        value = np.where(is_nan & (missing_type != MISSING_NAN), 0.0, value)
+        go_left = np.where(is_nan, value <= self.threshold[node], go_left)
+        is_missing = ((missing_type == MISSING_ZERO) & (np.abs(value) <= ZERO_THRESHOLD)) | \
+            ((missing_type == MISSING_NAN) & is_nan)
+        return np.where(is_missing, self.default_left[node], go_left)
+
+    def predict(self, X):
+        raw = self.predict_raw(X)
+        if self.sigmoid is None:
+            return raw
+        return 1.0 / (1.0 + np.exp(-self.sigmoid * raw))
+
+    def save(self, directory):
+        # Written to a temporary directory and renamed into place, so a reader never sees half a model
+        tmp_directory = f"{directory}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_directory, f"{name}.npy"), self.arrays[name])
+        with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+        try:
+            os.rename(tmp_directory, directory)
+        except OSError:
+            # Another process compiled the same model first
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("format") != COMPILED_FORMAT:
+            raise Exception(f"Compiled model in {directory} has an outdated format")
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        return cls(arrays, meta)
+
+
+def load_compiled_model(path, sha256, cache_dir=COMPILED_MODEL_DIR):
+    # Compiled once per model file content, later loads just memory-map the cached arrays
+    directory = os.path.join(cache_dir, sha256)
+    try:
+        return CompiledModel.load(directory)
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    compile_lightgbm_model(path).save(directory)
+    return CompiledModel.load(directory)
@@ -0,0 +1,32 @@
+import os
+import sys
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+# The service modules import each other as top-level modules (python3 main.py is run from src/)
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture
+def app(monkeypatch, tmp_path):
+    monkeypatch.setenv("SQLALCHEMY_DATABASE_URI", "sqlite://")
+    from main import create_app
+    from models import db
+    from credit_tiers import credit_tier_cache
+    from cci import cci_store
+
+    app = create_app()
+    credit_tier_cache.invalidate()
+    monkeypatch.setattr(cci_store, "directory", str(tmp_path / "cci_cache"))
+    cci_store.invalidate()
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,104 @@
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from models import db, Customer, CustomerStatus, CreditTier, Transaction, TransactionStatus, InstalmentPayment, InstalmentPaymentStatus
+from service import get_payment_history_and_credit_utilisation_ratio, preprocess, predict
+
+
+def add_customer(customer_id, credit_score=500, credit_score_history="-1,-1,-1,-1,-1,-1", credit_utilisation_ratio=0.3):
+    db.session.add(Customer(
+        customer_id=customer_id,
+        name=customer_id,
+        email=f"{customer_id}@example.com",
+        password="password",
+        contact_number="91234567",
+        address="address",
+        date_of_birth=datetime(1990, 1, 1),
+        status=CustomerStatus.ACTIVE,
+        credit_score=credit_score,
+        credit_score_history=credit_score_history,
+        credit_utilisation_ratio=credit_utilisation_ratio,
+    ))
+
+
+def add_instalments(customer_id, instalments, transaction_id=None):
+    # instalments: (months before now that it was due, months late it was paid or None if unpaid)
+    transaction_id = transaction_id or f"{customer_id}-transaction"
+    db.session.add(Transaction(transaction_id=transaction_id, amount=300, status=TransactionStatus.IN_PROGRESS, customer_id=customer_id))
+    now = datetime.now()
+    for i, (months_ago, months_late) in enumerate(instalments):
+        due_date = now - relativedelta(months=months_ago, days=1)
+        paid = months_late is not None
+        db.session.add(InstalmentPayment(
+            instalment_payment_id=f"{transaction_id}-{i}",
+            amount_due=100,
+            late_payment_amount_due=0,
+            status=InstalmentPaymentStatus.PAID if paid else InstalmentPaymentStatus.UNPAID,
+            due_date=due_date,
+            paid_date=due_date + relativedelta(months=months_late) if paid else None,
+            instalment_number=i + 1,
+            transaction_id=transaction_id,
+        ))
+
+
+def seed():
+    db.session.add(CreditTier(credit_tier_id="tier", name="Standard", min_credit_score=0, max_credit_score=1000, credit_limit=1000))
+    add_customer("on-time")
+    add_instalments("on-time", [(3, 0), (2, 0), (1, 0)])
+    add_customer("late", credit_score_history="-1,2,3,-1,-1,-2")
+    add_instalments("late", [(4, 3), (2, None), (1, 2)])
+    add_customer("new-customer", credit_score_history="-2,-2,-1,-1,4,5", credit_utilisation_ratio=0.9)
+    add_customer("no-history", credit_score_history=None)
+    add_instalments("no-history", [(1, 0)])
+    db.session.commit()
+
+
+def test_batch_update_matches_single_customer_scoring(client):
+    seed()
+    customer_ids = ["on-time", "late", "new-customer"]
+    expected = {}
+    for customer_id in customer_ids:
+        payment_history, credit_utilisation_ratio = get_payment_history_and_credit_utilisation_ratio(db, customer_id)
+        expected[customer_id] = int(predict(preprocess(credit_utilisation_ratio, payment_history))[0])
+
+    response = client.post("/batch-update-credit-rating", json={"customer_ids": customer_ids})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["errors"] == []
+    assert {result["customer_id"]: result["credit_score"] for result in body["results"]} == expected
+    assert body["model_version"].startswith("lgb_model_v3@")
+    db.session.expire_all()
+    for customer_id, credit_score in expected.items():
+        assert db.session.get(Customer, customer_id).credit_score == credit_score
+
+
+def test_batch_update_reports_per_customer_errors(client):
+    seed()
+
+    response = client.post("/batch-update-credit-rating", json={"customer_ids": ["on-time", "missing", "no-history"]})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [result["customer_id"] for result in body["results"]] == ["on-time"]
+    assert {error["customer_id"] for error in body["errors"]} == {"missing", "no-history"}
+
+
+def test_batch_update_requires_customer_ids(client):
+    assert client.post("/batch-update-credit-rating", json={}).status_code == 401
+
+
+def test_score_updates_never_fetch_profile_picture(client):
+    from test_repository import count_queries
+    seed()
+    customer = db.session.get(Customer, "on-time")
+    customer.profile_picture = b"\x89PNG" + bytes(1 << 20)
+    db.session.commit()
+    db.session.expire_all()
+
+    with count_queries() as statements:
+        single = client.post("/update-credit-rating", json={"customer_id": "on-time"})
+        batch = client.post("/batch-update-credit-rating", json={"customer_ids": ["on-time", "late"]})
+
+    assert single.status_code == 200 and batch.status_code == 200
+    assert statements
+    assert not [statement for statement in statements if "profile_picture" in statement or "password" in statement]
@@ -0,0 +1,45 @@
+import benchmark
+from models import db, Customer, InstalmentPayment, CustomerPaymentStatus
+
+
+def test_benchmark_builds_the_database_and_reports_every_hot_path(app):
+    result = benchmark.benchmark(db, "1k", iterations=3)
+
+    assert result["instalments"] >= benchmark.SCALES["1k"]
+    assert result["customers"] == db.session.query(CustomerPaymentStatus).count()
+    assert set(result["results"]) == {
+        "get_most_recent_6_months_instalment_payments",
+        "get_payment_history_and_credit_utilisation_ratio",
+        "get_payment_history_and_credit_utilisation_ratio_computed",
+        "preprocess",
+        "preprocess_cached",
+        "predict",
+        "extract_payment_history_and_credit_utilisation_ratio_from_report",
+        "extract_payment_history_and_credit_utilisation_ratio_from_cci",
+    }
+    for timings in result["results"].values():
+        assert timings["iterations"] == 3
+        assert 0 < timings["p50_ms"] <= timings["p95_ms"]
+        assert timings["peak_memory_bytes"] > 0
+
+    # A filled database is reused rather than built again
+    assert benchmark.benchmark(db, "1k", iterations=1)["build_seconds"] is None
+    assert db.session.query(InstalmentPayment).count() == result["instalments"]
+
+
+def test_synthetic_data_is_reproducible():
+    now = benchmark.datetime(2024, 6, 1)
+    first = list(benchmark.generate_customers(500, benchmark.random.Random(1), now))
+    second = list(benchmark.generate_customers(500, benchmark.random.Random(1), now))
+    assert first == second
+    assert sum(len(instalments) for _, _, instalments in first) >= 500
+
+
+def test_compare_reports_p50_regressions_over_the_threshold():
+    baseline = {"results": {"predict": {"p50_ms": 1.0}, "preprocess": {"p50_ms": 10.0}, "removed": {"p50_ms": 1.0}}}
+    current = {"results": {"predict": {"p50_ms": 1.5}, "preprocess": {"p50_ms": 11.0}, "added": {"p50_ms": 5.0}}}
+
+    regressions = benchmark.compare(baseline, current, threshold=0.2)
+
+    assert [regression["benchmark"] for regression in regressions] == ["predict"]
+    assert regressions[0]["change"] == 0.5
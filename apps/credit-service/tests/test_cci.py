@@ -0,0 +1,78 @@
+import os
+import fitz
+import pytest
+import cci
+from cci import CCIStore, parse_cci_delinquency, BASE_DIR, cci_store
+
+CCI_PATH = os.path.join(BASE_DIR, "CONSUMER-CREDIT-INDEX-Q2-2024.pdf")
+
+
+@pytest.fixture(scope="module")
+def cci_content():
+    with open(CCI_PATH, "rb") as f:
+        return f.read()
+
+
+def test_parse_cci_delinquency_reads_the_last_6_months():
+    parsed = parse_cci_delinquency(CCI_PATH)
+
+    assert parsed["months"] == ["JAN'24", "FEB'24", "MAR'24", "APR'24", "MAY'24", "JUN'24"]
+    assert parsed["delinquency_rates"][-1] == [1.88, 2.55, 3.25, 3.74, 3.75, 3.47, 2.53]
+    assert parsed["average_delinquency"][-1] == pytest.approx(sum([1.88, 2.55, 3.25, 3.74, 3.75, 3.47, 2.53]) / 7)
+
+
+def test_store_keys_artifacts_by_content_hash_and_serves_the_latest(tmp_path, cci_content, monkeypatch):
+    store = CCIStore(directory=str(tmp_path), pdf_dir=str(tmp_path))
+    assert store.latest() is None
+
+    first = store.add(cci_content, "CONSUMER-CREDIT-INDEX-Q2-2024.pdf")
+    assert os.path.exists(tmp_path / f"{first['sha256']}.json")
+    assert store.latest() is first
+
+    # Uploading the same PDF again reuses its artifact without parsing
+    monkeypatch.setattr(cci, "parse_cci_delinquency", lambda file: pytest.fail("parsed an already stored CCI"))
+    again = store.add(cci_content, "copy.pdf")
+    assert again["version"] == first["version"]
+
+    # Another worker sharing the directory picks up the latest upload from disk
+    other_worker = CCIStore(directory=str(tmp_path), pdf_dir=str(tmp_path))
+    assert other_worker.latest()["sha256"] == first["sha256"]
+
+
+def test_a_pdf_that_fails_to_parse_is_tried_again(tmp_path, cci_content, monkeypatch):
+    (tmp_path / "pdfs").mkdir()
+    (tmp_path / "pdfs" / "CONSUMER-CREDIT-INDEX-Q2-2024.pdf").write_bytes(cci_content)
+    store = CCIStore(directory=str(tmp_path / "artifacts"), pdf_dir=str(tmp_path / "pdfs"))
+    parse = cci.parse_cci_delinquency
+
+    def fail(file):
+        raise Exception("disk full")
+
+    monkeypatch.setattr(cci, "parse_cci_delinquency", fail)
+    with pytest.raises(Exception, match="disk full"):
+        store.latest()
+
+    monkeypatch.setattr(cci, "parse_cci_delinquency", parse)
+    assert store.latest()["filename"] == "CONSUMER-CREDIT-INDEX-Q2-2024.pdf"
+
+
+def test_scoring_routes_never_open_the_pdf(client, cci_content, monkeypatch, tmp_path):
+    from io import BytesIO
+    from models import db, CreditTier
+    import routes
+    monkeypatch.setattr(routes, "BASE_DIR", str(tmp_path))
+    db.session.add(CreditTier(credit_tier_id="tier", name="Standard", min_credit_score=0, max_credit_score=1000, credit_limit=1000))
+    db.session.commit()
+
+    response = client.post("/upload-cci", data={"file": (BytesIO(cci_content), "CONSUMER-CREDIT-INDEX-TEST.pdf")})
+    assert response.status_code == 200
+    assert response.get_json()["version"] == cci_store.latest()["version"]
+
+    def fail_open(*args, **kwargs):
+        raise AssertionError("PDF opened on the scoring path")
+    monkeypatch.setattr(fitz, "open", fail_open)
+    monkeypatch.setattr(os, "listdir", fail_open)
+
+    response = client.post("/get-admin-credit-rating")
+    assert response.status_code == 200
+    assert 0 <= response.get_json()["credit_score"] <= 1000
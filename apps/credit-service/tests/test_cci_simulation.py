@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from service import get_status_this_month, payment_histories_from_defaults, score_cci_simulation, simulate_payment_histories_from_cci
+
+AVERAGE_DELINQUENCY = [3.2, 3.3, 3.4, 3.3, 3.2, 3.3]
+
+
+def scalar_history(defaults):
+    # simulate_payment_history_from_cci with the random draws replaced by the given defaults
+    payment_history = []
+    for has_default in defaults:
+        payment_history.append(get_status_this_month(payment_history, len(payment_history), 0, has_default))
+    return [-1 if status == 1 else status for status in payment_history]
+
+
+def test_vectorized_histories_match_recursive_statuses():
+    # Every default pattern over 6 and 9 months
+    for months in (6, 9):
+        defaults = ((np.arange(2 ** months)[:, None] >> np.arange(months)) & 1).astype(bool)
+        expected = [scalar_history(row) for row in defaults]
+        assert payment_histories_from_defaults(defaults).tolist() == expected
+
+
+def test_simulation_is_reproducible_with_a_seed():
+    first = score_cci_simulation(AVERAGE_DELINQUENCY, 2000, seed=7)
+    second = score_cci_simulation(AVERAGE_DELINQUENCY, 2000, seed=7)
+
+    assert first == second
+    assert first["n_samples"] == 2000
+    assert first["quantiles"]["0.05"] <= first["quantiles"]["0.5"] <= first["quantiles"]["0.95"]
+    assert first["payment_history"] == [-1] * 6
+
+
+def test_default_rate_follows_delinquency():
+    histories = simulate_payment_histories_from_cci([50] * 6, 20000, np.random.default_rng(0))
+    # A month with status -1 either had no default or a first-month default
+    assert (histories[:, 1:] != -1).mean() == pytest.approx(0.25, abs=0.02)
+
+
+def test_admin_rating_reports_simulation(client):
+    from models import db, CreditTier
+    db.session.add(CreditTier(credit_tier_id="tier", name="Standard", min_credit_score=0, max_credit_score=1000, credit_limit=1000))
+    db.session.commit()
+
+    response = client.post("/get-admin-credit-rating", data={"simulation_samples": "500", "seed": "3"})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["simulation"]["n_samples"] == 500
+    assert body["credit_score"] == int(min(body["simulation"]["mean"], 1000))
+    assert client.post("/get-admin-credit-rating", data={"simulation_samples": "0"}).status_code == 400
@@ -0,0 +1,111 @@
+import os
+import re
+import fitz
+import pytest
+from cci import BASE_DIR
+from credit_report import read_credit_report, parse_credit_report, STATUS_SEQUENCE_PATTERN
+from service import map_payment_status, extract_payment_history_and_credit_utilisation_ratio_from_report
+
+REPORT_PATH = os.path.join(BASE_DIR, "Consumer-Credit-Report.pdf")
+
+HISTORY_PAGE = "Unsecured Credit Card\nAccount Status History\n{statuses}\nCurrent Balance\n{balance}\nHDB Loan\nAAAAAAAAAAAA\n"
+LIMIT_PAGE = "Unsecured Credit Limit\n{credit_limit}\nApplicant Type\nPrincipal\n"
+FILLER_PAGE = "Enquiry History\nNo enquiries in the last 12 months\n"
+
+# Synthetic reports, page by page, around the layouts of the sample report
+SYNTHETIC_REPORTS = {
+    "limit-first": [LIMIT_PAGE.format(credit_limit="12,000"), HISTORY_PAGE.format(statuses="ABCDAAAAAAAA", balance="3456.78")],
+    "history-first": [HISTORY_PAGE.format(statuses="AAAAAAAAAAAA", balance="100.00"), FILLER_PAGE, LIMIT_PAGE.format(credit_limit="5,000")],
+    "no-limit": [FILLER_PAGE, HISTORY_PAGE.format(statuses="**GHRSWAAAAA", balance="0.50")],
+    "several-sequences": [LIMIT_PAGE.format(credit_limit="800"), HISTORY_PAGE.format(statuses="AAAAAAAAAAA\nBBBBBBBBBBBBB\nDCBAAAAAAAAA\nWWAAAAAAAAAA", balance="7.25")],
+    "filler-pages": [FILLER_PAGE, FILLER_PAGE, LIMIT_PAGE.format(credit_limit="20,000"), FILLER_PAGE, HISTORY_PAGE.format(statuses="BAAAAAAAAAAA", balance="19999.99")],
+}
+
+
+def legacy_extract(file):
+    # The parser before it was made page-targeted and streaming, the reference for the corpus
+    payment_history = [0]
+    balance = 0
+    credit_limit = 10
+    pdf_document = fitz.open(stream=file.read(), filetype="pdf")
+    for page_num in range(pdf_document.page_count):
+        text = pdf_document[page_num].get_text()
+        start_section = ["Unsecured Credit Card", "Account Status History"]
+        end_section = "HDB Loan"
+        if all(substring in text for substring in start_section):
+            section_start = text.find(start_section[0])
+            section_end = text.find(end_section, section_start)
+            relevant_text = text[section_start:section_end].strip()
+            for status_sequence in re.findall(r'[ABCD*GHRSW]*', relevant_text):
+                if len(status_sequence) == 12:
+                    payment_history = list(status_sequence[:6])
+            balance_match = re.search(r'\d+\.\d+', relevant_text)
+            if balance_match:
+                balance = int(float(balance_match.group()))
+            else:
+                raise Exception("No balance found in PDF")
+        start_section = "Unsecured Credit Limit"
+        end_section = "Applicant Type"
+        if start_section in text:
+            section_start = text.find(start_section)
+            section_end = text.find(end_section, section_start)
+            credit_limit = int(text[section_start+len(start_section):section_end].strip().replace(",", ""))
+    pdf_document.close()
+    return map_payment_status(payment_history), balance/credit_limit
+
+
+def write_report(path, pages):
+    pdf_document = fitz.open()
+    for text in pages:
+        pdf_document.new_page().insert_text((72, 72), text)
+    pdf_document.save(path)
+    pdf_document.close()
+    return path
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("reports")
+    reports = {"sample": REPORT_PATH}
+    for name, pages in SYNTHETIC_REPORTS.items():
+        reports[name] = write_report(str(directory / f"{name}.pdf"), pages)
+    return reports
+
+
+@pytest.mark.parametrize("name", ["sample", *SYNTHETIC_REPORTS])
+def test_parser_matches_the_legacy_parser_on_the_corpus(corpus, name):
+    with open(corpus[name], "rb") as f:
+        expected = legacy_extract(f)
+    assert extract_payment_history_and_credit_utilisation_ratio_from_report(corpus[name]) == expected
+    with open(corpus[name], "rb") as f:
+        assert extract_payment_history_and_credit_utilisation_ratio_from_report(f) == expected
+
+
+def test_status_pattern_only_matches_runs_of_12():
+    assert STATUS_SEQUENCE_PATTERN.findall("AAAAAAAAAAA BBBBBBBBBBBBB CCCCCCCCCCCC xDDDDDDDDDDDDx") == ["CCCCCCCCCCCC", "DDDDDDDDDDDD"]
+
+
+def test_parser_stops_once_both_sections_are_found(corpus, monkeypatch):
+    read_pages = []
+    get_text = fitz.Page.get_text
+    monkeypatch.setattr(fitz.Page, "get_text", lambda page, *args, **kwargs: read_pages.append(page.number) or get_text(page, *args, **kwargs))
+
+    parse_credit_report(corpus["limit-first"])
+    assert read_pages == [0, 1]
+    read_pages.clear()
+    parse_credit_report(REPORT_PATH)
+    assert read_pages == [0, 1]
+
+
+def test_uploads_are_spooled_and_removed(tmp_path, monkeypatch):
+    import tempfile
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    with open(REPORT_PATH, "rb") as f:
+        read_credit_report(f)
+    assert os.listdir(tmp_path) == []
+
+
+def test_report_without_status_history_is_rejected(tmp_path):
+    path = write_report(str(tmp_path / "empty.pdf"), [FILLER_PAGE, LIMIT_PAGE.format(credit_limit="1,000")])
+    with pytest.raises(Exception, match="No account status history"):
+        parse_credit_report(path)
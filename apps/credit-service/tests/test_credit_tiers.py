@@ -0,0 +1,121 @@
+import random
+import pytest
+from credit_tiers import CreditTierCache, CreditTierIndex, CreditTierRecord, credit_tier_cache
+from models import db, CreditTier
+
+
+def tier(name, min_credit_score, max_credit_score, credit_limit):
+    return CreditTierRecord(name, name, min_credit_score, max_credit_score, credit_limit)
+
+
+def linear_scan(credit_tiers, credit_score):
+    # What get_customer_credit_limit did per request before the index
+    matching = [t for t in credit_tiers if t.min_credit_score <= credit_score <= t.max_credit_score]
+    if len(matching) > 1:
+        return "More than 1 credit tier exists in database"
+    if len(matching) == 0:
+        return "Customer credit score does not belong to any credit tier in database"
+    return matching[0].credit_limit
+
+
+def test_index_matches_linear_scan_on_random_tiers():
+    rng = random.Random(8)
+    for _ in range(200):
+        credit_tiers = []
+        for i in range(rng.randint(0, 6)):
+            low = rng.randint(0, 1000)
+            credit_tiers.append(tier(f"tier-{i}", low, low + rng.randint(0, 300), rng.randint(100, 5000)))
+        index = CreditTierIndex(credit_tiers)
+
+        for credit_score in range(-5, 1310):
+            expected = linear_scan(credit_tiers, credit_score)
+            try:
+                actual = index.credit_limit(credit_score)
+            except Exception as e:
+                actual = str(e)
+            assert actual == expected
+
+
+def test_index_reports_overlaps_and_gaps_once_at_load():
+    index = CreditTierIndex([
+        tier("low", 0, 399, 500),
+        tier("mid", 400, 699, 1000),
+        tier("high", 650, 850, 3000),
+        tier("top", 900, 1000, 5000),
+    ])
+
+    assert [(low, high) for low, high, _ in index.overlaps] == [(650, 650), (650, 699), (699, 699)]
+    assert [(low, high) for low, high, _ in index.gaps] == [(850, 900)]
+    assert index.credit_limit(400) == 1000
+    assert index.lowest_credit_tier().name == "low"
+    with pytest.raises(Exception, match="More than 1 credit tier"):
+        index.credit_limit(680)
+    with pytest.raises(Exception, match="does not belong to any credit tier"):
+        index.credit_limit(870)
+    # Customers written elsewhere can have no credit score yet
+    with pytest.raises(Exception, match="does not belong to any credit tier"):
+        index.credit_limit(None)
+
+
+def test_lowest_credit_tier_requires_a_tier():
+    with pytest.raises(Exception, match="No credit tier exists in database"):
+        CreditTierIndex([]).lowest_credit_tier()
+
+
+def test_cache_reloads_after_ttl_or_invalidate():
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return [tier("standard", 0, 1000, 1000 * len(loads))]
+
+    cache = CreditTierCache(ttl=3600, loader=loader)
+    assert cache.get().credit_limit(500) == 1000
+    assert cache.get().credit_limit(500) == 1000
+    assert len(loads) == 1
+
+    cache.invalidate()
+    assert cache.get().credit_limit(500) == 2000
+
+    cache.ttl = 0
+    assert cache.get().credit_limit(500) == 3000
+
+
+def test_tier_edits_invalidate_the_cache(client):
+    db.session.add(CreditTier(credit_tier_id="standard", name="Standard", min_credit_score=0, max_credit_score=1000, credit_limit=1000))
+    db.session.commit()
+    assert credit_tier_cache.get().credit_limit(500) == 1000
+
+    # Edited through this service
+    db.session.get(CreditTier, "standard").credit_limit = 2000
+    db.session.commit()
+    assert credit_tier_cache.get().credit_limit(500) == 2000
+
+    # Edited by another service, then announced through the invalidate hook
+    db.session.execute(CreditTier.__table__.update().values(credit_limit=3000))
+    db.session.commit()
+    assert credit_tier_cache.get().credit_limit(500) == 2000
+    assert client.post("/invalidate-credit-tiers").status_code == 200
+    assert credit_tier_cache.get().credit_limit(500) == 3000
+
+
+def test_tier_edits_invalidate_the_cache_only_once_committed(client):
+    db.session.add(CreditTier(credit_tier_id="standard", name="Standard", min_credit_score=0, max_credit_score=1000, credit_limit=1000))
+    db.session.commit()
+    index = credit_tier_cache.get()
+    assert index.credit_limit(500) == 1000
+
+    db.session.get(CreditTier, "standard").credit_limit = 2000
+    db.session.flush()
+    # Until the commit, other requests cannot read the new tiers, so they are not reloaded yet
+    assert credit_tier_cache.get() is index
+    db.session.commit()
+    assert credit_tier_cache.get().credit_limit(500) == 2000
+
+    # A rolled back edit leaves the cache alone
+    db.session.get(CreditTier, "standard").credit_limit = 3000
+    db.session.flush()
+    index = credit_tier_cache.get()
+    db.session.rollback()
+    assert credit_tier_cache.get() is index
+    assert index.credit_limit(500) == 2000
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+from feature_cache import FeatureCache, feature_cache
+from feature_matrix import compute_feature_matrix
+from service import preprocess, preprocess_batch, prewarm_feature_cache
+from test_batch_update_credit_rating import add_customer
+
+
+def counting(compute):
+    calls = []
+
+    def wrapped(payment_histories):
+        calls.append(payment_histories)
+        return compute(payment_histories)
+    return wrapped, calls
+
+
+def test_lookup_counts_hits_misses_and_evictions():
+    cache = FeatureCache(maxsize=2)
+    compute, calls = counting(lambda histories: [np.array(history) * 2 for history in histories])
+
+    rows = cache.lookup([[1, 2], [3, 4], [1, 2]], compute)
+    assert rows.tolist() == [[2, 4], [6, 8], [2, 4]]
+    assert calls == [[[1.0, 2.0], [3.0, 4.0]]]
+    assert cache.stats()["misses"] == 2
+
+    cache.lookup([[1, 2]], compute)
+    cache.lookup([[5, 6]], compute)  # evicts [3, 4], the least recently used
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 1, "misses": 3, "evictions": 1, "hit_rate": 0.25}
+
+    cache.lookup([[1, 2]], compute)
+    assert len(calls) == 2
+
+
+def test_cached_features_are_read_only():
+    cache = FeatureCache()
+    cache.lookup([[1, 2]], lambda histories: [np.array(history) for history in histories])
+    with pytest.raises(ValueError):
+        cache._features[(1.0, 2.0)][0] = 0
+
+
+def test_zero_maxsize_disables_the_cache():
+    cache = FeatureCache(maxsize=0)
+    compute, calls = counting(lambda histories: [np.array(history) for history in histories])
+    cache.lookup([[1]], compute)
+    cache.lookup([[1]], compute)
+    assert len(calls) == 2
+    assert cache.stats()["size"] == 0
+
+
+def test_preprocess_only_recomputes_the_credit_utilisation_ratio():
+    feature_cache.clear()
+    payment_history = [-1, 0, 1, 2, -1, -1]
+    first = preprocess(0.25, payment_history).to_numpy()[0]
+    second = preprocess(0.75, payment_history).to_numpy()[0]
+
+    expected = compute_feature_matrix([payment_history], [0.75])[0]
+    assert second[0] == 0.75
+    np.testing.assert_array_equal(second[1:], expected[1:])
+    np.testing.assert_array_equal(first[1:], second[1:])
+    assert feature_cache.stats()["hits"] == 1
+
+
+def test_preprocess_batch_uses_the_cache_for_ragged_histories():
+    feature_cache.clear()
+    payment_histories = [[-1] * 6, [0, 1, 2, 3, 4, 5, 6], [-1] * 6]
+    ratios = [0.1, 0.2, 0.3]
+    actual = preprocess_batch(ratios, payment_histories).to_numpy()
+
+    for row, ratio, payment_history in zip(actual, ratios, payment_histories):
+        np.testing.assert_array_equal(row, compute_feature_matrix([payment_history], [ratio])[0])
+    assert feature_cache.stats()["misses"] == 2
+    assert feature_cache.stats()["hits"] == 0
+
+
+def test_prewarm_from_most_common_credit_score_histories(app):
+    from models import db
+    for i in range(3):
+        add_customer(f"common-{i}", credit_score_history="0,0,0,0,0,0")
+    add_customer("rare", credit_score_history="1,1,1,1,1,1")
+    db.session.commit()
+
+    feature_cache.clear()
+    assert prewarm_feature_cache(db, 1) == 1
+    assert feature_cache.stats()["size"] == 1
+    assert feature_cache.stats()["misses"] == 0
+
+    preprocess(0.5, [0] * 6)
+    assert feature_cache.stats()["hits"] == 1
+
+
+def test_feature_cache_stats_route(client):
+    feature_cache.clear()
+    preprocess(0.5, [-1] * 6)
+    response = client.get("/feature-cache-stats")
+    assert response.status_code == 200
+    assert response.get_json()["misses"] == 1
@@ -0,0 +1,52 @@
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from features import get_feature_spec
+from service import preprocess_batch, preprocess_tsfresh
+from test_features import PAYMENT_HISTORIES
+
+
+def test_preprocess_batch_matches_tsfresh():
+    ratios = np.linspace(0, 1, len(PAYMENT_HISTORIES))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = pd.concat([preprocess_tsfresh(ratio, history) for ratio, history in zip(ratios, PAYMENT_HISTORIES)], ignore_index=True)
+
+    actual = preprocess_batch(ratios, PAYMENT_HISTORIES)
+
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize("length", [1, 2, 3, 4, 5, 6, 7, 8, 12])
+def test_preprocess_batch_matches_tsfresh_for_every_history_length(length):
+    # Below a calculator's minimum length tsfresh returns NaN or 0 rather than raising
+    rng = np.random.default_rng(length)
+    histories = np.concatenate([[[-1] * length, [0] * length], rng.integers(-2, 9, size=(6, length))])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = pd.concat([preprocess_tsfresh(0.3, history) for history in histories], ignore_index=True)
+
+    actual = preprocess_batch(np.full(len(histories), 0.3), histories)
+
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False, rtol=1e-9, atol=1e-9)
+
+
+def test_preprocess_batch_matches_targeted_extractor_on_random_histories():
+    rng = np.random.default_rng(4103)
+    histories = np.concatenate([
+        rng.integers(-2, 4, size=(200, 6)),
+        rng.integers(-2, 10, size=(200, 6)),
+        rng.choice([-2, -1, 0], size=(200, 6)),
+    ])
+    spec = get_feature_spec()
+
+    expected = np.array([spec.extract(history) for history in histories])
+    actual = preprocess_batch(np.zeros(len(histories)), histories).to_numpy()[:, 1:]
+
+    np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-9)
+
+
+def test_preprocess_batch_handles_no_customers():
+    assert preprocess_batch([], np.empty((0, 6))).shape == (0, len(get_feature_spec().columns))
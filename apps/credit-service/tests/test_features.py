@@ -0,0 +1,49 @@
+import warnings
+import pandas as pd
+import pytest
+from features import get_feature_spec
+from service import preprocess, preprocess_tsfresh
+
+PAYMENT_HISTORIES = [
+    [-1, -1, -1, -1, -1, -1],
+    [-2, -2, -2, -2, -2, -2],
+    [0, 0, 0, 0, 0, 0],
+    [-1, -1, 2, 3, -1, -2],
+    [-2, -2, -1, -1, 2, -1],
+    [6, 5, 4, 3, 2, -1],
+    [-1, 9, -1, 9, -1, 9],
+    [0, -1, 2, 3, 4, 6],
+]
+
+
+@pytest.mark.parametrize("payment_history", PAYMENT_HISTORIES)
+def test_targeted_extractor_matches_tsfresh(payment_history):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = preprocess_tsfresh(0.4213, payment_history)
+
+    feature_spec = get_feature_spec()
+    actual = pd.DataFrame([[0.4213, *feature_spec.extract(payment_history)]], columns=feature_spec.columns)
+
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(actual, expected, check_exact=True, check_dtype=False)
+
+
+@pytest.mark.parametrize("payment_history", PAYMENT_HISTORIES)
+def test_preprocess_matches_tsfresh(payment_history):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = preprocess_tsfresh(0.4213, payment_history)
+
+    actual = preprocess(0.4213, payment_history)
+
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False, rtol=1e-9, atol=1e-9)
+
+
+def test_feature_spec_is_parsed_once():
+    spec = get_feature_spec()
+
+    assert get_feature_spec() is spec
+    assert len(spec) == 246
+    assert spec.columns[0] == "CREDIT_UTILISATION_RATIO"
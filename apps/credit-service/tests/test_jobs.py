@@ -0,0 +1,125 @@
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import routes
+from cci import BASE_DIR
+from jobs import JobQueue, MemoryJobStore, FileJobStore, score_report, DONE, FAILED, PENDING
+from models import db, Customer
+from test_batch_update_credit_rating import add_customer
+
+REPORT_PATH = os.path.join(BASE_DIR, "Consumer-Credit-Report.pdf")
+
+
+def wait_for(client, job_id, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f"/jobs/{job_id}").get_json()
+        if job["status"] != PENDING:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+def upload(client, route, **form):
+    with open(REPORT_PATH, "rb") as f:
+        return client.post(route, data={**form, "async": "true", "report": (f, "Consumer-Credit-Report.pdf")}, content_type="multipart/form-data")
+
+
+def test_first_credit_rating_job_scores_in_a_worker_process_and_saves(client, monkeypatch):
+    add_customer("c1", credit_score=0)
+    db.session.commit()
+    queue = JobQueue(store=MemoryJobStore(), max_workers=1)
+    monkeypatch.setattr(routes, "job_queue", queue)
+    try:
+        response = upload(client, "/get-first-credit-rating", customer_id="c1")
+        assert response.status_code == 202
+        job = wait_for(client, response.get_json()["job_id"])
+    finally:
+        queue.shutdown()
+
+    expected = score_report(REPORT_PATH)
+    assert job["status"] == DONE
+    assert job["result"] == expected
+    db.session.expire_all()
+    customer = db.session.get(Customer, "c1")
+    assert customer.credit_score == expected["credit_score"]
+    assert customer.credit_score_history == ",".join(map(str, expected["payment_history"]))
+
+
+def test_full_queue_is_rejected_with_429(client, monkeypatch):
+    release = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    queue = JobQueue(store=MemoryJobStore(), max_pending=1, executor=executor)
+    monkeypatch.setattr(routes, "job_queue", queue)
+
+    def score_report(path, remove):
+        release.wait()
+        os.remove(path)
+        return {"credit_score": 1}
+    monkeypatch.setattr(routes, "score_report", score_report)
+    try:
+        first = upload(client, "/get-admin-credit-rating")
+        second = upload(client, "/get-admin-credit-rating")
+        assert first.status_code == 202
+        assert second.status_code == 429
+        assert second.headers["Retry-After"] == "1"
+
+        release.set()
+        assert wait_for(client, first.get_json()["job_id"])["result"] == {"credit_score": 1}
+        assert upload(client, "/get-admin-credit-rating").status_code == 202
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_failed_job_reports_the_error(client, monkeypatch):
+    queue = JobQueue(store=MemoryJobStore(), executor=ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(routes, "job_queue", queue)
+    response = client.post("/get-admin-credit-rating", data={"async": "1", "report": (io.BytesIO(b"not a pdf"), "report.pdf")}, content_type="multipart/form-data")
+
+    job = wait_for(client, response.get_json()["job_id"])
+    assert job["status"] == FAILED
+    assert job["error"]
+    assert queue.stats()["pending"] == 0
+
+
+def test_only_the_scored_report_is_spooled(client, monkeypatch):
+    queue = JobQueue(store=MemoryJobStore(), executor=ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(routes, "job_queue", queue)
+    spooled = []
+    spool_to_file = routes.spool_to_file
+    monkeypatch.setattr(routes, "spool_to_file", lambda file: spooled.append(spool_to_file(file)) or spooled[-1])
+
+    with open(REPORT_PATH, "rb") as f:
+        response = client.post("/get-admin-credit-rating", data={"async": "1", "other": (io.BytesIO(b"not a pdf"), "other.pdf"), "report": (f, "report.pdf")}, content_type="multipart/form-data")
+    job = wait_for(client, response.get_json()["job_id"])
+
+    assert job["status"] == DONE
+    assert job["result"] == score_report(REPORT_PATH)
+    assert len(spooled) == 1
+    assert not os.path.exists(spooled[0])
+
+
+def test_a_job_without_a_report_is_rejected_with_400(app):
+    with app.test_request_context("/get-admin-credit-rating", method="POST", data={"async": "1"}):
+        response, status = routes.submit_report_job("admin-credit-rating")
+    assert status == 400
+
+
+def test_unknown_job_is_404(client):
+    assert client.get("/jobs/0123").status_code == 404
+
+
+def test_file_store_round_trips_and_prunes_finished_jobs(tmp_path):
+    store = FileJobStore(str(tmp_path))
+    job = {"job_id": "a" * 32, "status": DONE, "finished_at": 100.0}
+    store.put(job)
+    assert FileJobStore(str(tmp_path)).get("a" * 32) == job
+    assert store.get("../escape") is None
+
+    store.prune(before=50.0)
+    assert store.get("a" * 32) == job
+    store.prune(before=200.0)
+    assert store.get("a" * 32) is None
@@ -0,0 +1,80 @@
+import json
+import pytest
+import loadtest
+
+
+def test_load_test_drives_the_mix_against_a_served_app(tmp_path, monkeypatch):
+    monkeypatch.setenv("CCI_CACHE_DIR", str(tmp_path / "cci_cache"))
+    profile_path = str(tmp_path / "server.folded")
+
+    result = loadtest.load_test(
+        f"sqlite:///{tmp_path / 'loadtest.db'}",
+        mix="update-credit-rating=3,get-first-credit-rating=1,batch-update-credit-rating=1",
+        concurrency=[1, 2],
+        duration=1,
+        warmup=0.5,
+        profile_path=profile_path,
+    )
+
+    assert [step["concurrency"] for step in result["steps"]] == [1, 2]
+    for step in result["steps"]:
+        overall = step["overall"]
+        assert overall["requests"] > 0
+        assert overall["error_rate"] == 0
+        assert overall["p50_ms"] <= overall["p95_ms"] <= overall["max_ms"]
+        assert set(step["endpoints"]) <= {"update-credit-rating", "get-first-credit-rating", "batch-update-credit-rating"}
+        assert sum(endpoint["requests"] for endpoint in step["endpoints"].values()) == overall["requests"]
+        assert step["stages"]["model_inference"]["count"] > 0
+    with open(profile_path) as f:
+        assert "preprocess (service.py:" in f.read()
+    json.dumps(result)
+
+
+def test_open_loop_latency_counts_from_when_a_request_was_due(monkeypatch):
+    # A server that takes 50ms per request, offered 100 requests/s by a single client, falls
+    # further behind with every request
+    def slow_send(connection, request):
+        loadtest.time.sleep(0.05)
+        return 200
+
+    monkeypatch.setattr(loadtest, "send", slow_send)
+    factory = loadtest.RequestFactory(["customer"])
+    step = loadtest.run_step(None, factory, {"update-credit-rating": 1}, duration=0.5, concurrency=1, rate=100)
+
+    overall = step["overall"]
+    assert overall["requests"] == 50
+    assert overall["max_ms"] > 1000
+    assert overall["p50_ms"] > 500
+
+
+def test_admin_requests_differ_unless_repeated():
+    factory = loadtest.RequestFactory(["customer"])
+
+    def content(endpoint):
+        # The body without its multipart boundary, which differs on every request
+        _, _, body, headers = factory.build(endpoint)
+        return body.replace(headers["Content-Type"].partition("boundary=")[2].encode(), b"")
+
+    for endpoint in ("admin-update-credit-rating", "get-admin-credit-rating"):
+        assert content(endpoint) != content(endpoint)
+    for endpoint in ("admin-update-credit-rating-repeated", "get-admin-credit-rating-repeated"):
+        assert content(endpoint) == content(endpoint)
+
+
+def test_parse_mix():
+    assert loadtest.parse_mix("update-credit-rating=8, get-first-credit-rating=2") == {"update-credit-rating": 8, "get-first-credit-rating": 2}
+    assert loadtest.parse_mix("update-credit-rating") == {"update-credit-rating": 1}
+    with pytest.raises(Exception, match="Unknown endpoint"):
+        loadtest.parse_mix("delete-everything=1")
+
+
+def test_stage_breakdown_is_the_difference_between_two_metrics_scrapes():
+    before = loadtest.stage_totals('credit_service_stage_duration_seconds_sum{stage="db_fetch"} 1.5\ncredit_service_stage_duration_seconds_count{stage="db_fetch"} 10\n')
+    after = loadtest.stage_totals(
+        'credit_service_stage_duration_seconds_bucket{stage="db_fetch",le="0.1"} 14\n'
+        'credit_service_stage_duration_seconds_sum{stage="db_fetch"} 2.5\ncredit_service_stage_duration_seconds_count{stage="db_fetch"} 15\n'
+        'credit_service_stage_duration_seconds_sum{stage="commit"} 0.5\ncredit_service_stage_duration_seconds_count{stage="commit"} 5\n'
+    )
+    breakdown = loadtest.stage_breakdown(before, after)
+    assert breakdown["db_fetch"] == {"count": 5, "seconds": 1.0, "mean_ms": 200.0}
+    assert breakdown["commit"]["count"] == 5
@@ -0,0 +1,118 @@
+import os
+import time
+import metrics
+import profiling
+from metrics import Counter, Histogram, STAGE_SECONDS, REQUESTS, REQUEST_ERRORS
+from test_batch_update_credit_rating import seed
+
+
+def test_histogram_renders_cumulative_prometheus_buckets():
+    histogram = Histogram("latency_seconds", "Latency.", ["stage"], buckets=[0.1, 1.0])
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value, stage='say "hi"')
+
+    assert histogram.render() == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{stage="say \\"hi\\"",le="0.1"} 2',
+        'latency_seconds_bucket{stage="say \\"hi\\"",le="1.0"} 3',
+        'latency_seconds_bucket{stage="say \\"hi\\"",le="+Inf"} 4',
+        'latency_seconds_sum{stage="say \\"hi\\""} 2.65',
+        'latency_seconds_count{stage="say \\"hi\\""} 4',
+    ]
+
+
+def test_counter_renders_one_series_per_label_set():
+    counter = Counter("requests_total", "Requests.", ["endpoint"])
+    counter.inc(endpoint="/a")
+    counter.inc(2, endpoint="/a")
+    counter.inc(endpoint="/b")
+    assert counter.render()[2:] == ['requests_total{endpoint="/a"} 3', 'requests_total{endpoint="/b"} 1']
+
+
+def test_values_written_by_other_processes_are_added_up():
+    counter = Counter("requests_total", "Requests.", ["endpoint"])
+    histogram = Histogram("latency_seconds", "Latency.", buckets=[0.1])
+    counter.inc(endpoint="/a")
+    histogram.observe(0.05)
+    other_counter = Counter("requests_total", "Requests.", ["endpoint"])
+    other_histogram = Histogram("latency_seconds", "Latency.", buckets=[0.1])
+    other_counter.inc(2, endpoint="/a")
+    other_counter.inc(endpoint="/b")
+    other_histogram.observe(0.5)
+
+    assert counter.render([other_counter.snapshot()])[2:] == ['requests_total{endpoint="/a"} 3', 'requests_total{endpoint="/b"} 1']
+    assert histogram.render([other_histogram.snapshot()])[2:] == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="+Inf"} 2',
+        "latency_seconds_sum 0.55",
+        "latency_seconds_count 2",
+    ]
+
+
+def test_scoring_records_stage_timings_and_request_counts(client):
+    seed()
+    stages = ["db_fetch", "monthly_status", "feature_extraction", "model_inference", "commit"]
+    before = {name: STAGE_SECONDS.count(stage=name) for name in stages}
+    requests_before = REQUESTS.value(endpoint="/batch-update-credit-rating", method="POST", status="200")
+    errors_before = REQUEST_ERRORS.value(endpoint="/update-credit-rating")
+
+    assert client.post("/batch-update-credit-rating", json={"customer_ids": ["on-time", "late"]}).status_code == 200
+    assert client.post("/update-credit-rating", json={"customer_id": "missing"}).status_code == 500
+
+    for name in stages:
+        assert STAGE_SECONDS.count(stage=name) > before[name], name
+    assert REQUESTS.value(endpoint="/batch-update-credit-rating", method="POST", status="200") == requests_before + 1
+    assert REQUEST_ERRORS.value(endpoint="/update-credit-rating") == errors_before + 1
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert 'credit_service_stage_duration_seconds_count{stage="model_inference"}' in response.get_data(as_text=True)
+    assert 'credit_service_requests_total{endpoint="/batch-update-credit-rating",method="POST",status="200"}' in response.get_data(as_text=True)
+
+
+def test_slow_requests_are_profiled_in_folded_format(app, tmp_path):
+    profiling.init_app(app, threshold="0.01", interval=0.001, directory=str(tmp_path))
+
+    @app.route("/slow")
+    def slow():
+        time.sleep(0.05)
+        return "done"
+
+    @app.route("/fast")
+    def fast():
+        return "done"
+
+    client = app.test_client()
+    client.get("/fast")
+    assert os.listdir(tmp_path) == []
+
+    client.get("/slow")
+    [filename] = os.listdir(tmp_path)
+    assert filename.endswith("-slow.folded")
+    with open(tmp_path / filename) as f:
+        lines = f.read().splitlines()
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert stack.split(";")[-1].startswith("slow (test_metrics.py:")
+
+
+def test_stack_sampler_without_a_thread_id_samples_every_other_thread():
+    stop = profiling.threading.Event()
+
+    def busy():
+        while not stop.is_set():
+            sum(range(1000))
+
+    thread = profiling.threading.Thread(target=busy)
+    thread.start()
+    sampler = profiling.StackSampler(interval=0.001, exclude={profiling.threading.get_ident()}).start()
+    time.sleep(0.05)
+    sampler.stop()
+    stop.set()
+    thread.join()
+
+    innermost = {stack.split(";")[-1].split(" (")[0] for stack in sampler.samples}
+    assert "busy" in innermost
+    assert not any("test_stack_sampler" in stack or "_run (profiling.py" in stack for stack in sampler.samples)
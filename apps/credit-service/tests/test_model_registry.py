@@ -0,0 +1,100 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import service
+from model_registry import ModelRegistry, DEFAULT_MODEL_PATH
+
+CHECK_INTERVAL = 0.2
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    path = tmp_path / "model.txt"
+    shutil.copy(DEFAULT_MODEL_PATH, path)
+    return path
+
+
+@pytest.fixture
+def registry(model_path):
+    registry = ModelRegistry(check_interval=CHECK_INTERVAL)
+    registry.register("lgb_model_v3", str(model_path), primary=True)
+    return registry
+
+
+def rewrite(path, content):
+    # A later mtime than the previous write, however coarse the filesystem's timestamps are
+    mtime = os.stat(path).st_mtime
+    with open(path, "wb") as f:
+        f.write(content)
+    os.utime(path, (mtime + 10, mtime + 10))
+
+
+def features():
+    return service.preprocess_batch(np.array([0.1, 0.5]), np.array([[-1] * 6, [2, 2, -1, -1, 3, -1]]))
+
+
+def test_a_new_model_file_is_picked_up_after_the_check_interval(registry, model_path):
+    old = registry.get()
+    with open(model_path, "rb") as f:
+        content = f.read()
+    rewrite(model_path, content + b"\n")
+
+    # Not stat'ed again before the interval is up
+    assert registry.get() is old
+    time.sleep(CHECK_INTERVAL)
+    new = registry.get()
+    assert new.version != old.version
+    assert new.version.startswith("lgb_model_v3@")
+    np.testing.assert_array_equal(new.predict(features()), old.predict(features()))
+
+
+def test_a_touched_file_with_the_same_content_is_not_reloaded(registry, model_path):
+    old = registry.get()
+    with open(model_path, "rb") as f:
+        rewrite(model_path, f.read())
+    time.sleep(CHECK_INTERVAL)
+
+    assert registry.get() is old
+
+
+def test_a_corrupt_file_keeps_the_previous_model_serving(registry, model_path):
+    old = registry.get()
+    rewrite(model_path, b"tree\nnot a model")
+    time.sleep(CHECK_INTERVAL)
+
+    assert registry.get() is old
+    assert len(old.predict(features())) == 2
+    # Nor is it loaded once the next interval is up
+    time.sleep(CHECK_INTERVAL)
+    assert registry.get() is old
+
+
+def test_a_prediction_in_flight_finishes_with_the_model_it_started_with(registry, model_path, monkeypatch):
+    monkeypatch.setattr(service, "model_registry", registry)
+    old = registry.get()
+    started, release = threading.Event(), threading.Event()
+    predict = old.booster.predict
+
+    def slow_predict(X):
+        started.set()
+        release.wait()
+        return predict(X)
+
+    monkeypatch.setattr(old.booster, "predict", slow_predict)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        in_flight = executor.submit(service.predict, features(), True, [])
+        started.wait()
+        with open(model_path, "rb") as f:
+            rewrite(model_path, f.read() + b"\n")
+        time.sleep(CHECK_INTERVAL)
+        new_version = service.predict(features(), with_version=True, shadow_models=[])[1]
+        release.set()
+        credit_ratings, version = in_flight.result()
+
+    assert new_version != old.version
+    assert version == old.version
+    assert len(credit_ratings) == 2
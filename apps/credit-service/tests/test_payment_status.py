@@ -0,0 +1,129 @@
+import random
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+import pytest
+import payment_status
+import service
+from models import db, CustomerPaymentStatus, InstalmentPayment, InstalmentPaymentStatus
+from repository import get_payment_statuses
+from service import get_monthly_payment_statuses, payment_statuses_valid_until, get_payment_history_and_credit_utilisation_ratio, get_payment_histories_and_credit_utilisation_ratios
+from test_batch_update_credit_rating import add_customer, add_instalments, seed
+from test_repository import count_queries
+
+CUSTOMER_IDS = ["on-time", "late", "new-customer"]
+
+
+def live_statuses(instalment_payments, now):
+    # What scoring computes at now: the instalments due in the last 6 months, by month
+    recent = [payment for payment in instalment_payments if payment["due_date"] >= now - relativedelta(months=6)]
+    return get_monthly_payment_statuses(recent, now)
+
+
+def test_statuses_do_not_change_before_valid_until():
+    rng = random.Random(7)
+    for _ in range(200):
+        now = datetime(2024, 1, 1) + timedelta(days=rng.randrange(366), seconds=rng.randrange(86400))
+        instalment_payments = []
+        for _ in range(rng.randrange(1, 6)):
+            due_date = now - timedelta(days=rng.randrange(-60, 180), seconds=rng.randrange(86400))
+            paid = rng.random() < 0.5 and due_date < now
+            instalment_payments.append({"due_date": due_date, "paid_date": due_date + timedelta(days=rng.randrange(0, 120)) if paid else None})
+        recent = [payment for payment in instalment_payments if payment["due_date"] >= now - relativedelta(months=6)]
+        valid_until = payment_statuses_valid_until(recent, now)
+        assert valid_until > now
+
+        expected = live_statuses(instalment_payments, now)
+        for t in [now + (valid_until - now) * fraction for fraction in (0.25, 0.5, 0.9, 0.999)] + [valid_until - timedelta(microseconds=1)]:
+            assert live_statuses(instalment_payments, t) == expected
+
+
+def test_scoring_reads_the_materialised_statuses(app, monkeypatch):
+    seed()
+    monkeypatch.setattr(service, "USE_MATERIALISED_PAYMENT_STATUS", False)
+    expected = {customer_id: get_payment_history_and_credit_utilisation_ratio(db, customer_id) for customer_id in CUSTOMER_IDS}
+    monkeypatch.setattr(service, "USE_MATERIALISED_PAYMENT_STATUS", True)
+
+    # The first score computes and saves the statuses, later ones read them with the rest of the snapshot
+    for customer_id in CUSTOMER_IDS:
+        assert get_payment_history_and_credit_utilisation_ratio(db, customer_id) == expected[customer_id]
+    assert db.session.query(CustomerPaymentStatus).count() == len(CUSTOMER_IDS)
+    for customer_id in CUSTOMER_IDS:
+        with count_queries() as statements:
+            assert get_payment_history_and_credit_utilisation_ratio(db, customer_id) == expected[customer_id]
+        assert len(statements) == 1
+
+    histories, errors = get_payment_histories_and_credit_utilisation_ratios(db, CUSTOMER_IDS)
+    assert errors == {}
+    assert histories == expected
+
+
+def test_paying_an_instalment_expires_the_statuses(app, monkeypatch):
+    monkeypatch.setattr(service, "USE_MATERIALISED_PAYMENT_STATUS", True)
+    seed()
+    before, _ = get_payment_history_and_credit_utilisation_ratio(db, "late")
+
+    instalment = db.session.query(InstalmentPayment).filter(InstalmentPayment.paid_date.is_(None)).one()
+    instalment.status = InstalmentPaymentStatus.PAID
+    instalment.paid_date = instalment.due_date
+    db.session.commit()
+
+    assert get_payment_statuses(db, ["late"], datetime.now()) == {}
+    after, _ = get_payment_history_and_credit_utilisation_ratio(db, "late")
+    assert after != before
+    assert "late" in get_payment_statuses(db, ["late"], datetime.now())
+    assert payment_status.check(db)["mismatched"] == 0
+
+
+def test_payments_made_by_other_services_are_scored_straight_away(app):
+    # The backend pays instalments through Prisma: no mapper event fires and nothing calls
+    # /refresh-payment-status, so scoring does not read the table by default
+    seed()
+    payment_status.rebuild(db)
+    before = get_payment_history_and_credit_utilisation_ratio(db, "late")
+
+    instalment = db.session.query(InstalmentPayment).filter(InstalmentPayment.paid_date.is_(None)).one()
+    db.session.execute(InstalmentPayment.__table__.update().where(
+        InstalmentPayment.instalment_payment_id == instalment.instalment_payment_id
+    ).values(status=InstalmentPaymentStatus.PAID, paid_date=instalment.due_date))
+    db.session.commit()
+    db.session.expire_all()
+
+    payment_history, _ = get_payment_history_and_credit_utilisation_ratio(db, "late")
+    assert payment_history != before[0]
+    # The table still has the statuses from before the payment
+    assert payment_status.check(db)["mismatched"] == 1
+
+
+def test_rebuild_then_check_finds_no_mismatches(app):
+    seed()
+    assert payment_status.rebuild(db, chunk_size=2) == {"rebuilt": 4}
+    report = payment_status.check(db, chunk_size=2)
+    assert report == {"checked": 4, "missing": 0, "stale": 0, "mismatched": 0, "mismatches": []}
+
+    db.session.query(CustomerPaymentStatus).filter(CustomerPaymentStatus.customer_id == "late").update({"statuses": "6,6,6"})
+    db.session.commit()
+    report = payment_status.check(db, chunk_size=2)
+    assert report["mismatched"] == 1
+    assert report["mismatches"][0]["customer_id"] == "late"
+    assert report["mismatches"][0]["materialised"] == [6, 6, 6]
+
+
+def test_roll_forward_refreshes_the_rows_time_has_made_stale(app):
+    seed()
+    payment_status.rebuild(db)
+    next_month = datetime.now() + relativedelta(months=1)
+    assert get_payment_statuses(db, CUSTOMER_IDS, next_month) == {}
+
+    assert payment_status.roll_forward(db, chunk_size=2, now=next_month) == {"refreshed": 4}
+    assert payment_status.roll_forward(db, chunk_size=2, now=next_month) == {"refreshed": 0}
+    assert payment_status.check(db, now=next_month)["checked"] == 4
+
+
+def test_refresh_payment_status_route(client):
+    seed()
+    response = client.post("/refresh-payment-status", json={"customer_ids": ["late", "new-customer"]})
+    assert response.status_code == 200
+    payment_statuses = response.get_json()["payment_statuses"]
+    assert payment_statuses["new-customer"] == []
+    assert get_payment_statuses(db, ["late"], datetime.now()) == {"late": payment_statuses["late"]}
+    assert client.post("/refresh-payment-status", json={}).status_code == 401
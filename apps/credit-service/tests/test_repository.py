@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+import pytest
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import postgresql
+from models import db, Customer
+from credit_tiers import credit_tier_cache
+from repository import get_most_recent_6_months_instalment_payments, get_most_recent_6_months_instalment_payments_by_customer, get_credit_snapshot, get_customer_credit_limit, get_customer_outstanding_balance, get_credit_score_history, get_first_customer_credit_utilisation_ratio, update_customer_credit, update_customer_credits, bulk_update_statement
+from test_batch_update_credit_rating import add_customer, add_instalments, seed
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def test_recent_instalment_payments_use_one_query(app):
+    seed()
+    # Spread one customer's instalments over several transactions, including one too old to count
+    add_instalments("on-time", [(8, 0), (5, 0)], transaction_id="on-time-second-transaction")
+    db.session.commit()
+
+    with count_queries() as statements:
+        instalment_payments = get_most_recent_6_months_instalment_payments(db, "on-time")
+
+    assert len(statements) == 1
+    assert len(instalment_payments) == 4
+    assert set(instalment_payments[0]) == {"due_date", "paid_date"}
+
+
+def test_bulk_recent_instalment_payments_match_single_customer_query(app):
+    seed()
+    add_customer("another")
+    db.session.commit()
+    customer_ids = ["on-time", "late", "new-customer", "another"]
+
+    with count_queries() as statements:
+        by_customer = get_most_recent_6_months_instalment_payments_by_customer(db, customer_ids)
+
+    assert len(statements) == 1
+    for customer_id in customer_ids:
+        expected = sorted(get_most_recent_6_months_instalment_payments(db, customer_id), key=lambda payment: payment["due_date"])
+        actual = sorted(by_customer.get(customer_id, []), key=lambda payment: payment["due_date"])
+        assert actual == expected
+
+
+def test_credit_snapshot_is_one_query_and_matches_individual_lookups(app):
+    seed()
+    add_instalments("late", [(8, None), (5, 0)], transaction_id="late-second-transaction")
+    db.session.commit()
+    # Credit tiers are read once into the tier cache, not per snapshot
+    credit_tier_cache.get()
+
+    for customer_id in ["on-time", "late", "new-customer"]:
+        with count_queries() as statements:
+            snapshot = get_credit_snapshot(db, customer_id)
+
+        assert len(statements) == 1
+        assert snapshot["credit_score_history"] == get_credit_score_history(customer_id)
+        assert snapshot["credit_utilisation_ratio"] == get_first_customer_credit_utilisation_ratio(customer_id)
+        assert snapshot["credit_limit"] == get_customer_credit_limit(customer_id)
+        assert snapshot["outstanding_balance"] == get_customer_outstanding_balance(customer_id)
+        assert sorted(snapshot["instalment_payments"], key=lambda payment: payment["due_date"]) == \
+            sorted(get_most_recent_6_months_instalment_payments(db, customer_id), key=lambda payment: payment["due_date"])
+
+
+def test_scoring_indexes_exist(app):
+    inspector = inspect(db.engine)
+    instalment_indexes = {index["name"]: index["column_names"] for index in inspector.get_indexes("InstalmentPayment")}
+    transaction_indexes = {index["name"]: index["column_names"] for index in inspector.get_indexes("Transaction")}
+
+    assert instalment_indexes["InstalmentPayment_transaction_id_status_due_date_idx"] == ["transaction_id", "status", "due_date"]
+    assert transaction_indexes["Transaction_customer_id_idx"] == ["customer_id"]
+
+
+def test_credit_update_is_one_statement_without_loading_the_customer(app):
+    add_customer("c1")
+    db.session.commit()
+
+    with count_queries() as statements:
+        update_customer_credit(db, "c1", credit_score=712.9, credit_score_history="-1,-1,2,-1,-1,-1", credit_utilisation_ratio=0.25)
+
+    assert len(statements) == 1
+    assert statements[0].startswith("UPDATE")
+    db.session.expire_all()
+    customer = db.session.get(Customer, "c1")
+    assert (customer.credit_score, customer.credit_score_history, customer.credit_utilisation_ratio) == (712, "-1,-1,2,-1,-1,-1", 0.25)
+
+
+def test_credit_update_of_a_missing_customer_fails(app):
+    with pytest.raises(Exception, match="Customer not found"):
+        update_customer_credit(db, "missing", credit_score=500)
+
+
+def test_bulk_credit_update_is_one_statement_per_field_set(app):
+    for i in range(2500):
+        add_customer(f"c{i}")
+    db.session.commit()
+
+    credits = {f"c{i}": {"credit_score": i % 1000} for i in range(2000)}
+    credits.update({f"c{i}": {"credit_score": 1, "credit_utilisation_ratio": 0.5} for i in range(2000, 2500)})
+    with count_queries() as statements:
+        update_customer_credits(db, credits)
+
+    assert len(statements) == 2
+    db.session.expire_all()
+    scores = dict(db.session.query(Customer.customer_id, Customer.credit_score).all())
+    assert scores["c1999"] == 999
+    assert scores["c2499"] == 1
+    assert db.session.get(Customer, "c2499").credit_utilisation_ratio == 0.5
+
+
+def test_bulk_credit_update_renders_update_from_values_on_postgresql():
+    statement = bulk_update_statement(("credit_score", "credit_utilisation_ratio"), [
+        {"customer_id": "c1", "credit_score": 500, "credit_utilisation_ratio": 0.1},
+        {"customer_id": "c2", "credit_score": 600, "credit_utilisation_ratio": 0.2},
+    ])
+    sql = " ".join(str(statement.compile(dialect=postgresql.dialect())).split())
+
+    assert sql.startswith('UPDATE "Customer" SET credit_score=credit_updates.credit_score, credit_utilisation_ratio=credit_updates.credit_utilisation_ratio FROM (VALUES')
+    assert sql.endswith('AS credit_updates (customer_id, credit_score, credit_utilisation_ratio) WHERE "Customer".customer_id = credit_updates.customer_id')
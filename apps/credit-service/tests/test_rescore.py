@@ -0,0 +1,76 @@
+import json
+import pytest
+import rescore
+from models import db, Customer, CustomerStatus
+from service import get_payment_history_and_credit_utilisation_ratio, preprocess, predict
+from test_batch_update_credit_rating import add_customer, add_instalments, seed
+
+
+def seed_customers():
+    seed()
+    for i in range(5):
+        add_customer(f"extra-{i}", credit_score_history=f"-1,-1,{i},-1,-1,-1")
+    add_instalments("extra-0", [(2, 1), (1, None)])
+    add_customer("suspended", credit_score=123)
+    db.session.commit()
+    db.session.query(Customer).filter(Customer.customer_id == "suspended").update({"status": CustomerStatus.SUSPENDED})
+    db.session.commit()
+
+
+def expected_scores():
+    expected = {}
+    for (customer_id,) in db.session.query(Customer.customer_id).filter(Customer.status == CustomerStatus.ACTIVE, Customer.customer_id != "no-history"):
+        payment_history, credit_utilisation_ratio = get_payment_history_and_credit_utilisation_ratio(db, customer_id)
+        expected[customer_id] = int(predict(preprocess(credit_utilisation_ratio, payment_history))[0])
+    return expected
+
+
+def scores():
+    db.session.expire_all()
+    return dict(db.session.query(Customer.customer_id, Customer.credit_score).all())
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_rescore_scores_every_active_customer(app, tmp_path, workers):
+    seed_customers()
+    expected = expected_scores()
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    summary = rescore.rescore(db, chunk_size=3, workers=workers, checkpoint_path=checkpoint_path)
+
+    assert summary["scored"] == len(expected)
+    assert summary["errors"] == 1  # no-history has no credit score history to pad with
+    actual = scores()
+    assert {customer_id: actual[customer_id] for customer_id in expected} == expected
+    assert actual["suspended"] == 123
+    assert not (tmp_path / "checkpoint.json").exists()
+
+
+def test_interrupted_rescore_resumes_from_the_checkpoint(app, tmp_path, monkeypatch):
+    seed_customers()
+    expected = expected_scores()
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    writes = []
+    update_customer_credits = rescore.update_customer_credits
+
+    def fail_on_second_chunk(db, credits):
+        if writes:
+            raise Exception("connection lost")
+        writes.append(credits)
+        update_customer_credits(db, credits)
+    monkeypatch.setattr(rescore, "update_customer_credits", fail_on_second_chunk)
+    with pytest.raises(Exception, match="connection lost"):
+        rescore.rescore(db, chunk_size=3, workers=0, checkpoint_path=checkpoint_path)
+
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    assert checkpoint["last_customer_id"] == sorted(expected)[2]
+    assert checkpoint["scored"] == 3
+
+    monkeypatch.setattr(rescore, "update_customer_credits", update_customer_credits)
+    summary = rescore.rescore(db, chunk_size=3, workers=0, checkpoint_path=checkpoint_path)
+    assert summary["scored_this_run"] == len(expected) - 3
+    assert summary["scored"] == len(expected)
+    actual = scores()
+    assert {customer_id: actual[customer_id] for customer_id in expected} == expected
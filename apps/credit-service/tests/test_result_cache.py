@@ -0,0 +1,169 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import routes
+from cci import BASE_DIR
+from result_cache import ResultCache, result_cache
+
+REPORT_PATH = os.path.join(BASE_DIR, "Consumer-Credit-Report.pdf")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_results_are_served_until_they_expire():
+    clock = Clock()
+    cache = ResultCache(maxsize=10, ttl=60, clock=clock)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get_or_compute("key", compute) == 1
+    clock.now = 59
+    assert cache.get_or_compute("key", compute) == 1
+    clock.now = 61
+    assert cache.get_or_compute("key", compute) == 2
+    assert cache.stats() == {"size": 1, "maxsize": 10, "ttl": 60, "hits": 1, "misses": 2, "coalesced": 0, "expirations": 1, "evictions": 0, "errors": 0, "hit_rate": 1 / 3}
+
+
+def test_least_recently_used_results_are_evicted():
+    cache = ResultCache(maxsize=2, ttl=60)
+    cache.get_or_compute("a", lambda: "a")
+    cache.get_or_compute("b", lambda: "b")
+    cache.get_or_compute("a", lambda: "stale")
+    cache.get_or_compute("c", lambda: "c")
+
+    assert cache.get_or_compute("a", lambda: "recomputed") == "a"
+    assert cache.get_or_compute("b", lambda: "recomputed") == "recomputed"
+    assert cache.stats()["evictions"] == 2
+
+
+def test_concurrent_identical_requests_share_one_computation():
+    cache = ResultCache(maxsize=10, ttl=60)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "result"
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        leader = executor.submit(cache.get_or_compute, "key", compute)
+        started.wait()
+        followers = [executor.submit(cache.get_or_compute, "key", compute) for _ in range(7)]
+        while cache.stats()["coalesced"] < 7:
+            pass
+        release.set()
+        assert [future.result() for future in [leader, *followers]] == ["result"] * 8
+
+    assert len(calls) == 1
+    assert cache.stats()["coalesced"] == 7
+
+
+def test_failures_reach_every_waiting_request_and_are_not_cached():
+    cache = ResultCache(maxsize=10, ttl=60)
+    started, release = threading.Event(), threading.Event()
+
+    def fail():
+        started.set()
+        release.wait()
+        raise Exception("No balance found in PDF")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(cache.get_or_compute, "key", fail)
+        started.wait()
+        follower = executor.submit(cache.get_or_compute, "key", fail)
+        while cache.stats()["coalesced"] < 1:
+            pass
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(Exception, match="No balance found"):
+                future.result()
+
+    assert cache.get_or_compute("key", lambda: "retried") == "retried"
+    assert cache.stats()["errors"] == 1
+
+
+@pytest.fixture
+def cache():
+    result_cache.clear()
+    yield result_cache
+    result_cache.clear()
+
+
+def test_admin_what_if_scores_are_cached_by_normalised_inputs(client, cache, monkeypatch):
+    calls = []
+    predict = routes.predict
+    monkeypatch.setattr(routes, "predict", lambda X, with_version=False: calls.append(1) or predict(X, with_version))
+
+    first = client.post("/admin-update-credit-rating", json={"creditUtilisationRatio": 0.3, "paymentHistory": [-1, 2, -1, -1, -1, -1]})
+    # Same inputs written differently
+    second = client.post("/admin-update-credit-rating", json={"creditUtilisationRatio": "0.30", "paymentHistory": [-1.0, 2, -1, -1, -1, -1]})
+    other = client.post("/admin-update-credit-rating", json={"creditUtilisationRatio": 0.9, "paymentHistory": [-1, 2, -1, -1, -1, -1]})
+
+    assert first.status_code == second.status_code == other.status_code == 200
+    assert second.get_json() == first.get_json()
+    assert len(calls) == 2
+    assert client.get("/result-cache-stats").get_json()["hits"] == 1
+
+
+@pytest.mark.parametrize("body", [
+    {"paymentHistory": [-1, -1, -1, -1, -1, -1]},
+    {"creditUtilisationRatio": "high", "paymentHistory": [-1, -1, -1, -1, -1, -1]},
+    {"creditUtilisationRatio": 0.3},
+    {"creditUtilisationRatio": 0.3, "paymentHistory": [[-1, 2]]},
+    {"creditUtilisationRatio": 0.3, "paymentHistory": []},
+    {"creditUtilisationRatio": "nan", "paymentHistory": [-1, -1, -1, -1, -1, -1]},
+    {"creditUtilisationRatio": "inf", "paymentHistory": [-1, -1, -1, -1, -1, -1]},
+    {"creditUtilisationRatio": 0.3, "paymentHistory": [-1, "-inf", -1, -1, -1, -1]},
+])
+def test_invalid_what_if_inputs_are_rejected_before_the_cache(client, cache, body):
+    response = client.post("/admin-update-credit-rating", json=body)
+
+    assert response.status_code == 400
+    assert "creditUtilisationRatio" in response.get_json()["error"]
+    assert cache.stats()["misses"] == 0
+
+
+def test_a_new_model_version_is_not_answered_from_the_cache(client, cache, monkeypatch):
+    body = {"creditUtilisationRatio": 0.3, "paymentHistory": [-1, -1, -1, -1, -1, -1]}
+    client.post("/admin-update-credit-rating", json=body)
+    monkeypatch.setattr(routes, "current_model_version", lambda: "lgb_model_v4@000000000000")
+    client.post("/admin-update-credit-rating", json=body)
+
+    assert cache.stats()["misses"] == 2
+
+
+def test_report_uploads_are_cached_by_content(client, cache, monkeypatch):
+    calls = []
+    extract = routes.extract_payment_history_and_credit_utilisation_ratio_from_report
+
+    def counting_extract(file):
+        calls.append(1)
+        return extract(file)
+
+    monkeypatch.setattr(routes, "extract_payment_history_and_credit_utilisation_ratio_from_report", counting_extract)
+    with open(REPORT_PATH, "rb") as f:
+        content = f.read()
+
+    responses = [
+        client.post("/get-admin-credit-rating", data={"report": (io.BytesIO(content), filename)}, content_type="multipart/form-data")
+        for filename in ("report.pdf", "renamed.pdf")
+    ]
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert responses[0].get_json() == responses[1].get_json()
+    assert len(calls) == 1
+    assert client.post("/get-admin-credit-rating", data={"report": (io.BytesIO(b"not a pdf"), "report.pdf")}, content_type="multipart/form-data").status_code == 500
+    assert cache.stats()["errors"] == 1
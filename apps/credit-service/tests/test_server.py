@@ -0,0 +1,236 @@
+import json
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import pytest
+import server
+from main import engine_options, create_app
+from models import db
+from benchmark import build_database
+
+SRC_DIR = os.path.dirname(os.path.abspath(server.__file__))
+BASE_DIR = os.path.dirname(SRC_DIR)
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="forks and reads /proc")
+
+
+def test_engine_options_size_the_pool_of_each_worker(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "2")
+    monkeypatch.setenv("DB_POOL_RECYCLE", "600")
+
+    options = engine_options("postgresql://localhost/credit")
+    assert options == {"pool_pre_ping": True, "pool_recycle": 600, "pool_size": 3, "max_overflow": 2, "pool_timeout": 30.0}
+    # SQLite pools are not sized
+    assert "pool_size" not in engine_options("sqlite://")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def workers_of(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return {int(child) for child in f.read().split()}
+
+
+def wait_for(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            result = condition()
+            if result:
+                return result
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise AssertionError("timed out")
+
+
+def get(port, path):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=30) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def start_server(port, workers, env=None):
+    process = subprocess.Popen([sys.executable, "server.py", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers)], cwd=SRC_DIR, env=env or dict(os.environ))
+    wait_for(lambda: len(workers_of(process.pid)) == workers and get(port, "/result-cache-stats"))
+    return process
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(timeout=60) == 0
+
+
+def score(port, customer_id):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/update-credit-rating", json.dumps({"customer_id": customer_id}).encode(), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)
+
+
+def seed_database(tmp_path, monkeypatch):
+    monkeypatch.setenv("SQLALCHEMY_DATABASE_URI", f"sqlite:///{tmp_path / 'credit.db'}")
+    monkeypatch.setenv("CCI_CACHE_DIR", str(tmp_path / "cci_cache"))
+    app = create_app(warm_up=False)
+    with app.app_context():
+        build_database(db, 100)
+        db.engine.dispose()
+    return app
+
+
+def test_workers_share_the_preloaded_app_and_are_replaced_on_model_updates(tmp_path, monkeypatch):
+    seed_database(tmp_path, monkeypatch)
+    model_path = tmp_path / "model.txt"
+    shutil.copy(os.path.join(BASE_DIR, "lgb_model_v3.txt"), model_path)
+    env = dict(os.environ, CREDIT_MODEL_PATH=str(model_path), MODEL_RELOAD_CHECK_INTERVAL="0.2")
+
+    port = free_port()
+    process = subprocess.Popen([sys.executable, "server.py", "--host", "127.0.0.1", "--port", str(port), "--workers", "2"], cwd=SRC_DIR, env=env)
+    try:
+        workers = wait_for(lambda: len(workers_of(process.pid)) == 2 and workers_of(process.pid))
+        first = wait_for(lambda: score(port, "customer-0000001"))
+        assert 0 <= first["credit_score"] <= 1000
+
+        # Idle workers have written to little of the memory they inherited
+        for pid in workers:
+            usage = server.memory_usage(pid)
+            assert usage["private"] < usage["rss"] / 2
+
+        # A new model file: every worker is replaced by one forked with the new model
+        with open(model_path, "a") as f:
+            f.write("\n")
+        wait_for(lambda: workers_of(process.pid).isdisjoint(workers) and len(workers_of(process.pid)) == 2)
+        second = score(port, "customer-0000001")
+        assert second["model_version"] != first["model_version"]
+
+        # SIGHUP replaces them again
+        workers = workers_of(process.pid)
+        process.send_signal(signal.SIGHUP)
+        wait_for(lambda: workers_of(process.pid).isdisjoint(workers) and len(workers_of(process.pid)) == 2)
+        assert score(port, "customer-0000002")["model_version"] == second["model_version"]
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=30) == 0
+
+
+def test_jobs_can_be_polled_from_any_worker(tmp_path, monkeypatch):
+    seed_database(tmp_path, monkeypatch)
+    monkeypatch.delenv("JOB_QUEUE_BACKEND", raising=False)
+    monkeypatch.setenv("JOB_DIR", str(tmp_path / "jobs"))
+    port = free_port()
+    process = start_server(port, 2)
+    try:
+        with open(os.path.join(BASE_DIR, "Consumer-Credit-Report.pdf"), "rb") as f:
+            content = f.read()
+        body = (b"--b\r\nContent-Disposition: form-data; name=\"async\"\r\n\r\ntrue\r\n"
+                b"--b\r\nContent-Disposition: form-data; name=\"report\"; filename=\"report.pdf\"\r\n\r\n" + content + b"\r\n--b--\r\n")
+        request = urllib.request.Request(f"http://127.0.0.1:{port}/get-admin-credit-rating", body, {"Content-Type": "multipart/form-data; boundary=b"})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            assert response.status == 202
+            job_id = json.load(response)["job_id"]
+
+        # Every poll opens a new connection, which either worker may accept
+        for _ in range(20):
+            status, job = get(port, f"/jobs/{job_id}")
+            assert status == 200
+        assert wait_for(lambda: get(port, f"/jobs/{job_id}")[1]["status"] == "done")
+    finally:
+        stop_server(process)
+
+
+def post(port, path, data):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", json.dumps(data).encode(), {"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_invalidating_the_credit_tiers_reaches_every_worker(tmp_path, monkeypatch):
+    seed_database(tmp_path, monkeypatch)
+    port = free_port()
+    process = start_server(port, 2)
+    try:
+        for i in range(10):
+            assert post(port, "/update-credit-rating", {"customer_id": f"customer-000000{i}"})[0] == 200
+
+        # Tiers removed by another service, then announced to one worker
+        with sqlite3.connect(tmp_path / "credit.db") as connection:
+            connection.execute('DELETE FROM "CreditTier"')
+        assert post(port, "/invalidate-credit-tiers", {})[0] == 200
+        time.sleep(2)
+
+        for i in range(10):
+            status, body = post(port, "/update-credit-rating", {"customer_id": f"customer-000000{i}"})
+            assert status == 500
+            assert "credit tier" in body["error"]
+    finally:
+        stop_server(process)
+
+
+def scrape(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=30) as response:
+        return response.read().decode()
+
+
+def test_metrics_and_cache_stats_cover_every_worker(tmp_path, monkeypatch):
+    seed_database(tmp_path, monkeypatch)
+    port = free_port()
+    process = start_server(port, 2)
+    try:
+        for i in list(range(10)) * 2:
+            status, body = post(port, "/update-credit-rating", {"customer_id": f"customer-000000{i}"})
+            assert status == 200, body
+        time.sleep(2)
+
+        # Whichever worker answers, it reports the requests both handled
+        series = 'credit_service_requests_total{endpoint="/update-credit-rating",method="POST",status="200"} 20'
+        for _ in range(6):
+            assert series in scrape(port).splitlines()
+        for _ in range(6):
+            stats = get(port, "/feature-cache-stats")[1]
+            assert stats["workers"] == 2
+            assert stats["hits"] + stats["misses"] == 20
+    finally:
+        stop_server(process)
+
+
+def test_worker_exits_after_max_requests(tmp_path, monkeypatch):
+    app = seed_database(tmp_path, monkeypatch)
+    sock = server.listen("127.0.0.1", 0)
+    server.preload(app)
+    port = sock.getsockname()[1]
+
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            code = server.run_worker(app, sock, max_requests=3)
+        finally:
+            os._exit(code)
+    try:
+        for i in range(3):
+            score(port, f"customer-000000{i}")
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+    finally:
+        sock.close()
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
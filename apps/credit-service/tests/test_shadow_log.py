@@ -0,0 +1,110 @@
+import shutil
+import threading
+import numpy as np
+import pytest
+import service
+from metrics import SHADOW_SCORES
+from model_registry import ModelRegistry, parse_shadow_models, DEFAULT_MODEL_PATH
+from shadow_log import ShadowLog, encode_block, read_shadow_log, summarise, log_paths
+
+
+def test_blocks_with_different_shadow_models_read_back_as_one_table(tmp_path):
+    path = tmp_path / "shadow.log"
+    with open(path, "wb") as f:
+        f.write(encode_block([
+            (1.0, "/update-credit-rating", "v3@a", np.array([700.0]), {"v4@b": np.array([710.0])}),
+            (2.0, "/batch-update-credit-rating", "v3@a", np.array([500.0, 600.0]), {"v4@b": np.array([450.0, 650.0]), "v5@c": np.array([500.0, 600.0])}),
+        ]))
+        f.write(encode_block([(3.0, "/update-credit-rating", "v3@a", np.array([800.0]), {})]))
+
+    frame = read_shadow_log([path])
+    assert frame["endpoint"].tolist() == ["/update-credit-rating", "/batch-update-credit-rating", "/batch-update-credit-rating", "/update-credit-rating"]
+    assert frame["row"].tolist() == [0, 0, 1, 0]
+    assert frame["primary_score"].tolist() == [700, 500, 600, 800]
+    assert frame["score:v4@b"].tolist()[:3] == [710, 450, 650]
+    assert np.isnan(frame["score:v5@c"][0]) and np.isnan(frame["score:v4@b"][3])
+
+    summary = summarise(frame)
+    assert summary["v4@b"]["rows"] == 3
+    assert summary["v4@b"]["mean_absolute_difference"] == pytest.approx(110 / 3)
+    assert summary["v5@c"] == {"rows": 2, "mean_difference": 0, "mean_absolute_difference": 0, "p95_absolute_difference": 0, "correlation": pytest.approx(1)}
+
+
+def test_a_block_cut_short_is_ignored(tmp_path):
+    path = tmp_path / "shadow.log"
+    block = encode_block([(1.0, "", "v3@a", np.array([700.0, 710.0]), {"v4@b": np.array([690.0, 720.0])})])
+    with open(path, "wb") as f:
+        f.write(block + block[:-3])
+
+    assert len(read_shadow_log([path])) == 2
+
+
+def test_scores_are_written_in_the_background(tmp_path):
+    log = ShadowLog(str(tmp_path), flush_interval=60)
+    assert log.append("v3@a", np.array([700.0, 800.0]), {"v4@b": np.array([705.0, 790.0])}, "/update-credit-rating")
+    log.flush()
+
+    frame = read_shadow_log(log_paths(str(tmp_path)))
+    assert frame["score:v4@b"].tolist() == [705, 790]
+    log.close()
+
+
+def test_a_full_queue_drops_scores_instead_of_blocking(tmp_path, monkeypatch):
+    log = ShadowLog(str(tmp_path), queue_size=2)
+    # A writer that is stuck and takes nothing off the queue
+    stuck = threading.Event()
+    monkeypatch.setattr(log, "_run", lambda records, path: stuck.wait())
+    dropped = SHADOW_SCORES.value(outcome="dropped")
+
+    results = [log.append("v3@a", np.array([700.0, 710.0]), {}) for _ in range(5)]
+    assert results == [True, True, False, False, False]
+    assert SHADOW_SCORES.value(outcome="dropped") == dropped + 6
+    stuck.set()
+    log.close(timeout=0.1)
+
+
+def test_parse_shadow_models():
+    assert parse_shadow_models("") == []
+    assert parse_shadow_models("v4=/models/v4.txt, v5 = /models/v5.txt") == [("v4", "/models/v4.txt"), ("v5", "/models/v5.txt")]
+    with pytest.raises(Exception, match="name=path"):
+        parse_shadow_models("/models/v4.txt")
+
+
+@pytest.fixture
+def shadow_models(tmp_path, monkeypatch):
+    registry = ModelRegistry()
+    registry.register("lgb_model_v3", DEFAULT_MODEL_PATH, primary=True)
+    candidate = tmp_path / "candidate.txt"
+    shutil.copy(DEFAULT_MODEL_PATH, candidate)
+    with open(candidate, "a") as f:
+        f.write("\n")
+    registry.register("candidate", str(candidate))
+    registry.register("broken", str(tmp_path / "missing.txt"))
+    log = ShadowLog(str(tmp_path / "shadow_log"), flush_interval=60)
+    monkeypatch.setattr(service, "model_registry", registry)
+    monkeypatch.setattr(service, "shadow_log", log)
+    yield registry, log
+    log.close()
+
+
+def test_predict_returns_the_primary_score_and_logs_the_shadow_scores(shadow_models):
+    registry, log = shadow_models
+    X = service.preprocess_batch(np.array([0.1, 0.5]), np.array([[-1] * 6, [2, 2, -1, -1, 3, -1]]))
+
+    credit_ratings, version = service.predict(X, with_version=True)
+    assert version == registry.get().version
+    assert credit_ratings.tolist() == ((1 - registry.get().predict(X)) * 1000).tolist()
+
+    log.flush()
+    frame = read_shadow_log(log_paths(log.directory))
+    # The broken model is skipped, the candidate scores the same features as the primary model
+    assert [column for column in frame.columns if column.startswith("score:")] == ["score:" + registry.get("candidate").version]
+    assert frame["primary_score"].tolist() == pytest.approx(credit_ratings.tolist())
+    assert summarise(frame)[registry.get("candidate").version]["mean_absolute_difference"] == pytest.approx(0, abs=1e-3)
+
+
+def test_shadow_scoring_can_be_turned_off_per_call(shadow_models):
+    _, log = shadow_models
+    service.predict(service.preprocess(0.1, [-1] * 6), shadow_models=[])
+    log.flush()
+    assert log.path is None
@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+from conftest import SRC_DIR
+
+# Importing main is what a new worker pays before it can serve; heavy libraries must stay lazy
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET_SECONDS", "1.5"))
+LAZY_MODULES = ["pandas", "tsfresh", "statsmodels", "scipy", "numba", "stumpy", "lightgbm", "fitz"]
+
+IMPORT_MAIN = f"""
+import json, sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "loaded": [m for m in {LAZY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def test_importing_main_is_fast_and_lazy():
+    output = subprocess.run([sys.executable, "-c", IMPORT_MAIN], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+
+    assert result["loaded"] == []
+    assert result["elapsed"] < IMPORT_TIME_BUDGET
+
+
+def test_create_app_warms_up_scoring(app):
+    from model_registry import registry
+    from feature_matrix import get_batch_plan
+
+    assert registry.primary in registry._models
+    assert get_batch_plan.cache_info().currsize == 1
+    assert "pandas" in sys.modules
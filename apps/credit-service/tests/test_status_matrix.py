@@ -0,0 +1,76 @@
+import random
+from datetime import datetime, timedelta
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from service import get_monthly_payment_statuses
+from status_matrix import add_months, months_between, compute_status_matrix, status_lists
+
+
+def random_datetime(rng, around, days):
+    # Month ends and times of day included, where relativedelta clips and compares
+    date = around + timedelta(days=rng.randrange(-days, days))
+    if rng.random() < 0.3:
+        date = date.replace(day=1) + relativedelta(months=1) - timedelta(days=rng.randrange(1, 4))
+    return date.replace(hour=rng.randrange(24), minute=rng.randrange(60), microsecond=rng.randrange(1000000))
+
+
+def random_customers(rng, now, n_customers):
+    customers = []
+    for _ in range(n_customers):
+        instalment_payments = []
+        for _ in range(rng.randrange(0, 8)):
+            due_date = random_datetime(rng, now - timedelta(days=90), 120)
+            paid_date = None
+            if rng.random() < 0.6:
+                paid_date = due_date + timedelta(days=rng.randrange(0, 400), seconds=rng.randrange(86400))
+            instalment_payments.append({"due_date": due_date, "paid_date": paid_date})
+        customers.append(instalment_payments)
+    return customers
+
+
+def test_month_arithmetic_matches_relativedelta():
+    rng = random.Random(3)
+    dates = [random_datetime(rng, datetime(2024, 6, 15), 800) for _ in range(2000)]
+    months = [rng.randrange(-15, 15) for _ in dates]
+    nows = [random_datetime(rng, datetime(2024, 6, 15), 800) for _ in dates]
+    dates64 = np.array(dates, dtype="M8[us]")
+
+    expected = np.array([date + relativedelta(months=k) for date, k in zip(dates, months)], dtype="M8[us]")
+    np.testing.assert_array_equal(add_months(dates64, np.array(months)), expected)
+    for now, date, actual in zip(nows, dates, months_between(np.array(nows, dtype="M8[us]"), dates64)):
+        difference = relativedelta(now, date)
+        assert actual == difference.years * 12 + difference.months
+
+
+def test_status_matrix_matches_scalar_statuses_on_random_customers():
+    rng = random.Random(11)
+    for _ in range(20):
+        now = random_datetime(rng, datetime(2024, 6, 15), 400)
+        customers = random_customers(rng, now, 200)
+        customer_rows = [row for row, payments in enumerate(customers) for _ in payments]
+        due_dates = np.array([payment["due_date"] for payments in customers for payment in payments], dtype="M8[us]")
+        paid_dates = np.array([payment["paid_date"] for payments in customers for payment in payments], dtype="M8[us]")
+
+        statuses, lengths = compute_status_matrix(customer_rows, due_dates, paid_dates, len(customers), now)
+
+        assert status_lists(statuses, lengths) == [get_monthly_payment_statuses(payments, now) for payments in customers]
+
+
+def test_status_lists_spanning_a_new_year_continue_into_the_next_year():
+    # Due in August, scored the next February: September to January must not all collapse into January
+    now = datetime(2025, 2, 20)
+    instalment_payments = [
+        {"due_date": datetime(2024, 8, 25), "paid_date": datetime(2024, 8, 25)},
+        {"due_date": datetime(2025, 2, 5), "paid_date": datetime(2025, 5, 5)},
+        {"due_date": datetime(2024, 12, 5), "paid_date": datetime(2025, 3, 5)},
+    ]
+    expected = [-1, -2, -2, -2, 3, -2, 3]
+    assert get_monthly_payment_statuses(instalment_payments, now) == expected
+
+    statuses, lengths = compute_status_matrix([0, 0, 0], np.array([p["due_date"] for p in instalment_payments], dtype="M8[us]"), np.array([p["paid_date"] for p in instalment_payments], dtype="M8[us]"), 1, now)
+    assert status_lists(statuses, lengths) == [expected]
+
+
+def test_customers_without_instalments_get_empty_lists():
+    statuses, lengths = compute_status_matrix([], np.array([], dtype="M8[us]"), np.array([], dtype="M8[us]"), 3, datetime(2024, 1, 1))
+    assert status_lists(statuses, lengths) == [[], [], []]
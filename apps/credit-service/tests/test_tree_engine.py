@@ -0,0 +1,70 @@
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+import pytest
+from feature_matrix import compute_feature_matrix
+from model_registry import ModelRegistry, DEFAULT_MODEL_PATH, file_sha256
+from tree_engine import CompiledModel, compile_lightgbm_model, load_compiled_model
+
+
+@pytest.fixture(scope="module")
+def booster():
+    return lgb.Booster(model_file=DEFAULT_MODEL_PATH)
+
+
+def random_features(rng, n_rows):
+    X = rng.normal(size=(n_rows, 247)) * 3
+    X[rng.random(X.shape) < 0.05] = np.nan
+    X[rng.random(X.shape) < 0.05] = 0
+    return X
+
+
+def test_compiled_model_matches_booster(booster):
+    rng = np.random.default_rng(11)
+    model = compile_lightgbm_model(DEFAULT_MODEL_PATH)
+    histories = rng.integers(-2, 7, size=(2000, 6))
+
+    for X in (random_features(rng, 3000), compute_feature_matrix(histories, rng.random(2000) * 3)):
+        np.testing.assert_allclose(model.predict(X), booster.predict(X), rtol=0, atol=1e-9)
+    single_row = pd.DataFrame(X[:1])
+    np.testing.assert_allclose(model.predict(single_row), booster.predict(single_row), rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize("params", [
+    {"use_missing": True},
+    {"use_missing": True, "zero_as_missing": True},
+    {"use_missing": False},
+])
+def test_compiled_model_handles_missing_values_like_lightgbm(tmp_path, params):
+    rng = np.random.default_rng(3)
+    X = random_features(rng, 2000)[:, :10]
+    y = (np.nan_to_num(X[:, 0]) + rng.normal(size=len(X)) > 0).astype(int)
+    trained = lgb.train({"objective": "binary", "num_leaves": 7, "verbose": -1, "seed": 0, **params}, lgb.Dataset(X, y), num_boost_round=20)
+    path = str(tmp_path / "model.txt")
+    trained.save_model(path)
+
+    model = compile_lightgbm_model(path)
+    np.testing.assert_allclose(model.predict(X), lgb.Booster(model_file=path).predict(X), rtol=0, atol=1e-9)
+
+
+def test_compiled_model_is_cached_and_memory_mapped(tmp_path):
+    sha256 = file_sha256(DEFAULT_MODEL_PATH)
+    first = load_compiled_model(DEFAULT_MODEL_PATH, sha256, str(tmp_path))
+    assert (tmp_path / sha256 / "meta.json").exists()
+
+    cached = CompiledModel.load(str(tmp_path / sha256))
+    assert all(isinstance(array, np.memmap) for array in cached.arrays.values())
+    X = random_features(np.random.default_rng(0), 10)
+    np.testing.assert_array_equal(cached.predict(X), first.predict(X))
+
+
+def test_registry_backends_agree(booster):
+    registry = ModelRegistry()
+    registry.register("compiled", DEFAULT_MODEL_PATH, backend="compiled")
+    registry.register("lightgbm", DEFAULT_MODEL_PATH, backend="lightgbm")
+    X = random_features(np.random.default_rng(5), 100)
+
+    assert isinstance(registry.get("compiled").booster, CompiledModel)
+    np.testing.assert_allclose(registry.get("compiled").predict(X), registry.get("lightgbm").predict(X), rtol=0, atol=1e-9)
+    with pytest.raises(Exception, match="Unknown model backend"):
+        registry.register("other", DEFAULT_MODEL_PATH, backend="xgboost")